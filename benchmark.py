@@ -0,0 +1,326 @@
+"""
+Benchmarks of the cost of doc_etl: the overhead of the decorators, the memory of the
+trace and the time of the writers. It runs offline and without stdin, and saves the
+results as JSON so they can be compared between versions:
+
+    python benchmark.py --output benchmark.json
+"""
+
+import argparse
+import atexit
+import contextlib
+import gc
+import json
+import os
+import platform
+import runpy
+import tempfile
+import time
+import timeit
+import tracemalloc
+
+import pandas as pd
+import polars as pl
+
+import doc_etl
+
+# The benchmarks write their own documentation
+atexit.unregister(doc_etl.write)
+
+MAIN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+
+
+def reset_trace():
+    """
+    Drop the calls traced so far
+    :return: None
+    """
+    doc_etl.flush()
+    doc_etl.TRACE = doc_etl.TraceStore()
+    gc.collect()
+
+
+@contextlib.contextmanager
+def working_directory():
+    """
+    Run in a temporary directory with the doc_etl folder
+    :return: A context manager
+    """
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as path:
+        os.chdir(path)
+        os.makedirs("doc_etl")
+        try:
+            yield path
+        finally:
+            os.chdir(cwd)
+
+
+def make_frame(library, width, rows=100):
+    """
+    Make a DataFrame
+    :param library: A string with the library, pandas or polars
+    :param width: An integer with the number of columns
+    :param rows: An integer with the number of rows
+    :return: A DataFrame
+    """
+    data = {f"column_{i}": list(range(rows)) for i in range(width)}
+    return pd.DataFrame(data) if library == "pandas" else pl.DataFrame(data)
+
+
+def per_call(function, number):
+    """
+    Time a function
+    :param function: A function without arguments
+    :param number: An integer with the number of calls
+    :return: A float with the best time per call in seconds
+    """
+    return min(timeit.repeat(function, number=number, repeat=3)) / number
+
+
+def bench_overhead(widths=(1, 10, 100, 1000), number=2000):
+    """
+    Measure the time the decorators add to each call of a function
+    :param widths: An iterable with the numbers of columns of the DataFrames
+    :param number: An integer with the number of calls of each measure
+    :return: A list with the results
+    """
+    results = []
+    for library in ("pandas", "polars"):
+        for width in widths:
+            df = make_frame(library, width)
+
+            def read():
+                return df
+
+            def step(df):
+                return df
+
+            def write(df):
+                return None
+
+            decorated = {
+                "extract": (read, doc_etl.extract("bench")(read), ()),
+                "transform": (step, doc_etl.transform()(step), (df,)),
+                "insert": (write, doc_etl.insert("bench")(write), (df,)),
+            }
+            for decorator, (bare, wrapped, args) in decorated.items():
+                reset_trace()
+                bare_time = per_call(lambda: bare(*args), number)
+                wrapped_time = per_call(lambda: wrapped(*args), number)
+                results.append(
+                    {
+                        "library": library,
+                        "width": width,
+                        "decorator": decorator,
+                        "bare_seconds": bare_time,
+                        "decorated_seconds": wrapped_time,
+                        "overhead_seconds": wrapped_time - bare_time,
+                    }
+                )
+
+    reset_trace()
+    return results
+
+
+def bench_memory(counts=(10, 100, 1000, 10000)):
+    """
+    Measure the memory of the trace after a number of calls, each with a new
+    DataFrame, so every call gets new labels
+    :param counts: An iterable with the numbers of calls
+    :return: A list with the results
+    """
+
+    @doc_etl.transform()
+    def step(df):
+        return df.copy()
+
+    results = []
+    for count in counts:
+        reset_trace()
+        tracemalloc.start()
+        start = tracemalloc.get_traced_memory()[0]
+
+        for i in range(count):
+            step(pd.DataFrame({"id": [i], "value": [i]}))
+        trace = doc_etl.flush()
+        gc.collect()
+
+        memory = tracemalloc.get_traced_memory()[0] - start
+        tracemalloc.stop()
+        results.append(
+            {
+                "calls": count,
+                "records": len(trace),
+                "labels": len(trace.labels()),
+                "bytes": memory,
+                "bytes_per_call": memory / count,
+            }
+        )
+
+    reset_trace()
+    return results
+
+
+def synthetic_trace(calls, width=10):
+    """
+    Build a trace with a chain of calls, where each call reads the DataFrame of the
+    previous one. One call in ten is an extract and one in ten is an insert
+    :param calls: An integer with the number of calls
+    :param width: An integer with the number of columns of the DataFrames
+    :return: A TraceStore
+    """
+    functions = {}
+    trace = doc_etl.TraceStore(functions=functions)
+    columns = tuple(f"column_{i}" for i in range(width))
+    dtypes = ("Int64",) * width
+    fingerprint = doc_etl.schema_fingerprint(columns, dtypes)
+    trace.add_table("table", columns)
+
+    for i in range(max(1, calls // 10)):
+        function_type = {0: "extract", 9: "insert"}.get(i % 10, "transform")
+        code = (
+            f"def function_{i}(df):\n" + "    df = df.copy()\n" * 20 + "    return df"
+        )
+        functions[f"bench.function_{i}"] = {
+            "name": f"function_{i}",
+            "type": function_type,
+            "docstring": f"Function {i} of the benchmark.",
+            "code": code,
+            "file": None,
+            "first_line": None,
+            "last_line": None,
+            "code_hash": doc_etl.content_hash(code),
+        }
+
+    keys = list(functions)
+    previous = None
+    for i in range(calls):
+        key = keys[i % len(keys)]
+        frame = doc_etl.FrameInfo(f"DataFrame_{i}", columns, fingerprint, dtypes)
+        function_type = functions[key]["type"]
+        trace.call_counts[key] += 1
+        if function_type == "extract" or previous is None:
+            trace.add_call(key, db_table=("table",), output=(frame,))
+        elif function_type == "insert":
+            trace.add_call(key, db_table=("table",), input=(previous,))
+            continue
+        else:
+            trace.add_call(key, input=(previous,), output=(frame,))
+        previous = frame
+    return trace
+
+
+def timed(function, *args, **kwargs):
+    """
+    Time a single call of a function
+    :param function: The function
+    :return: A float with the time in seconds
+    """
+    start = time.perf_counter()
+    function(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def read_json(path):
+    """
+    Load a trace from the JSON file of write_json
+    :param path: A string with the path of the file
+    :return: A TraceStore
+    """
+    with open(path) as f:
+        return doc_etl.TraceStore.from_dict(json.load(f))
+
+
+def bench_writers(sizes=(10, 100, 1000, 10000, 100000)):
+    """
+    Measure the time of the writers, and of the loaders of the JSON and columnar
+    exports, with synthetic traces
+    :param sizes: An iterable with the numbers of calls
+    :return: A list with the results
+    """
+    results = []
+    with working_directory():
+        for size in sizes:
+            trace = synthetic_trace(size)
+            result = {"calls": size, "records": len(trace)}
+
+            start = time.perf_counter()
+            substitutions = doc_etl.frame_names(trace)
+            doc_etl.correct_df_names(trace, substitutions)
+            result["naming_seconds"] = time.perf_counter() - start
+
+            result["write_json_seconds"] = timed(doc_etl.write_json, trace)
+            result["write_mermaid_seconds"] = timed(doc_etl.write_mermaid, trace)
+            result["write_prompt_seconds"] = timed(doc_etl.write_prompt, trace)
+            result["write_columnar_seconds"] = timed(doc_etl.write_columnar, trace)
+            result["read_json_seconds"] = timed(read_json, "doc_etl/raw.json")
+            result["read_columnar_seconds"] = timed(doc_etl.read_columnar)
+            result["sizes_bytes"] = {
+                name: os.path.getsize(os.path.join("doc_etl", name))
+                for name in ("raw.json", "mermaid.md", "prompt.md")
+            }
+            result["sizes_bytes"]["trace"] = sum(
+                entry.stat().st_size for entry in os.scandir("doc_etl/trace")
+            )
+            results.append(result)
+    return results
+
+
+def bench_pipeline(repeat=5):
+    """
+    Measure the example pipeline of main.py, traced, and the writing of its
+    documentation
+    :param repeat: An integer with the number of runs
+    :return: A dictionary with the results
+    """
+    runs, writes = [], []
+    with working_directory():
+        for _ in range(repeat):
+            reset_trace()
+            runs.append(timed(runpy.run_path, MAIN_PATH, run_name="__main__"))
+            writes.append(timed(doc_etl.write_docs, doc_etl.flush()))
+
+    reset_trace()
+    return {
+        "runs": repeat,
+        "pipeline_seconds": min(runs),
+        "write_docs_seconds": min(writes),
+    }
+
+
+def main(argv=None):
+    """
+    Run the benchmarks and save the results
+    :param argv: A list with the command line arguments
+    :return: An integer with the exit code
+    """
+    parser = argparse.ArgumentParser(description="Doc ETL benchmarks")
+    parser.add_argument("--output", default="benchmark.json")
+    parser.add_argument(
+        "--quick", action="store_true", help="Run smaller sizes, up to 10k calls"
+    )
+    args = parser.parse_args(argv)
+
+    sizes = (10, 100, 1000, 10000) if args.quick else (10, 100, 1000, 10000, 100000)
+    results = {
+        "environment": {
+            "python": platform.python_version(),
+            "pandas": pd.__version__,
+            "polars": pl.__version__,
+            "platform": platform.platform(),
+        },
+        "pipeline": bench_pipeline(),
+        "overhead": bench_overhead(number=500 if args.quick else 2000),
+        "memory": bench_memory(sizes[:4]),
+        "writers": bench_writers(sizes),
+    }
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=4)
+    print(f"Benchmark results saved to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
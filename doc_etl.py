@@ -1,319 +1,4634 @@
+import ast
 import atexit
+import collections
+import contextvars
 import functools
+import gc
+import hashlib
+import importlib
 import inspect
+import itertools
 import json
+import linecache
 import os
+import pickle
+import random
+import sys
+import textwrap
+import threading
+import time
+import tracemalloc
+import warnings
+import weakref
 
-import pandas as pd
-import polars as pl
 
-# TODO: Find a better way to handle getting the table schema
-from const import data_schema as DB_SCHEMA
+def parse_schema(schema):
+    """
+    Parse the schema of a table from the output of the defined query
+    :param schema: A list with the schema of the table
+    :return: A list with the columns of the table
+    """
+    columns = []
+    for column in schema:
+        column_name = column[2]
+        columns.append(column_name)
+    return columns
+
+
+class SchemaProvider:
+    """
+    Base class for the sources of the database schema. A provider yields rows with
+    the same layout as the defined query: (schema, table_name, column_name, ...)
+    """
+
+    def rows(self):
+        """
+        Get the rows of the database schema
+        :return: An iterable with the rows of the schema
+        """
+        raise NotImplementedError
+
+    def build_index(self):
+        """
+        Build the index of the database schema, keyed by table name
+        :return: A dictionary with the table names and the ordered columns
+        """
+        tables = {}
+        for row in self.rows():
+            tables.setdefault(row[1], []).append(row)
+
+        return {
+            table_name: tuple(parse_schema(table_schema))
+            for table_name, table_schema in tables.items()
+        }
+
+
+class ConstSchemaProvider(SchemaProvider):
+    """
+    Schema provider for a static schema defined in a Python module
+    """
+
+    def __init__(self, module="const", attribute="data_schema"):
+        self.module = module
+        self.attribute = attribute
+
+    def rows(self):
+        return getattr(importlib.import_module(self.module), self.attribute)
+
+
+class FileSchemaProvider(SchemaProvider):
+    """
+    Schema provider for a snapshot of the schema saved on disk. JSON snapshots can be
+    a list of rows or a dictionary with the table names and their columns. Parquet
+    snapshots must have the "table_name" and "column_name" columns
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def rows(self):
+        if self.path.endswith(".parquet"):
+            import polars as pl
+
+            schema = pl.read_parquet(self.path, columns=["table_name", "column_name"])
+            return ((None, table, column) for table, column in schema.iter_rows())
+
+        with open(self.path) as f:
+            schema = json.load(f)
+
+        if isinstance(schema, dict):
+            return (
+                (None, table, column)
+                for table, columns in schema.items()
+                for column in columns
+            )
+        return schema
+
+
+class DBAPISchemaProvider(SchemaProvider):
+    """
+    Schema provider for a DB-API 2.0 connection
+    """
+
+    query = (
+        "SELECT table_schema, table_name, column_name "
+        "FROM information_schema.columns "
+        "ORDER BY table_schema, table_name, ordinal_position"
+    )
+
+    def __init__(self, connection, query=None):
+        self.connection = connection
+        if query is not None:
+            self.query = query
+
+    def rows(self):
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute(self.query)
+            return cursor.fetchall()
+        finally:
+            cursor.close()
+
+
+class SQLiteSchemaProvider(DBAPISchemaProvider):
+    """
+    Schema provider for a SQLite database, used as a local stand-in of the warehouse
+    """
+
+    query = (
+        "SELECT 'main', m.name, p.name "
+        "FROM sqlite_master AS m JOIN pragma_table_info(m.name) AS p "
+        "WHERE m.type IN ('table', 'view') "
+        "ORDER BY m.name, p.cid"
+    )
+
+    def __init__(self, database, query=None):
+        if isinstance(database, str):
+            import sqlite3
+
+            database = sqlite3.connect(database)
+        super().__init__(database, query)
+
+
+SCHEMA_PROVIDER = None
+SCHEMA_INDEX = None
+
+
+def set_schema_provider(provider):
+    """
+    Set the provider of the database schema and drop the cached lookups
+    :param provider: A SchemaProvider instance
+    :return: None
+    """
+    global SCHEMA_PROVIDER, SCHEMA_INDEX
+    SCHEMA_PROVIDER = provider
+    SCHEMA_INDEX = None
+    get_table.cache_clear()
+
+
+def get_schema_index():
+    """
+    Get the index of the database schema, building it on the first call
+    :return: A dictionary with the table names and the ordered columns
+    """
+    global SCHEMA_PROVIDER, SCHEMA_INDEX
+    if SCHEMA_INDEX is not None:
+        return SCHEMA_INDEX
+
+    if SCHEMA_PROVIDER is None:
+        schema_path = os.environ.get("DOC_ETL_SCHEMA")
+        if schema_path:
+            SCHEMA_PROVIDER = FileSchemaProvider(schema_path)
+        else:
+            SCHEMA_PROVIDER = ConstSchemaProvider()
+
+    # The schema is built when the documentation is written at exit, so a provider
+    # that fails in any way (a missing module, a malformed snapshot or the errors of
+    # a DB-API driver, which have no common base class) only leaves the tables
+    # without columns. The failure is cached, so it is not retried on every lookup
+    try:
+        SCHEMA_INDEX = SCHEMA_PROVIDER.build_index()
+    except Exception as error:
+        warnings.warn(f"Could not load the database schema: {error!r}")
+        SCHEMA_INDEX = {}
+    return SCHEMA_INDEX
+
+
+@functools.lru_cache(maxsize=1024)
+def get_table(table):
+    """
+    Get the schema of a table from the database schema. The returned dictionary is
+    cached, so it must not be modified
+    :param table: A string with the table name
+    :return: A dictionary with the table schema
+    """
+    return {table: list(get_schema_index().get(table, ()))}
+
+
+# Static information of the decorated functions, filled once at decoration time
+FUNCTION_REGISTRY = {}
+
+
+def register_function(func, func_type):
+    """
+    Register the static information of a decorated function
+    :param func: The decorated function
+    :param func_type: A string with the function type (extract, transform or insert)
+    :return: A string with the key of the function in the registry
+    """
+    # The spawned worker processes import the main module as __mp_main__
+    module = "__main__" if func.__module__ == "__mp_main__" else func.__module__
+    key = f"{module}.{func.__qualname__}"
+
+    try:
+        lines, first_line = inspect.getsourcelines(func)
+        code = "".join(lines).strip()
+        last_line = first_line + len(lines) - 1
+    except (OSError, TypeError):
+        # The source is not available (e.g. functions defined in a REPL)
+        code = ""
+        first_line = last_line = None
+
+    FUNCTION_REGISTRY[key] = {
+        "name": func.__name__,
+        "type": func_type,
+        "docstring": (func.__doc__ or "").replace("\n", " "),
+        "code": code,
+        "file": inspect.getsourcefile(func) if first_line else None,
+        "first_line": first_line,
+        "last_line": last_line,
+        "code_hash": hashlib.sha256(code.encode()).hexdigest(),
+    }
+    return key
+
+
+# Information of a logged DataFrame. The schema and size fields are optional, so
+# plain tuples with the label and the columns can be used as well
+FrameInfo = collections.namedtuple(
+    "FrameInfo",
+    ["label", "columns", "fingerprint", "dtypes", "rows", "size", "name"],
+    defaults=(None, None, None, None, None),
+)
+
+
+class StageMetrics:
+    """
+    Runtime metrics of the calls of a decorated function. The durations are kept in
+    a bounded reservoir sample, so the percentiles use constant memory
+    """
+
+    __slots__ = (
+        "calls",
+        "wall",
+        "cpu",
+        "wall_max",
+        "wall_samples",
+        "cpu_samples",
+        "rows_in",
+        "rows_out",
+        "bytes_in",
+        "bytes_out",
+        "peak_memory",
+        "_summary",
+        "_random",
+    )
+
+    reservoir_size = 1024
+
+    def __init__(self):
+        self.calls = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.wall_max = 0.0
+        self.wall_samples = []
+        self.cpu_samples = []
+        self.rows_in = 0
+        self.rows_out = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.peak_memory = None
+        self._summary = None
+        # The sampling does not use or change the random state of the pipeline
+        self._random = random.Random()
+
+    def add(
+        self,
+        wall,
+        cpu,
+        rows_in=0,
+        rows_out=0,
+        bytes_in=0,
+        bytes_out=0,
+        peak_memory=None,
+    ):
+        """
+        Add the metrics of a call
+        :param wall: A float with the wall-clock time in seconds
+        :param cpu: A float with the CPU time in seconds
+        :param rows_in: An integer with the rows of the input DataFrames
+        :param rows_out: An integer with the rows of the output DataFrames
+        :param bytes_in: An integer with the in-memory size of the input DataFrames
+        :param bytes_out: An integer with the in-memory size of the output DataFrames
+        :param peak_memory: An integer with the peak allocation delta in bytes
+        :return: None
+        """
+        self.calls += 1
+        self.wall += wall
+        self.cpu += cpu
+        self.wall_max = max(self.wall_max, wall)
+
+        # Reservoir sampling of the durations
+        if len(self.wall_samples) < self.reservoir_size:
+            self.wall_samples.append(wall)
+            self.cpu_samples.append(cpu)
+        else:
+            i = self._random.randrange(self.calls)
+            if i < self.reservoir_size:
+                self.wall_samples[i] = wall
+                self.cpu_samples[i] = cpu
+
+        self.rows_in += rows_in
+        self.rows_out += rows_out
+        self.bytes_in += bytes_in
+        self.bytes_out += bytes_out
+        if peak_memory is not None:
+            self.peak_memory = max(self.peak_memory or 0, peak_memory)
+
+    def summary(self):
+        """
+        Get the summary of the metrics
+        :return: A dictionary with the totals and the p50, p95 and max durations
+        """
+        if self._summary is not None:
+            return self._summary
+
+        def percentile(samples, q):
+            samples = sorted(samples)
+            return samples[round(q * (len(samples) - 1))] if samples else 0.0
+
+        return {
+            "calls": self.calls,
+            "wall_total": self.wall,
+            "wall_p50": percentile(self.wall_samples, 0.5),
+            "wall_p95": percentile(self.wall_samples, 0.95),
+            "wall_max": self.wall_max,
+            "cpu_total": self.cpu,
+            "cpu_p50": percentile(self.cpu_samples, 0.5),
+            "cpu_p95": percentile(self.cpu_samples, 0.95),
+            "rows_in": self.rows_in,
+            "rows_out": self.rows_out,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "peak_memory": self.peak_memory,
+        }
+
+    @classmethod
+    def from_summary(cls, summary):
+        """
+        Build the metrics from a summary returned by summary()
+        :param summary: A dictionary with the summary of the metrics
+        :return: A StageMetrics
+        """
+        metrics = cls()
+        metrics.calls = summary["calls"]
+        metrics.wall = summary["wall_total"]
+        metrics.cpu = summary["cpu_total"]
+        metrics.wall_max = summary["wall_max"]
+        metrics._summary = summary
+        return metrics
+
+
+class CallRecord:
+    """
+    Record of the calls of a decorated function that share the same shape: same
+    tables, and same input and output DataFrames with the same columns
+    """
+
+    __slots__ = ("function", "db_table", "input", "output", "count")
+
+    def __init__(self, function, db_table, input, output, count=1):
+        self.function = function
+        self.db_table = db_table
+        self.input = input
+        self.output = output
+        self.count = count
+
+
+class TraceStore:
+    """
+    Store of the traced calls. Strings and column lists are interned, so every
+    function, table and column list is kept once, and the calls with the same shape
+    are collapsed into a single record with a count
+    """
+
+    def __init__(self, functions=None):
+        self.functions = FUNCTION_REGISTRY if functions is None else functions
+        self.tables = {}
+        self.frames = {}
+        self.names = {}
+        self.profiles = {}
+        self.call_counts = collections.Counter()
+        self.chunk_counts = collections.Counter()
+        self.metrics = {}
+        self._strings = {}
+        self._columns = {}
+        self._records = {}
+        self._occurrences = collections.defaultdict(list)
+
+    def __len__(self):
+        return len(self._records)
+
+    def intern(self, string):
+        """
+        Get the interned copy of a string
+        :param string: A string
+        :return: The interned string
+        """
+        return self._strings.setdefault(string, string)
+
+    def intern_columns(self, columns):
+        """
+        Get the interned copy of a list of columns
+        :param columns: An iterable with the column names
+        :return: A tuple with the interned column names
+        """
+        interned = self._columns.get(columns) if type(columns) is tuple else None
+        if interned is not None:
+            return interned
+        columns = tuple(self.intern(str(column)) for column in columns)
+        return self._columns.setdefault(columns, columns)
+
+    def add_table(self, table_name, columns):
+        """
+        Add the schema of a database table to the store
+        :param table_name: A string with the table name
+        :param columns: An iterable with the column names
+        :return: The interned table name
+        """
+        table_name = self.intern(table_name)
+        if table_name not in self.tables:
+            self.tables[table_name] = self.intern_columns(columns)
+        return table_name
+
+    def add_frame(self, label, fingerprint, dtypes, name=None):
+        """
+        Add the schema fingerprint of a DataFrame to the store
+        :param label: A string with the DataFrame label
+        :param fingerprint: A string with the schema fingerprint
+        :param dtypes: An iterable with the column data types
+        :param name: A string with the name inferred for the DataFrame, or None. The
+            first name given to a label is kept
+        :return: The interned label
+        """
+        label = self.intern(label)
+        if label not in self.frames:
+            self.frames[label] = (self.intern(fingerprint), self.intern_columns(dtypes))
+        if name and label not in self.names:
+            self.names[label] = self.intern(name)
+        return label
+
+    def add_profile(self, label, profile):
+        """
+        Add the profile of a DataFrame to the store. The first profile of a label is
+        kept
+        :param label: A string with the DataFrame label
+        :param profile: A dictionary returned by profile_frame
+        :return: None
+        """
+        self.profiles.setdefault(self.intern(label), profile)
+
+    def add_call(
+        self, function, db_table=(), input=(), output=(), count=1, aggregate=False
+    ):
+        """
+        Add a call of a decorated function to the store
+        :param function: A string with the key of the function in the registry
+        :param db_table: An iterable with the table names
+        :param input: An iterable with the FrameInfo of the input DataFrames
+        :param output: An iterable with the FrameInfo of the output DataFrames
+        :param count: An integer with the number of calls
+        :param aggregate: A boolean to collapse the calls with the same input and
+            output schemas, regardless of the DataFrame labels
+        :return: The CallRecord of the call
+        """
+        input = [f if type(f) is FrameInfo else FrameInfo(*f) for f in input]
+        output = [f if type(f) is FrameInfo else FrameInfo(*f) for f in output]
+        shape = (
+            self.intern(function),
+            tuple(self.intern(table) for table in db_table),
+            tuple(
+                (self.intern(f.label), self.intern_columns(f.columns)) for f in input
+            ),
+            tuple(
+                (self.intern(f.label), self.intern_columns(f.columns)) for f in output
+            ),
+        )
+
+        key = shape
+        if aggregate:
+            key = (
+                "aggregate",
+                shape[0],
+                shape[1],
+                tuple(f.fingerprint or f.columns for f in input),
+                tuple(f.fingerprint or f.columns for f in output),
+            )
+
+        record = self._records.get(key)
+        if record is not None:
+            record.count += count
+            # Keep a name given to a DataFrame after its first call
+            for frame in itertools.chain(input, output):
+                if frame.name and frame.label in self.frames:
+                    self.add_frame(
+                        frame.label, frame.fingerprint, frame.dtypes, frame.name
+                    )
+            return record
+
+        for frame in itertools.chain(input, output):
+            if frame.fingerprint is not None:
+                self.add_frame(frame.label, frame.fingerprint, frame.dtypes, frame.name)
+        record = self._records[key] = CallRecord(*shape, count=count)
+        for direction in ("input", "output"):
+            for position, (label, _) in enumerate(getattr(record, direction)):
+                self._occurrences[label].append((record, direction, position))
+        return record
+
+    def add_metrics(self, function, *args, **kwargs):
+        """
+        Add the runtime metrics of a call of a decorated function
+        :param function: A string with the key of the function in the registry
+        :return: None
+        """
+        metrics = self.metrics.get(function)
+        if metrics is None:
+            metrics = self.metrics[self.intern(function)] = StageMetrics()
+        metrics.add(*args, **kwargs)
+
+    def slowest(self, n=5):
+        """
+        Get the functions with the largest total wall-clock time
+        :param n: An integer with the number of functions
+        :return: A list with the keys of the functions
+        """
+        return sorted(
+            self.metrics, key=lambda key: self.metrics[key].wall, reverse=True
+        )[:n]
+
+    def calls(self, record):
+        """
+        Get the total number of calls of the function of a record, including the
+        calls that were not recorded by the capture policy
+        :param record: A CallRecord
+        :return: An integer with the number of calls
+        """
+        return self.call_counts.get(record.function) or record.count
+
+    def labels(self):
+        """
+        Get the labels of the DataFrames of the store
+        :return: A view with the labels
+        """
+        return self._occurrences.keys()
+
+    def occurrences(self, label):
+        """
+        Get the places where a DataFrame is used, in the order they were recorded
+        :param label: A string with the DataFrame label
+        :return: A list with tuples of the CallRecord, the direction ("input" or
+            "output") and the position of the DataFrame
+        """
+        return self._occurrences.get(label, [])
+
+    def rename(self, substitutions):
+        """
+        Rename DataFrames in place, updating only the records where they are used
+        :param substitutions: A dictionary with the DataFrame labels and new labels
+        :return: None
+        """
+        # Pop all the renamed labels first, so labels can be swapped
+        moved = [
+            (label, self.intern(new_label), self._occurrences.pop(label))
+            for label, new_label in substitutions.items()
+            if label in self._occurrences and label != new_label
+        ]
+        frames = {label: self.frames.pop(label, None) for label, _, _ in moved}
+        names = {label: self.names.pop(label, None) for label, _, _ in moved}
+        profiles = {label: self.profiles.pop(label, None) for label, _, _ in moved}
+
+        for label, new_label, occurrences in moved:
+            for record, direction, position in occurrences:
+                frames_list = list(getattr(record, direction))
+                frames_list[position] = (new_label, frames_list[position][1])
+                setattr(record, direction, tuple(frames_list))
+            self._occurrences[new_label].extend(occurrences)
+
+            if frames[label] is not None:
+                self.frames.setdefault(new_label, frames[label])
+            if names[label] is not None:
+                self.names.setdefault(new_label, names[label])
+            if profiles[label] is not None:
+                self.profiles.setdefault(new_label, profiles[label])
+
+    def function(self, record):
+        """
+        Get the static information of the function of a record
+        :param record: A CallRecord
+        :return: A dictionary with the function information
+        """
+        return self.functions[record.function]
+
+    def items(self):
+        """
+        Iterate over the records of the store
+        :return: A generator with tuples of the record ID and the CallRecord
+        """
+        for i, record in enumerate(self._records.values()):
+            yield f"call_{i}", record
+
+    def to_dict(self):
+        """
+        Convert the store to a dictionary that can be serialized to JSON
+        :return: A dictionary with the functions, tables and calls
+        """
+        used_functions = {record.function for record in self._records.values()}
+        return {
+            "functions": {
+                key: info
+                for key, info in self.functions.items()
+                if key in used_functions
+            },
+            "call_counts": dict(self.call_counts),
+            "chunk_counts": dict(self.chunk_counts),
+            "metrics": {key: value.summary() for key, value in self.metrics.items()},
+            "tables": {name: list(columns) for name, columns in self.tables.items()},
+            "frames": {
+                label: {
+                    "fingerprint": fingerprint,
+                    "dtypes": list(dtypes),
+                    "name": self.names.get(label),
+                }
+                for label, (fingerprint, dtypes) in self.frames.items()
+            },
+            "profiles": self.profiles,
+            "calls": {
+                call_id: {
+                    "function": record.function,
+                    "count": record.count,
+                    "db_table": list(record.db_table),
+                    "input": [{label: list(cols)} for label, cols in record.input],
+                    "output": [{label: list(cols)} for label, cols in record.output],
+                }
+                for call_id, record in self.items()
+            },
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        Build a store from the dictionary returned by to_dict
+        :param data: A dictionary with the functions, tables and calls
+        :return: A TraceStore
+        """
+        trace = cls(functions=dict(data["functions"]))
+        trace.call_counts.update(data.get("call_counts", {}))
+        trace.chunk_counts.update(data.get("chunk_counts", {}))
+        for key, summary in data.get("metrics", {}).items():
+            trace.metrics[key] = StageMetrics.from_summary(summary)
+        for table_name, columns in data["tables"].items():
+            trace.add_table(table_name, columns)
+        for label, frame in data.get("frames", {}).items():
+            trace.add_frame(
+                label, frame["fingerprint"], frame["dtypes"], frame.get("name")
+            )
+
+        for label, profile in data.get("profiles", {}).items():
+            trace.add_profile(label, profile)
+
+        for call in data["calls"].values():
+            trace.add_call(
+                call["function"],
+                call["db_table"],
+                [item for df in call["input"] for item in df.items()],
+                [item for df in call["output"] for item in df.items()],
+                count=call.get("count", 1),
+            )
+        return trace
+
+
+# TODO: Is there a way to not use a global variable?
+TRACE = TraceStore()
+TRACE_LOCK = threading.Lock()
+
+
+class TraceBuffer:
+    """
+    Buffer of the calls made by a thread or an asyncio task. The calls are appended
+    without locking and merged into the global trace when the buffer is full or when
+    the documentation is written
+    """
+
+    __slots__ = ("thread", "events", "call_counts")
+
+    flush_size = 1024
+
+    def __init__(self):
+        self.thread = threading.get_ident()
+        self.events = collections.deque()
+        self.call_counts = collections.Counter()
+
+    def add(self, *event):
+        """
+        Add an event to the buffer
+        :param event: A tuple with the event type and its arguments
+        :return: None
+        """
+        self.events.append(event)
+        if len(self.events) >= self.flush_size:
+            flush_buffer(self)
+
+
+class BufferOwner:
+    """
+    Token of the buffer of a thread, kept in its thread-local storage. The values of
+    a threading.local are dropped when their thread ends, so the buffer of a finished
+    thread is released when its token is collected
+    """
+
+    __slots__ = ("__weakref__",)
+
+
+# Buffer of the current thread or task, the buffer of each thread, and the buffers
+# of the running threads
+CURRENT_BUFFER = contextvars.ContextVar("doc_etl_buffer", default=None)
+THREAD_BUFFERS = threading.local()
+BUFFERS = []
+
+
+def release_buffer(buffer):
+    """
+    Merge the events of the buffer of a finished thread into the trace, and forget
+    the buffer
+    :param buffer: A TraceBuffer
+    :return: None
+    """
+    flush_buffer(buffer)
+    try:
+        BUFFERS.remove(buffer)
+    except ValueError:
+        pass
+
+
+def get_buffer():
+    """
+    Get the trace buffer of the current thread or asyncio task. The tasks that run
+    in the same thread share its buffer, as they can not interleave their appends
+    :return: A TraceBuffer
+    """
+    buffer = CURRENT_BUFFER.get()
+
+    # Threads started with a copy of the context (e.g. asyncio.to_thread) must not
+    # share the buffer of their parent
+    if buffer is None or buffer.thread != threading.get_ident():
+        buffer = getattr(THREAD_BUFFERS, "buffer", None)
+        if buffer is None:
+            buffer = THREAD_BUFFERS.buffer = TraceBuffer()
+            BUFFERS.append(buffer)
+            owner = THREAD_BUFFERS.owner = BufferOwner()
+            # The buffers left at exit are flushed when the documentation is written
+            weakref.finalize(owner, release_buffer, buffer).atexit = False
+        CURRENT_BUFFER.set(buffer)
+    return buffer
+
+
+def apply_events(trace, events, call_counts):
+    """
+    Add the events of a buffer to a trace
+    :param trace: A TraceStore
+    :param events: A list with the events
+    :param call_counts: A Counter with the number of calls of each function
+    :return: None
+    """
+    trace.call_counts.update(call_counts)
+    for event_type, function_key, *args in events:
+        if event_type == "call":
+            tables, inputs, outputs, aggregate = args
+            trace.add_call(
+                function_key,
+                db_table=log_tables(tables, trace),
+                input=inputs,
+                output=outputs,
+                aggregate=aggregate,
+            )
+        elif event_type == "metrics":
+            trace.add_metrics(function_key, *args)
+        elif event_type == "chunks":
+            trace.chunk_counts[function_key] += args[0]
+        elif event_type == "profile":
+            trace.add_profile(*args)
+
+
+def flush_buffer(buffer, trace=None):
+    """
+    Merge the events of a buffer into the trace. The worker processes write them to
+    their spool file, and the journal mode to the journal, instead
+    :param buffer: A TraceBuffer
+    :param trace: A TraceStore, by default the global trace
+    :return: None
+    """
+    with TRACE_LOCK:
+        counts, buffer.call_counts = buffer.call_counts, collections.Counter()
+        events = []
+        while buffer.events:
+            events.append(buffer.events.popleft())
+
+        journal = SPOOL or JOURNAL
+        if trace is None and journal is not None:
+            journal.write_events(events, counts)
+        else:
+            apply_events(TRACE if trace is None else trace, events, counts)
+
+
+def flush():
+    """
+    Merge the buffers of all the threads and tasks into the global trace
+    :return: The global TraceStore
+    """
+    for buffer in list(BUFFERS):
+        flush_buffer(buffer)
+    return TRACE
+
+
+@functools.lru_cache(maxsize=4096)
+def schema_fingerprint(columns, dtypes):
+    """
+    Get a fingerprint of a DataFrame schema from its column names and data types
+    :param columns: A tuple with the column names
+    :param dtypes: A tuple with the column data types
+    :return: A string with the fingerprint
+    """
+    schema = repr(tuple(zip(columns, dtypes))).encode()
+    return hashlib.blake2b(schema, digest_size=8).hexdigest()
+
+
+class FrameRegistry:
+    """
+    Registry that gives each DataFrame a monotonically increasing label. Frames are
+    tracked through weak references, so the registry never keeps them alive and a
+    reused id() never returns the label of a collected frame. Objects that can not be
+    weak-referenced fall back to their id() and schema fingerprint
+    """
+
+    def __init__(self, prefix="DataFrame_"):
+        self.prefix = prefix
+        self.types = set()
+        self._labels = {}
+        self._counter = itertools.count(1)
+
+    def __len__(self):
+        return len(self._labels)
+
+    def label(self, df, fingerprint):
+        """
+        Get the label of a DataFrame, creating a new one if it was not seen before
+        :param df: A DataFrame
+        :param fingerprint: A string with the schema fingerprint of the DataFrame
+        :return: A string with the label
+        """
+        key = id(df)
+        entry = self._labels.get(key)
+        if entry is not None:
+            ref, label, entry_fingerprint = entry
+            if ref is not None and ref() is df:
+                return label
+            if ref is None and entry_fingerprint == fingerprint:
+                return label
+
+        label = f"{self.prefix}{next(self._counter)}"
+        try:
+            ref = weakref.ref(df, functools.partial(self._forget, key))
+        except TypeError:
+            ref = None
+        self._labels[key] = (ref, label, fingerprint)
+
+        # The labels are sent with the DataFrames to and from the worker processes
+        if type(df) not in self.types:
+            self.types.add(type(df))
+            if MULTIPROCESS:
+                share_labels(type(df))
+        return label
+
+    def find(self, df):
+        """
+        Get the label of a DataFrame, without creating one
+        :param df: A DataFrame
+        :return: A string with the label, or None if the DataFrame was not labeled
+        """
+        entry = self._labels.get(id(df))
+        if entry is not None and entry[0] is not None and entry[0]() is df:
+            return entry[1]
+        return None
+
+    def adopt(self, df, label):
+        """
+        Give a DataFrame the label it has in another process
+        :param df: A DataFrame
+        :param label: A string with the label
+        :return: None
+        """
+        key = id(df)
+        try:
+            ref = weakref.ref(df, functools.partial(self._forget, key))
+        except TypeError:
+            return
+        self._labels[key] = (ref, label, None)
+
+    def _forget(self, key, ref):
+        """
+        Remove the entry of a collected DataFrame
+        :param key: The id() of the DataFrame
+        :param ref: The dead weak reference
+        :return: None
+        """
+        entry = self._labels.get(key)
+        if entry is not None and entry[0] is ref:
+            del self._labels[key]
+
+
+FRAME_REGISTRY = FrameRegistry()
+
+
+class FrameAdapter:
+    """
+    Adapter of the DataFrame types of a library: how to get their schema, number of
+    rows, in-memory size and column statistics. An adapter is loaded on the first
+    dispatch after the pipeline imports its library, so doc_etl never imports it
+    """
+
+    # Name of the module of the library
+    library = None
+
+    def __init__(self, module):
+        self.module = module
+
+    def types(self):
+        """
+        Get the DataFrame types handled by the adapter
+        :return: A tuple with the types
+        """
+        raise NotImplementedError
+
+    def readers(self):
+        """
+        Get the chunk reader types of the library: the iterators that yield its
+        DataFrames, whose chunks are logged as they are consumed
+        :return: A tuple with the types
+        """
+        return ()
+
+    def schema(self, df):
+        """
+        Get the schema of a DataFrame
+        :param df: A DataFrame
+        :return: A tuple with the tuples of the columns and the data types
+        """
+        raise NotImplementedError
+
+    def rows(self, df):
+        """
+        Get the number of rows of a DataFrame
+        :param df: A DataFrame
+        :return: An integer, or None if it is not known without computing it
+        """
+        return None
+
+    def size(self, df):
+        """
+        Get the in-memory size of a DataFrame
+        :param df: A DataFrame
+        :return: An integer with the size in bytes, or None
+        """
+        return None
+
+    def sample(self, df, n):
+        """
+        Get a random sample of the rows of a DataFrame, the same in every run
+        :param df: A DataFrame
+        :param n: An integer with the number of rows
+        :return: A DataFrame with the sampled rows
+        """
+        return df
+
+    def statistics(self, df):
+        """
+        Compute the statistics of the columns of a DataFrame
+        :param df: A DataFrame
+        :return: A dictionary with the data type, null count, distinct count, minimum
+            and maximum of each column, or None if the type is not profiled
+        """
+        return None
+
+
+def dtype_name(dtype):
+    """
+    Get the name of a data type. The names are cached, since converting the data
+    types of a wide DataFrame to strings on every call is slow
+    :param dtype: A numpy or pandas data type
+    :return: A string with the data type name
+    """
+    try:
+        return _dtype_name(dtype)
+    except TypeError:
+        # Unhashable data types
+        return str(dtype)
+
+
+@functools.lru_cache(maxsize=1024)
+def _dtype_name(dtype):
+    """
+    Get the name of a hashable data type
+    :param dtype: A numpy or pandas data type
+    :return: A string with the data type name
+    """
+    return str(dtype)
+
+
+class PandasAdapter(FrameAdapter):
+    """
+    Adapter of the pandas DataFrames
+    """
+
+    library = "pandas"
+
+    def types(self):
+        return (self.module.DataFrame,)
+
+    def readers(self):
+        # The readers of read_csv, read_json, read_stata and read_sas with chunksize
+        typing = getattr(self.module.api, "typing", None)
+        return (self.module.io.parsers.TextFileReader,) + tuple(
+            getattr(typing, name)
+            for name in ("JsonReader", "StataReader", "SASReader")
+            if hasattr(typing, name)
+        )
+
+    def schema(self, df):
+        # DataFrame.dtypes builds a Series, the block manager has them as an array
+        try:
+            dtypes = df._mgr.get_dtypes()
+        except AttributeError:
+            dtypes = df.dtypes
+        return tuple(df.columns.tolist()), tuple(map(dtype_name, dtypes.tolist()))
+
+    def rows(self, df):
+        return len(df)
+
+    def size(self, df):
+        # DataFrame.memory_usage builds a Series of each column, so the size is summed
+        # over the blocks that hold the columns of each data type
+        try:
+            blocks = df._mgr.blocks
+        except AttributeError:
+            return int(df.memory_usage(deep=False).sum())
+        return int(
+            df.index.memory_usage() + sum(block.values.nbytes for block in blocks)
+        )
+
+    def sample(self, df, n):
+        return df.sample(n=n, random_state=0)
+
+    def statistics(self, df):
+        # Vectorized operations over the whole frame
+        nulls = df.isna().sum()
+        try:
+            distinct = df.nunique()
+        except TypeError:
+            # Unhashable values (e.g. lists) have no distinct count
+            distinct = {}
+            for name in df.columns:
+                try:
+                    distinct[name] = df[name].nunique()
+                except TypeError:
+                    continue
+        # Aggregating by column keeps the data type of each column
+        ordered = df.select_dtypes(include=["number", "datetime", "bool"])
+        bounds = ordered.agg(["min", "max"]) if len(ordered.columns) else {}
+
+        return {
+            str(name): {
+                "dtype": str(dtype),
+                "nulls": int(nulls[name]),
+                "distinct": profile_value(distinct.get(name)),
+                "min": profile_value(bounds[name]["min"] if name in bounds else None),
+                "max": profile_value(bounds[name]["max"] if name in bounds else None),
+            }
+            for name, dtype in df.dtypes.items()
+        }
+
+
+class PolarsAdapter(FrameAdapter):
+    """
+    Adapter of the polars DataFrames
+    """
+
+    library = "polars"
+
+    def types(self):
+        return (self.module.DataFrame,)
+
+    def schema(self, df):
+        return tuple(df.columns), tuple(map(dtype_name, df.dtypes))
+
+    def rows(self, df):
+        return df.height
+
+    def size(self, df):
+        return df.estimated_size()
+
+    def sample(self, df, n):
+        return df.sample(n=n, seed=0)
+
+    def statistics(self, df):
+        # All the statistics are computed in a single query
+        pl = self.module
+        expressions = []
+        for name, dtype in df.schema.items():
+            column = pl.col(name)
+            expressions.append(column.null_count().alias(f"nulls:{name}"))
+            if not dtype.is_nested() and dtype != pl.Object:
+                expressions.append(column.approx_n_unique().alias(f"distinct:{name}"))
+            if (
+                dtype.is_numeric()
+                or dtype.is_temporal()
+                or dtype in (pl.String, pl.Boolean)
+            ):
+                expressions.append(column.min().alias(f"min:{name}"))
+                expressions.append(column.max().alias(f"max:{name}"))
+        values = df.select(expressions).row(0, named=True) if expressions else {}
+
+        return {
+            name: {
+                "dtype": str(dtype),
+                "nulls": values[f"nulls:{name}"],
+                "distinct": values.get(f"distinct:{name}"),
+                "min": profile_value(values.get(f"min:{name}")),
+                "max": profile_value(values.get(f"max:{name}")),
+            }
+            for name, dtype in df.schema.items()
+        }
+
+
+class LazyFrameAdapter(FrameAdapter):
+    """
+    Adapter of the polars LazyFrames. A LazyFrame is logged from its plan, without
+    running it, so it has no number of rows, size or statistics
+    """
+
+    library = "polars"
+
+    def types(self):
+        return (self.module.LazyFrame,)
+
+    def schema(self, df):
+        # Resolve the schema of the plan. Older polars versions only have .schema
+        schema = df.collect_schema() if hasattr(df, "collect_schema") else df.schema
+        return tuple(schema.keys()), tuple(map(str, schema.values()))
+
+
+class ArrowAdapter(FrameAdapter):
+    """
+    Adapter of the pyarrow Tables
+    """
+
+    library = "pyarrow"
+
+    def types(self):
+        return (self.module.Table,)
+
+    def schema(self, df):
+        return tuple(df.column_names), tuple(map(str, df.schema.types))
+
+    def rows(self, df):
+        return df.num_rows
+
+    def size(self, df):
+        return df.nbytes
+
+    def sample(self, df, n):
+        return df.take(sorted(random.Random(0).sample(range(df.num_rows), n)))
+
+    def statistics(self, df):
+        import pyarrow.compute as pc
+
+        types = self.module.types
+        statistics = {}
+        for name, column in zip(df.column_names, df.columns):
+            dtype = column.type
+            ordered = (
+                types.is_integer(dtype)
+                or types.is_floating(dtype)
+                or types.is_decimal(dtype)
+                or types.is_temporal(dtype)
+                or types.is_string(dtype)
+                or types.is_large_string(dtype)
+                or types.is_boolean(dtype)
+            )
+            bounds = pc.min_max(column) if ordered else None
+            statistics[name] = {
+                "dtype": str(dtype),
+                "nulls": column.null_count,
+                "distinct": (
+                    None
+                    if types.is_nested(dtype)
+                    else pc.count_distinct(column).as_py()
+                ),
+                "min": profile_value(bounds["min"].as_py()) if bounds else None,
+                "max": profile_value(bounds["max"].as_py()) if bounds else None,
+            }
+        return statistics
+
+
+class RecordArrayAdapter(FrameAdapter):
+    """
+    Adapter of the numpy record arrays, with a column for each field
+    """
+
+    library = "numpy"
+
+    def types(self):
+        return (self.module.recarray,)
+
+    def schema(self, df):
+        names = df.dtype.names or ()
+        return tuple(names), tuple(str(df.dtype[name]) for name in names)
+
+    def rows(self, df):
+        return len(df)
+
+    def size(self, df):
+        return int(df.nbytes)
+
+    def sample(self, df, n):
+        return df[sorted(random.Random(0).sample(range(len(df)), n))]
+
+    def statistics(self, df):
+        np = self.module
+        statistics = {}
+        for name in df.dtype.names or ():
+            column = np.asarray(df[name])
+            kind = column.dtype.kind
+            # NaN and NaT are the missing values of the numpy types
+            if kind in "fc":
+                valid = column[~np.isnan(column)]
+            elif kind in "mM":
+                valid = column[~np.isnat(column)]
+            else:
+                valid = column
+            bounds = (None, None)
+            if kind in "biufmM" and valid.size:
+                bounds = valid.min(), valid.max()
+            elif kind == "U" and valid.size:
+                # The strings have no minimum and maximum ufuncs, but can be sorted
+                bounds = tuple(np.sort(valid)[[0, -1]])
+            statistics[name] = {
+                "dtype": str(column.dtype),
+                "nulls": int(column.size - valid.size),
+                "distinct": len(np.unique(valid)) if kind not in "OV" else None,
+                "min": profile_value(bounds[0]),
+                "max": profile_value(bounds[1]),
+            }
+        return statistics
+
+
+class AdapterRegistry:
+    """
+    Registry of the frame adapters. The adapters of a library are loaded when it
+    has been imported, and the adapter of each type is looked up once and cached
+    """
+
+    def __init__(self):
+        self.adapters = []
+        self._loaded = set()
+        self._types = {}
+        self._readers = set()
+        self._cache = {}
+        self._reader_cache = {}
+
+    def register(self, adapter):
+        """
+        Register a frame adapter. The adapters registered later take precedence for
+        the same type
+        :param adapter: A FrameAdapter subclass
+        :return: The adapter, so it can be used as a class decorator
+        """
+        self.adapters.append(adapter)
+        self._cache.clear()
+        self._reader_cache.clear()
+        return adapter
+
+    def load(self):
+        """
+        Load the registered adapters whose library has been imported
+        :return: None
+        """
+        for adapter in self.adapters:
+            if adapter not in self._loaded and adapter.library in sys.modules:
+                self._loaded.add(adapter)
+                instance = adapter(sys.modules[adapter.library])
+                for frame_type in instance.types():
+                    self._types[frame_type] = instance
+                self._readers.update(instance.readers())
+
+    def get(self, cls):
+        """
+        Get the adapter of a type. A type of a library that is not imported cannot
+        have instances, so the types without an adapter are cached too
+        :param cls: A type
+        :return: A FrameAdapter, or None if the type is not a DataFrame
+        """
+        try:
+            return self._cache[cls]
+        except KeyError:
+            pass
+
+        self.load()
+        # The closest base class with an adapter handles the subclasses
+        adapter = next(
+            (self._types[base] for base in cls.__mro__ if base in self._types), None
+        )
+        self._cache[cls] = adapter
+        return adapter
+
+    def is_reader(self, cls):
+        """
+        Check if a type is a chunk reader of a registered adapter
+        :param cls: A type
+        :return: A boolean
+        """
+        try:
+            return self._reader_cache[cls]
+        except KeyError:
+            pass
+
+        self.load()
+        is_reader = any(base in self._readers for base in cls.__mro__)
+        self._reader_cache[cls] = is_reader
+        return is_reader
+
+
+FRAME_ADAPTERS = AdapterRegistry()
+for adapter in (
+    PandasAdapter,
+    PolarsAdapter,
+    LazyFrameAdapter,
+    ArrowAdapter,
+    RecordArrayAdapter,
+):
+    FRAME_ADAPTERS.register(adapter)
+
+
+def is_frame(value):
+    """
+    Check if a value is a DataFrame of a registered adapter
+    :param value: Any value
+    :return: A boolean
+    """
+    return FRAME_ADAPTERS.get(type(value)) is not None
+
+
+def frame_schema(df, metrics=False):
+    """
+    Get the schema of a DataFrame
+    :param df: DataFrame to log
+    :param metrics: A boolean to also get the number of rows and the in-memory size
+    :return: A tuple with the columns, the data types, the number of rows and the size
+    """
+    adapter = FRAME_ADAPTERS.get(type(df))
+    if adapter is None:
+        raise TypeError(f"Unsupported DataFrame type: {type(df).__name__}")
+
+    columns, dtypes = adapter.schema(df)
+    if not metrics:
+        return columns, dtypes, None, None
+    return columns, dtypes, adapter.rows(df), adapter.size(df)
+
+
+def measure_frames(frames):
+    """
+    Get the number of rows and the in-memory size of some DataFrames, without their
+    schema or label, for the metrics of the calls that are not recorded
+    :param frames: An iterable with the DataFrames
+    :return: A list with a FrameInfo with only the rows and size of each DataFrame
+    """
+    infos = []
+    for df in frames:
+        adapter = FRAME_ADAPTERS.get(type(df))
+        if adapter is not None:
+            infos.append(
+                FrameInfo(None, (), rows=adapter.rows(df), size=adapter.size(df))
+            )
+    return infos
+
+
+def log_dataframe_info(df, metrics=False, name=None, known=None):
+    """
+    Get a string representation of the DataFrame
+    :param df: DataFrame to log
+    :param metrics: A boolean to also get the number of rows and the in-memory size
+    :param name: A string with the name inferred for the DataFrame, or None
+    :param known: A dictionary with the id() and FrameInfo of the DataFrames already
+        logged in the call, or None
+    :return: A FrameInfo with the DataFrame label, columns and schema
+    """
+    columns, dtypes, rows, size = frame_schema(df, metrics)
+    info = known.get(id(df)) if known else None
+    if info is not None and info.columns == columns and info.dtypes == dtypes:
+        # An input DataFrame returned by the function. Its schema is still read,
+        # since the function may have changed its columns in place
+        return info._replace(rows=rows, size=size, name=name)
+    fingerprint = schema_fingerprint(columns, dtypes)
+    label = FRAME_REGISTRY.label(df, fingerprint)
+    return FrameInfo(label, columns, fingerprint, dtypes, rows, size, name)
+
+
+def log_arguments(args, kwargs, metrics=False, parameters=()):
+    """
+    Log the DataFrames passed as positional or keyword arguments to a function
+    :param args: A tuple with the positional arguments
+    :param kwargs: A dictionary with the keyword arguments
+    :param metrics: A boolean to also get the number of rows and the in-memory size
+    :param parameters: A tuple with the names of the positional parameters, used as
+        the names of the DataFrames
+    :return: A list with the FrameInfo of the DataFrames
+    """
+    names = itertools.chain(parameters, itertools.repeat(None))
+    return [
+        log_dataframe_info(arg, metrics, name)
+        for arg, name in itertools.chain(zip(args, names), zip(kwargs.values(), kwargs))
+        if is_frame(arg)
+    ]
+
+
+def table_names(tables):
+    """
+    Get the table names given to a decorator
+    :param tables: A string or list of strings with the table names
+    :return: A list with the table names
+    """
+    if isinstance(tables, str):
+        return [tables]
+    elif isinstance(tables, (list, tuple)):
+        return list(tables)
+    return []
+
+
+def log_tables(tables, trace=None):
+    """
+    Add the schema of the tables to the trace
+    :param tables: A string or list of strings with the table names
+    :param trace: A TraceStore, by default the global trace
+    :return: A list with the table names
+    """
+    trace = TRACE if trace is None else trace
+
+    return [
+        trace.add_table(table_name, columns)
+        for table in table_names(tables)
+        for table_name, columns in get_table(table).items()
+    ]
+
+
+def log_result(result, metrics=False, targets=None, known=None):
+    """
+    Log the DataFrames returned by a function
+    :param result: The value returned by the function
+    :param metrics: A boolean to also get the number of rows and the in-memory size
+    :param targets: A tuple with the names the result is assigned to, or None
+    :param known: A dictionary with the id() and FrameInfo of the input DataFrames,
+        whose FrameInfo is reused when they are returned, or None
+    :return: A list with the FrameInfo of the DataFrames
+    """
+    targets = targets or ()
+    if is_frame(result):
+        name = targets[0] if len(targets) == 1 else None
+        return [log_dataframe_info(result, metrics, name, known)]
+    elif isinstance(result, (tuple, list)):
+        names = targets if len(targets) == len(result) else itertools.repeat(None)
+        return [
+            log_dataframe_info(item, metrics, name, known)
+            for item, name in zip(result, names)
+            if is_frame(item)
+        ]
+    return []
+
+
+def target_names(target):
+    """
+    Get the names of an assignment target
+    :param target: An ast node with the target
+    :return: A tuple with a name, or None, for each assigned value
+    """
+    if isinstance(target, (ast.Tuple, ast.List)):
+        return tuple(target_names(item)[0] for item in target.elts)
+    elif isinstance(target, ast.Name):
+        return (target.id,)
+    elif isinstance(target, ast.Attribute):
+        return (target.attr,)
+    return (None,)
+
+
+@functools.lru_cache(maxsize=256)
+def assignment_index(filename):
+    """
+    Index the assignments of a source file whose value is a function call
+    :param filename: A string with the path of the source file
+    :return: A dictionary with the line numbers and lists of tuples with the called
+        function name and the assigned names
+    """
+    index = collections.defaultdict(list)
+    try:
+        tree = ast.parse("".join(linecache.getlines(filename)))
+    except (SyntaxError, ValueError):
+        return index
+
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Assign):
+            target = node.targets[0]
+        elif isinstance(node, ast.AnnAssign) and node.value is not None:
+            target = node.target
+        else:
+            continue
+
+        value = node.value.value if isinstance(node.value, ast.Await) else node.value
+        if not isinstance(value, ast.Call):
+            continue
+        function = value.func
+        callee = getattr(function, "id", None) or getattr(function, "attr", None)
+
+        names = target_names(target)
+        for line in range(node.lineno, node.end_lineno + 1):
+            index[line].append((callee, names))
+    return index
+
+
+@functools.lru_cache(maxsize=4096)
+def call_site_targets(filename, line, function_name):
+    """
+    Get the names the result of a call is assigned to, e.g. ("clean", "dirty") for
+    clean, dirty = clean_data(raw). The result is cached per call site
+    :param filename: A string with the path of the source file of the caller
+    :param line: An integer with the line number of the call
+    :param function_name: A string with the name of the called function
+    :return: A tuple with the assigned names, or None if the call is not assigned
+    """
+    for callee, names in assignment_index(filename).get(line, ()):
+        if callee == function_name:
+            return names
+    return None
+
+
+class StreamLog:
+    """
+    Log of the DataFrames yielded by a generator or iterator. Only the FrameInfo of
+    each schema is kept, with the rows and sizes of its chunks summed, so the chunks
+    are not buffered
+    """
+
+    __slots__ = ("metrics", "frames", "chunks")
+
+    def __init__(self, metrics=False):
+        self.metrics = metrics
+        self.frames = {}
+        self.chunks = 0
+
+    def add(self, item):
+        """
+        Log an item of the stream, if it is a DataFrame
+        :param item: The yielded item
+        :return: None
+        """
+        if not is_frame(item):
+            return
+
+        self.chunks += 1
+        columns, dtypes, rows, size = frame_schema(item, self.metrics)
+        fingerprint = schema_fingerprint(columns, dtypes)
+        frame = self.frames.get(fingerprint)
+        if frame is None:
+            label = FRAME_REGISTRY.label(item, fingerprint)
+            self.frames[fingerprint] = FrameInfo(
+                label, columns, fingerprint, dtypes, rows, size
+            )
+        elif self.metrics:
+            self.frames[fingerprint] = frame._replace(
+                rows=(frame.rows or 0) + (rows or 0),
+                size=(frame.size or 0) + (size or 0),
+            )
+
+    def outputs(self):
+        """
+        Get the logged DataFrames
+        :return: A list with a FrameInfo for each schema
+        """
+        return list(self.frames.values())
+
+
+class FrameStream:
+    """
+    Iterator returned in place of a chunk reader (e.g. a pandas reader with
+    chunksize), that logs the chunks as they are consumed. The call is added to the
+    trace when the iterator is exhausted, closed or garbage collected. Other
+    attributes are taken from the wrapped reader, but it is not an instance of the
+    reader type. Only the readers of the frame adapters are wrapped: the other
+    iterators returned by a function (e.g. files or generators) are returned as they
+    are, and their items are not logged
+    """
+
+    def __init__(self, iterator, log, finish):
+        self._iterator = iterator
+        self._log = log
+        self._finish = finish
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            item = next(self._iterator)
+        except BaseException:
+            self._end()
+            raise
+        self._log.add(item)
+        return item
+
+    def get_chunk(self, *args, **kwargs):
+        """
+        Read the next chunk of the reader, and log it
+        :return: A DataFrame
+        """
+        get_chunk = self._iterator.get_chunk
+        try:
+            item = get_chunk(*args, **kwargs)
+        except BaseException:
+            self._end()
+            raise
+        self._log.add(item)
+        return item
+
+    def __getattr__(self, name):
+        return getattr(self._iterator, name)
+
+    def __enter__(self):
+        if hasattr(self._iterator, "__enter__"):
+            self._iterator.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._end()
+        if hasattr(self._iterator, "__exit__"):
+            return self._iterator.__exit__(*exc_info)
+        return None
+
+    def __del__(self):
+        self._end()
+
+    def _end(self):
+        """
+        Add the call to the trace, once
+        :return: None
+        """
+        finish, self._finish = self._finish, None
+        if finish is not None:
+            finish()
+
+    def close(self):
+        """
+        Close the stream and the wrapped iterator
+        :return: None
+        """
+        self._end()
+        close = getattr(self._iterator, "close", None)
+        if close is not None:
+            close()
+
+
+class TraceJournal:
+    """
+    Writer of trace events to a JSON Lines file, one compact line per record. The
+    static information of the functions, tables and DataFrames is written once,
+    before the first call that uses it. The lines of each batch of events are written
+    at once, and the file is synced to disk at most every fsync_interval seconds
+    """
+
+    def __init__(self, path, mode="a", fsync_interval=None):
+        self.path = path
+        self.mode = mode
+        self.fsync_interval = fsync_interval
+        self.file = None
+        self._written = set()
+        self._synced = time.monotonic()
+
+    def _dump(self, kind, **data):
+        """
+        Serialize a line of the journal
+        :param kind: A string with the kind of line
+        :param data: The content of the line
+        :return: A string with the line
+        """
+        return json.dumps({"kind": kind, **data}, separators=(",", ":")) + "\n"
+
+    def _dump_once(self, lines, kind, written_key, **data):
+        """
+        Serialize a line of static information if it was not written before
+        :param lines: A list with the lines to write
+        :param kind: A string with the kind of line
+        :param written_key: A string with the key of the information
+        :param data: The content of the line
+        :return: None
+        """
+        if (kind, written_key) not in self._written:
+            self._written.add((kind, written_key))
+            lines.append(self._dump(kind, **data))
+
+    def write_events(self, events, call_counts):
+        """
+        Write the events of a trace buffer
+        :param events: A list with the events
+        :param call_counts: A Counter with the number of calls of each function
+        :return: None
+        """
+        lines = []
+        for event_type, function_key, *args in events:
+            self._dump_once(
+                lines,
+                "function",
+                function_key,
+                key=function_key,
+                info=FUNCTION_REGISTRY[function_key],
+            )
+
+            if event_type == "call":
+                tables, inputs, outputs, aggregate = args
+                names = []
+                for table in table_names(tables):
+                    for table_name, columns in get_table(table).items():
+                        names.append(table_name)
+                        self._dump_once(
+                            lines, "table", table_name, name=table_name, columns=columns
+                        )
+
+                # A DataFrame is written again when it gets its first name
+                for frame in itertools.chain(inputs, outputs):
+                    if (
+                        frame.fingerprint is not None
+                        and ("frame", (frame.label, True)) not in self._written
+                    ):
+                        self._dump_once(
+                            lines,
+                            "frame",
+                            (frame.label, bool(frame.name)),
+                            label=frame.label,
+                            fingerprint=frame.fingerprint,
+                            dtypes=frame.dtypes,
+                            name=frame.name,
+                        )
+
+                lines.append(
+                    self._dump(
+                        "call",
+                        function=function_key,
+                        db_table=names,
+                        input=[[frame.label, frame.columns] for frame in inputs],
+                        output=[[frame.label, frame.columns] for frame in outputs],
+                        aggregate=aggregate,
+                    )
+                )
+            elif event_type == "metrics":
+                lines.append(self._dump("metrics", function=function_key, values=args))
+            elif event_type == "chunks":
+                lines.append(self._dump("chunks", function=function_key, count=args[0]))
+            elif event_type == "profile":
+                label, profile = args
+                lines.append(self._dump("profile", label=label, profile=profile))
+
+        if call_counts:
+            lines.append(self._dump("counts", counts=call_counts))
+
+        if self.file is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self.file = open(self.path, self.mode)
+        self.file.write("".join(lines))
+        self.file.flush()
+
+        if (
+            self.fsync_interval is not None
+            and time.monotonic() - self._synced >= self.fsync_interval
+        ):
+            self.sync()
+
+    def sync(self):
+        """
+        Sync the journal file to disk
+        :return: None
+        """
+        if self.file is not None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        self._synced = time.monotonic()
+
+    def close(self):
+        """
+        Close the journal file
+        :return: None
+        """
+        if self.file is not None:
+            if self.fsync_interval is not None:
+                self.sync()
+            self.file.close()
+            self.file = None
+
+
+def read_journal(path, trace=None):
+    """
+    Read a journal written by TraceJournal. A partial last line, left by a process
+    that was killed while writing, is ignored
+    :param path: A string with the path of the journal
+    :param trace: A TraceStore to add the records to, by default a new one
+    :return: The TraceStore
+    """
+    trace = TraceStore(functions={}) if trace is None else trace
+    frames = {}
+
+    with open(path) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                break
+
+            kind = entry["kind"]
+            if kind == "function":
+                trace.functions.setdefault(entry["key"], entry["info"])
+            elif kind == "table":
+                trace.add_table(entry["name"], entry["columns"])
+            elif kind == "frame":
+                frame = frames.setdefault(
+                    entry["label"],
+                    {
+                        "fingerprint": entry["fingerprint"],
+                        "dtypes": entry["dtypes"],
+                        "name": None,
+                    },
+                )
+                frame["name"] = frame["name"] or entry.get("name")
+            elif kind == "call":
+                trace.add_call(
+                    entry["function"],
+                    entry["db_table"],
+                    [
+                        FrameInfo(label, columns, **frames.get(label, {}))
+                        for label, columns in entry["input"]
+                    ],
+                    [
+                        FrameInfo(label, columns, **frames.get(label, {}))
+                        for label, columns in entry["output"]
+                    ],
+                    aggregate=entry["aggregate"],
+                )
+            elif kind == "metrics":
+                trace.add_metrics(entry["function"], *entry["values"])
+            elif kind == "chunks":
+                trace.chunk_counts[entry["function"]] += entry["count"]
+            elif kind == "profile":
+                trace.add_profile(entry["label"], entry["profile"])
+            elif kind == "counts":
+                trace.call_counts.update(entry["counts"])
+
+    return trace
+
+
+# Multiprocess collection: each worker process writes its trace to a spool file and
+# the parent process, the only one that writes the documentation, merges them
+MULTIPROCESS = os.environ.get("DOC_ETL_MULTIPROCESS", "").lower() in (
+    "1",
+    "true",
+    "yes",
+    "on",
+)
+PARENT_PID = os.getpid()
+SPOOL_DIR = None
+SPOOL = None
+
+
+def worker_parent():
+    """
+    Get the parent process of a worker started with the spawn or forkserver methods,
+    or of the forkserver, from the DOC_ETL_WORKER_OF environment variable set by
+    enable_multiprocess. The processes started by multiprocessing inherit the
+    authentication key of their parent, so the variable is ignored by the other
+    programs the parent runs
+    :return: A tuple with the process ID and the spool folder of the parent, or None
+    """
+    pid, _, value = os.environ.get("DOC_ETL_WORKER_OF", "").partition(":")
+    key, _, path = value.partition(":")
+    multiprocessing = sys.modules.get("multiprocessing")
+    if not pid.isdigit() or multiprocessing is None:
+        return None
+
+    # The forkserver is started by the parent but does not inherit its key
+    if "multiprocessing.forkserver" in sys.modules and os.getppid() == int(pid):
+        return int(pid), path
+    if key != authkey_digest(multiprocessing.current_process().authkey):
+        return None
+    return int(pid), path
+
+
+def authkey_digest(authkey):
+    """
+    Get a digest of the authentication key of a process, which can be exported
+    without revealing the key
+    :param authkey: A bytes object with the key
+    :return: A string with the digest
+    """
+    return hashlib.blake2b(authkey, digest_size=16).hexdigest()
+
+
+def is_worker():
+    """
+    Check if the current process is a worker of the process that runs the pipeline
+    :return: A boolean
+    """
+    if os.getpid() != PARENT_PID:
+        return True
+
+    # Spawned multiprocessing workers import the module again
+    multiprocessing = sys.modules.get("multiprocessing")
+    return multiprocessing is not None and multiprocessing.parent_process() is not None
+
+
+def get_spool_dir():
+    """
+    Get the folder of the spool files of the workers
+    :return: A string with the absolute path of the folder
+    """
+    return (
+        SPOOL_DIR
+        or os.environ.get("DOC_ETL_SPOOL_DIR")
+        or os.path.abspath(os.path.join("doc_etl", "spool", str(PARENT_PID)))
+    )
+
+
+def enable_multiprocess(path=None):
+    """
+    Enable the multiprocess collection. It must be called in the parent process
+    before starting the workers, so spawned workers inherit the configuration
+    :param path: A string with the folder of the spool files
+    :return: None
+    """
+    import multiprocessing
+
+    global MULTIPROCESS, SPOOL_DIR
+    MULTIPROCESS = True
+    SPOOL_DIR = os.path.abspath(path or get_spool_dir())
+    authkey = authkey_digest(multiprocessing.current_process().authkey)
+    os.environ["DOC_ETL_WORKER_OF"] = f"{PARENT_PID}:{authkey}:{SPOOL_DIR}"
+    for frame_type in FRAME_REGISTRY.types:
+        share_labels(frame_type)
+    register_worker_finalizer(after_fork_only=True)
+
+
+def share_labels(frame_type):
+    """
+    Send the labels with the DataFrames of a type that multiprocessing pickles to and
+    from the workers, so both processes log a DataFrame with the same label. The
+    DataFrames pickled by other means are not affected
+    :param frame_type: A DataFrame type
+    :return: None
+    """
+    from multiprocessing.reduction import ForkingPickler
+
+    ForkingPickler.register(frame_type, reduce_frame)
+
+
+def reduce_frame(df):
+    """
+    Reduce a DataFrame for pickling, adding its label
+    :param df: A DataFrame
+    :return: A tuple with the function that restores the DataFrame and its arguments
+    """
+    reduced = df.__reduce_ex__(pickle.DEFAULT_PROTOCOL)
+    label = FRAME_REGISTRY.find(df)
+    if label is None or any(item is not None for item in reduced[3:]):
+        return reduced
+    return restore_frame, (label, *reduced[:3])
+
+
+def restore_frame(label, function, args, state=None):
+    """
+    Restore a DataFrame reduced by reduce_frame, with its label
+    :param label: A string with the label of the DataFrame in the sending process
+    :param function: The function that creates the DataFrame
+    :param args: A tuple with the arguments of the function
+    :param state: The state of the DataFrame, or None
+    :return: The DataFrame
+    """
+    df = function(*args)
+    if state is not None:
+        if hasattr(df, "__setstate__"):
+            df.__setstate__(state)
+        else:
+            df.__dict__.update(state)
+    FRAME_REGISTRY.adopt(df, label)
+    return df
+
+
+def register_worker_finalizer(after_fork_only=False):
+    """
+    Flush the trace of a worker when it exits, as the multiprocessing workers exit
+    without running the atexit hooks. The workers drop the finalizers when they
+    start, so they are registered again after the fork
+    :param after_fork_only: A boolean to only register them in the forked workers
+    :return: None
+    """
+    from multiprocessing import util
+
+    if not after_fork_only:
+        util.Finalize(None, flush, exitpriority=0)
+    util.register_after_fork(
+        FRAME_REGISTRY, lambda _: util.Finalize(None, flush, exitpriority=0)
+    )
+
+
+def init_worker():
+    """
+    Prepare the trace of a worker process: drop the records inherited from the
+    parent, use labels that are unique across processes and open the spool file
+    :return: None
+    """
+    global TRACE, TRACE_LOCK, SPOOL, JOURNAL
+    TRACE = TraceStore()
+    TRACE_LOCK = threading.Lock()
+    for buffer in BUFFERS:
+        buffer.events.clear()
+        buffer.call_counts.clear()
+    FRAME_REGISTRY.prefix = f"DataFrame_{os.getpid()}_"
+
+    # The journal of the parent is not written by the workers
+    JOURNAL = None
+    SPOOL = None
+    if MULTIPROCESS:
+        SPOOL = TraceJournal(os.path.join(get_spool_dir(), f"{os.getpid()}.jsonl"))
+        register_worker_finalizer()
+        # The pool workers can be terminated without running the finalizers, e.g. at
+        # the end of a with Pool() block, so each call is written to the spool
+        TraceBuffer.flush_size = 1
+
+
+def merge_spools(trace=None, path=None):
+    """
+    Merge the spool files of the workers into the trace and remove them
+    :param trace: A TraceStore, by default the global trace
+    :param path: A string with the folder of the spool files
+    :return: The TraceStore
+    """
+    trace = TRACE if trace is None else trace
+    path = get_spool_dir() if path is None else path
+    if not os.path.isdir(path):
+        return trace
+
+    with TRACE_LOCK:
+        for name in sorted(os.listdir(path)):
+            if name.endswith(".jsonl"):
+                read_journal(os.path.join(path, name), trace)
+                os.remove(os.path.join(path, name))
+
+    try:
+        os.rmdir(path)
+        os.rmdir(os.path.dirname(path))
+    except OSError:
+        pass
+    return trace
+
+
+# Journal mode: the calls are appended to a journal while the pipeline runs instead
+# of being kept in memory until the end
+JOURNAL = None
+
+
+def enable_journal(path="doc_etl/journal.jsonl", fsync_interval=5.0, flush_size=128):
+    """
+    Enable the journal mode. The journal of the previous run is overwritten
+    :param path: A string with the path of the journal
+    :param fsync_interval: A float with the seconds between syncs to disk
+    :param flush_size: An integer with the calls buffered before writing them
+    :return: None
+    """
+    global JOURNAL
+    TraceBuffer.flush_size = flush_size
+    JOURNAL = TraceJournal(path, mode="w", fsync_interval=fsync_interval)
+
+
+# Switch of the tracing. When it is disabled with the DOC_ETL_DISABLED environment
+# variable, or with disable() before the pipeline modules are imported, the decorators
+# return the functions unchanged and no documentation is written at exit
+ENABLED = os.environ.get("DOC_ETL_DISABLED", "").lower() not in (
+    "1",
+    "true",
+    "yes",
+    "on",
+)
+
+
+def disable():
+    """
+    Disable the tracing. Only the functions decorated afterwards are left unwrapped
+    :return: None
+    """
+    global ENABLED
+    ENABLED = False
+    atexit.unregister(write)
+
+
+def enable():
+    """
+    Enable the tracing, and the writing of the documentation at exit
+    :return: None
+    """
+    global ENABLED
+    ENABLED = True
+    atexit.unregister(write)
+    atexit.register(write)
+    init_process()
+
+
+# Whether the tracing of the process has been prepared by init_process
+INITIALIZED = False
+
+
+def init_process():
+    """
+    Prepare the tracing of the process, once: find the parent of a worker process and
+    prepare its trace, or start the multiprocess collection and the journal of the
+    process that runs the pipeline. It is not run when the tracing is disabled at
+    import, so the disabled mode does not inspect the process nor hook the forks
+    :return: None
+    """
+    global INITIALIZED, PARENT_PID, SPOOL_DIR, MULTIPROCESS
+    if INITIALIZED:
+        return
+    INITIALIZED = True
+
+    parent = worker_parent()
+    if parent is not None:
+        PARENT_PID, SPOOL_DIR = parent
+        MULTIPROCESS = True
+
+    if is_worker():
+        init_worker()
+    else:
+        if MULTIPROCESS:
+            enable_multiprocess()
+
+        journal = os.environ.get("DOC_ETL_JOURNAL", "")
+        if journal.lower() in ("1", "true", "yes", "on"):
+            enable_journal()
+        elif journal and journal.lower() not in ("0", "false", "no", "off"):
+            enable_journal(journal)
+    os.register_at_fork(after_in_child=init_worker)
+
+
+if ENABLED:
+    init_process()
+
+
+class CapturePolicy:
+    """
+    Policy that decides which calls of a decorated function are recorded. The
+    available modes are:
+    - "all": Record every call
+    - "first:N": Record the first N calls
+    - "sample:P": Record each call with probability P
+    - "aggregate": Record every call, collapsing the calls with the same input and
+      output schemas into a single record with a count
+    - "once": Record the first call, and then replace the wrapper with the plain
+      function, so the next calls have no overhead
+    """
+
+    def __init__(self, mode="all", limit=None, probability=None):
+        if mode not in ("all", "first", "sample", "aggregate", "once"):
+            raise ValueError(f"Unsupported capture mode: {mode}")
+        self.mode = mode
+        self.limit = limit
+        self.probability = probability
+        self.aggregate = mode == "aggregate"
+        # The sampling does not use or change the random state of the pipeline
+        self._random = random.Random()
+
+    def __repr__(self):
+        return f"CapturePolicy({self.mode!r}, {self.limit!r}, {self.probability!r})"
+
+    @classmethod
+    def parse(cls, capture=None):
+        """
+        Get the capture policy from its string representation
+        :param capture: A CapturePolicy, a string with the policy or None to use
+            the DOC_ETL_CAPTURE environment variable
+        :return: A CapturePolicy
+        """
+        if isinstance(capture, cls):
+            return capture
+        if capture is None:
+            capture = os.environ.get("DOC_ETL_CAPTURE", "all")
+
+        mode, _, value = capture.strip().lower().partition(":")
+        if mode == "first":
+            return cls(mode, limit=int(value))
+        elif mode == "sample":
+            return cls(mode, probability=float(value))
+        return cls(mode)
+
+    def should_record(self, call_number):
+        """
+        Check if a call must be recorded
+        :param call_number: An integer with the number of the call, starting at 1
+        :return: A boolean
+        """
+        if self.mode == "first":
+            return call_number <= self.limit
+        elif self.mode == "once":
+            return call_number == 1
+        elif self.mode == "sample":
+            return self._random.random() < self.probability
+        return True
+
+
+def parse_metrics(metrics=None):
+    """
+    Get the runtime metrics option of the decorators
+    :param metrics: A boolean, "memory" to also measure the peak allocations, or
+        None to use the DOC_ETL_METRICS environment variable
+    :return: A tuple with two booleans: metrics enabled and memory enabled
+    """
+    if metrics is None:
+        metrics = os.environ.get("DOC_ETL_METRICS", "")
+    if isinstance(metrics, str):
+        metrics = metrics.strip().lower()
+        if metrics == "memory":
+            return True, True
+        return metrics in ("1", "true", "yes", "on"), False
+    return bool(metrics), False
+
+
+def parse_profile(profile=None):
+    """
+    Get the profiling option of the decorators
+    :param profile: A boolean, or None to use the DOC_ETL_PROFILE environment variable
+    :return: A boolean
+    """
+    if profile is None:
+        profile = os.environ.get("DOC_ETL_PROFILE", "")
+    if isinstance(profile, str):
+        return profile.strip().lower() in ("1", "true", "yes", "on")
+    return bool(profile)
+
+
+def profile_value(value):
+    """
+    Convert a statistic to a value that can be serialized to JSON
+    :param value: A Python, numpy or pandas scalar
+    :return: A boolean, number, string or None
+    """
+    if value is None or isinstance(value, (bool, int)):
+        return value
+    if isinstance(value, str):
+        # numpy strings are a subclass of str
+        return str(value)
+    if isinstance(value, float):
+        return None if value != value else float(value)
+    if hasattr(value, "item"):
+        return profile_value(value.item())
+    try:
+        if value != value:
+            # NaT, and other missing values that are not equal to themselves
+            return None
+    except TypeError:
+        # pandas.NA has no truth value
+        return None
+    return str(value)
+
+
+def profile_frame(df, sample_rows=None):
+    """
+    Profile a DataFrame: number of rows, and data type, null count, distinct count
+    estimate, minimum and maximum of each column. Frames with more rows than
+    sample_rows are profiled on a random sample. LazyFrames are not profiled, since
+    it would run their plan
+    :param df: A DataFrame
+    :param sample_rows: An integer with the maximum number of rows to profile, or None
+    :return: A dictionary with the profile, or None
+    """
+    adapter = FRAME_ADAPTERS.get(type(df))
+    rows = adapter.rows(df) if adapter is not None else None
+    if rows is None:
+        return None
+    if sample_rows is not None and rows > sample_rows:
+        df = adapter.sample(df, sample_rows)
+    columns = adapter.statistics(df)
+    if columns is None:
+        return None
+
+    return {"rows": rows, "profiled_rows": adapter.rows(df), "columns": columns}
+
+
+class Profiler:
+    """
+    Profiler of the DataFrames of a decorated function. The profiling of each call
+    has a time budget: the sample size is adapted to the time per row measured in
+    the previous profiles, and the DataFrames left when the budget is spent are not
+    profiled. Each DataFrame label is profiled once
+    """
+
+    # Maximum number of rows profiled of a DataFrame
+    sample_rows = 100_000
+
+    def __init__(self, budget=None):
+        if budget is None:
+            budget = float(os.environ.get("DOC_ETL_PROFILE_BUDGET") or 0.05)
+        self.budget = budget
+        self.seconds_per_row = 0.0
+
+    def deadline(self):
+        """
+        Get the deadline of the profiling of a call that starts now
+        :return: A float with the time, as in time.perf_counter
+        """
+        return time.perf_counter() + self.budget
+
+    def profile(self, buffer, function_key, frames, infos, deadline):
+        """
+        Profile the DataFrames of a call and add the profiles to a buffer
+        :param buffer: A TraceBuffer
+        :param function_key: A string with the key of the function in the registry
+        :param frames: A list with the DataFrames
+        :param infos: A list with the FrameInfo of the DataFrames
+        :param deadline: A float with the deadline of the profiling of the call
+        :return: None
+        """
+        for df, info in zip(frames, infos):
+            if info.label in PROFILED_LABELS:
+                continue
+            start = time.perf_counter()
+            remaining = deadline - start
+            if remaining <= 0:
+                return
+
+            sample_rows = self.sample_rows
+            if self.seconds_per_row:
+                sample_rows = max(
+                    1, min(sample_rows, int(remaining / self.seconds_per_row))
+                )
+            profile = profile_frame(df, sample_rows)
+            if profile is None:
+                continue
+
+            PROFILED_LABELS.add(info.label)
+            self.seconds_per_row = (time.perf_counter() - start) / max(
+                profile["profiled_rows"], 1
+            )
+            buffer.add("profile", function_key, info.label, profile)
+
+
+# Labels of the DataFrames that were already profiled in this process
+PROFILED_LABELS = set()
+
+
+def frame_values(values):
+    """
+    Get the DataFrames of a result or of the arguments of a function, in the order
+    they are logged
+    :param values: The value returned by a function, or an iterable with arguments
+    :return: A list with the DataFrames
+    """
+    if is_frame(values):
+        return [values]
+    return [value for value in values if is_frame(value)]
+
+
+def trace_function(
+    func, func_type, tables=None, capture=None, metrics=None, profile=None
+):
+    """
+    Wrap a function to log its calls in the trace. Coroutine functions and async
+    generators get native async wrappers
+    :param func: The function to wrap
+    :param func_type: A string with the function type (extract, transform or insert)
+    :param tables: A string or list of strings with the table names
+    :param capture: A CapturePolicy or a string with the capture policy
+    :param metrics: A boolean or "memory" to record the runtime metrics
+    :param profile: A boolean to profile the input and output DataFrames
+    :return: The wrapped function, or the function itself if the tracing is disabled
+    """
+    if not ENABLED:
+        return func
+
+    function_key = register_function(func, func_type)
+    policy = CapturePolicy.parse(capture)
+    metrics, memory = parse_metrics(metrics)
+    profiler = Profiler() if parse_profile(profile) else None
+    call_numbers = itertools.count(1)
+    released = False
+
+    # The names of the positional parameters name the input DataFrames
+    try:
+        parameters = tuple(
+            name
+            for name, parameter in inspect.signature(func).parameters.items()
+            if parameter.kind
+            in (parameter.POSITIONAL_ONLY, parameter.POSITIONAL_OR_KEYWORD)
+        )
+    except (TypeError, ValueError):
+        parameters = ()
+
+    def start_call(args, kwargs):
+        """
+        Count the call, log the input DataFrames and find the names the result is
+        assigned to at the call site
+        :return: A tuple with the state of the call, or None if it is not recorded
+        """
+        if released:
+            return None
+
+        buffer = get_buffer()
+        buffer.call_counts[function_key] += 1
+        record = policy.should_record(next(call_numbers))
+        if not record and not metrics:
+            return None
+
+        # Log the input DataFrames. The extract functions read from the tables, and
+        # the DataFrames of the calls that are not recorded are only measured
+        inputs = frames = []
+        if func_type != "extract":
+            frames = frame_values(itertools.chain(args, kwargs.values()))
+            if record:
+                inputs = log_arguments(args, kwargs, metrics, parameters)
+            else:
+                inputs = measure_frames(frames)
+        # The arguments are alive until the call ends, so their id() are not reused
+        known = dict(zip(map(id, frames), inputs)) if record else None
+
+        # The profiling is not included in the metrics of the call
+        deadline = None
+        if record and profiler is not None:
+            deadline = profiler.deadline()
+            profiler.profile(buffer, function_key, frames, inputs, deadline)
+
+        # The caller is two frames up: start_call and the wrapper
+        targets = None
+        if record and func_type != "insert":
+            caller = sys._getframe(2)
+            targets = call_site_targets(
+                caller.f_code.co_filename, caller.f_lineno, func.__name__
+            )
+
+        memory_start = None
+        if memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+            memory_start = tracemalloc.get_traced_memory()[0]
+        return (
+            buffer,
+            record,
+            inputs,
+            known,
+            targets,
+            deadline,
+            memory_start,
+            time.perf_counter(),
+            time.process_time(),
+        )
+
+    def end_call(call, result=None, stream=None):
+        """
+        Log the tables, the returned DataFrames and the metrics of the call. The
+        DataFrames of a generator or iterator are taken from its StreamLog
+        :return: None
+        """
+        buffer, record, inputs, known, targets, deadline, memory_start, *start = call
+        wall_start, cpu_start = start
+        wall, cpu = time.perf_counter() - wall_start, time.process_time() - cpu_start
+        peak_memory = None
+        if memory:
+            peak_memory = tracemalloc.get_traced_memory()[1] - memory_start
+
+        # The insert functions write to the tables
+        outputs = []
+        if record:
+            if func_type != "insert":
+                if stream is None:
+                    outputs = log_result(result, metrics, targets, known)
+                    if profiler is not None and (
+                        isinstance(result, (tuple, list)) or is_frame(result)
+                    ):
+                        frames = frame_values(result)
+                        profiler.profile(
+                            buffer, function_key, frames, outputs, deadline
+                        )
+                else:
+                    outputs = stream.outputs()
+                    buffer.add("chunks", function_key, stream.chunks)
+            buffer.add("call", function_key, tables, inputs, outputs, policy.aggregate)
+            if policy.mode == "once":
+                release()
+        elif func_type != "insert":
+            if stream is not None:
+                outputs = stream.outputs()
+            elif isinstance(result, (tuple, list)) or is_frame(result):
+                outputs = measure_frames(frame_values(result))
+
+        if metrics:
+            buffer.add(
+                "metrics",
+                function_key,
+                wall,
+                cpu,
+                sum(frame.rows or 0 for frame in inputs),
+                sum(frame.rows or 0 for frame in outputs),
+                sum(frame.size or 0 for frame in inputs),
+                sum(frame.size or 0 for frame in outputs),
+                peak_memory,
+            )
+
+    def release():
+        """
+        Stop tracing the function, replacing the wrapper with the plain function in
+        the module or class where it is defined. The wrapper is only a pass-through
+        when it is bound somewhere else (e.g. a local function)
+        :return: None
+        """
+        nonlocal released
+        released = True
+
+        namespace = sys.modules.get(func.__module__)
+        *path, name = func.__qualname__.split(".")
+        for part in path:
+            namespace = getattr(namespace, part, None)
+        if getattr(namespace, "__dict__", {}).get(name) is wrapper:
+            setattr(namespace, name, func)
+
+    if inspect.isasyncgenfunction(func):
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            call = start_call(args, kwargs)
+            if call is None:
+                async for item in func(*args, **kwargs):
+                    yield item
+                return
+
+            # Log one yielded DataFrame per schema, also when the consumer stops
+            # the generator early
+            stream = StreamLog(metrics)
+            try:
+                async for item in func(*args, **kwargs):
+                    stream.add(item)
+                    yield item
+            finally:
+                end_call(call, stream=stream)
+
+    elif inspect.isgeneratorfunction(func):
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            call = start_call(args, kwargs)
+            if call is None:
+                return (yield from func(*args, **kwargs))
+
+            stream = StreamLog(metrics)
+            try:
+                for item in func(*args, **kwargs):
+                    stream.add(item)
+                    yield item
+            finally:
+                end_call(call, stream=stream)
+
+    elif inspect.iscoroutinefunction(func):
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            call = start_call(args, kwargs)
+            if call is None:
+                return await func(*args, **kwargs)
+
+            result = await func(*args, **kwargs)
+            end_call(call, result)
+            return result
+
+    else:
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            call = start_call(args, kwargs)
+            if call is None:
+                return func(*args, **kwargs)
+
+            result = func(*args, **kwargs)
+
+            # Log the chunks of a returned reader as they are consumed
+            if func_type != "insert" and FRAME_ADAPTERS.is_reader(type(result)):
+                stream = StreamLog(metrics)
+                return FrameStream(
+                    result, stream, lambda: end_call(call, stream=stream)
+                )
+
+            end_call(call, result)
+            return result
+
+    return wrapper
+
+
+def extract(extract_table, capture=None, metrics=None, profile=None):
+    """
+    Decorator to log information about the function
+    :param extract_table: A string or list of strings with the table names
+    :param capture: A CapturePolicy or a string with the capture policy
+    :param metrics: A boolean or "memory" to record the runtime metrics
+    :param profile: A boolean to profile the DataFrames
+    :return: Decorator
+    """
+
+    def decorator(func):
+        return trace_function(func, "extract", extract_table, capture, metrics, profile)
+
+    return decorator
+
+
+def transform(capture=None, metrics=None, profile=None):
+    """
+    Decorator to log information about the function
+    :param capture: A CapturePolicy or a string with the capture policy
+    :param metrics: A boolean or "memory" to record the runtime metrics
+    :param profile: A boolean to profile the DataFrames
+    :return: Decorator
+    """
+
+    def decorator(func):
+        return trace_function(func, "transform", None, capture, metrics, profile)
+
+    return decorator
+
+
+def insert(insert_table, capture=None, metrics=None, profile=None):
+    """
+    Decorator to log information about the function
+    :param insert_table: A string or list of strings with the table names
+    :param capture: A CapturePolicy or a string with the capture policy
+    :param metrics: A boolean or "memory" to record the runtime metrics
+    :param profile: A boolean to profile the DataFrames
+    :return: Decorator
+    """
+
+    def decorator(func):
+        return trace_function(func, "insert", insert_table, capture, metrics, profile)
+
+    return decorator
+
+
+def write_json(trace, path="doc_etl/raw.json"):
+    """
+    Write the trace to a JSON file, with its column-level lineage
+    :param trace: A TraceStore with the information
+    :param path: A string with the path to save the file
+    :return: None
+    """
+    data = trace.to_dict()
+    data["column_lineage"] = column_lineage(trace)
+    with open(path, "w") as f:
+        json.dump(data, f, indent=4)
+
+
+def content_hash(*parts):
+    """
+    Get the hash of the content of a list of JSON serializable values
+    :param parts: The values to hash
+    :return: A string with the hash
+    """
+    content = json.dumps(parts, sort_keys=True, default=str, separators=(",", ":"))
+    return hashlib.blake2b(content.encode(), digest_size=16).hexdigest()
+
+
+def trace_digest(trace):
+    """
+    Get the hash of the content of a trace
+    :param trace: A TraceStore with the information
+    :return: A string with the hash
+    """
+    return content_hash(trace.to_dict())
+
+
+def record_digest(trace, record):
+    """
+    Get the hash of the content that is documented for a record. The record ID is
+    not hashed, since it is the position of the record in the trace and a new call
+    would change the hash of all the records after it
+    :param trace: A TraceStore with the information
+    :param record: A CallRecord
+    :return: A string with the hash
+    """
+    function_info = trace.function(record)
+    return content_hash(
+        [function_info[key] for key in ("name", "type", "docstring", "code_hash")],
+        trace.calls(record),
+        trace.chunk_counts.get(record.function),
+        record.count,
+        [(table_name, trace.tables[table_name]) for table_name in record.db_table],
+        record.input,
+        record.output,
+        [
+            trace.profiles.get(label)
+            for label, _ in itertools.chain(record.input, record.output)
+        ],
+    )
+
+
+class DocCache:
+    """
+    Cache of the documentation of the previous run, stored next to the documentation.
+    It keeps the digest of the trace and the fragments of the files, so an unchanged
+    trace is not written again and only the sections of the changed records are
+    generated
+    """
+
+    def __init__(self, path="doc_etl/cache.json"):
+        self.path = path
+        self.digest = None
+        self.fragments = {}
+        self._used = set()
+
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            # No cache yet, or a cache from an interrupted run
+            return
+
+        self.digest = data.get("digest")
+        self.fragments = data.get("fragments", {})
+
+    def fragment(self, key, build):
+        """
+        Get a cached fragment, building it if the key is not in the cache
+        :param key: A JSON serializable value that identifies the content
+        :param build: A function that returns the fragment
+        :return: A string with the fragment
+        """
+        key = content_hash(key)
+        self._used.add(key)
+        if key not in self.fragments:
+            self.fragments[key] = build()
+        return self.fragments[key]
+
+    def save(self, digest):
+        """
+        Save the cache, dropping the fragments that were not used in this run
+        :param digest: A string with the digest of the documented trace
+        :return: None
+        """
+        self.digest = digest
+        self.fragments = {
+            key: value for key, value in self.fragments.items() if key in self._used
+        }
+        with open(self.path, "w") as f:
+            json.dump({"digest": digest, "fragments": self.fragments}, f)
+
+
+def cached(cache, key, build):
+    """
+    Get a fragment from a cache, or build it when there is no cache
+    :param cache: A DocCache, or None
+    :param key: A JSON serializable value that identifies the content
+    :param build: A function that returns the fragment
+    :return: A string with the fragment
+    """
+    if cache is None:
+        return build()
+    return cache.fragment(key, build)
+
+
+# Extensions of the columnar export formats
+COLUMNAR_FORMATS = {"parquet": ".parquet", "ipc": ".arrow"}
+
+# Keys of the StageMetrics summaries, stored as columns of the functions table
+METRIC_KEYS = tuple(StageMetrics().summary())
+
+
+def get_columnar_format():
+    """
+    Get the format of the columnar export of the trace, from the DOC_ETL_COLUMNAR
+    environment variable
+    :return: A string with the format, "parquet" or "ipc", or None to not export it
+    """
+    format = os.environ.get("DOC_ETL_COLUMNAR", "").lower()
+    if format in ("1", "true", "yes"):
+        return "parquet"
+    if format not in COLUMNAR_FORMATS:
+        if format not in ("", "0", "false", "no"):
+            warnings.warn(f"Unknown columnar format {format!r}, it is not exported")
+        return None
+    return format
+
+
+def write_columnar(trace, path="doc_etl/trace", format="parquet"):
+    """
+    Write the trace as normalized tables, with the repeated strings dictionary-encoded:
+    - functions: the function information, call and chunk counts and metrics
+    - calls: the records, with their function and count
+    - tables: the columns of the database tables
+    - frames: the fingerprint, data types, name and profile of the DataFrames
+    - edges: the tables and DataFrames of each record
+    - schemas: the lists of columns and data types, referenced by ID from the edges
+      and frames, since many DataFrames share them
+    :param trace: A TraceStore with the information
+    :param path: A string with the path of the folder to save the tables
+    :param format: A string with the file format, "parquet" or "ipc" (Arrow)
+    :return: None
+    """
+    import polars as pl
+
+    extension = COLUMNAR_FORMATS[format]
+    os.makedirs(path, exist_ok=True)
+    category = pl.Categorical
+
+    records = (record.function for _, record in trace.items())
+    keys = list(
+        dict.fromkeys(itertools.chain(records, trace.call_counts, trace.metrics))
+    )
+    functions = {
+        "key": keys,
+        "calls": [trace.call_counts.get(key, 0) for key in keys],
+        "chunks": [trace.chunk_counts.get(key, 0) for key in keys],
+    }
+    fields = ("name", "type", "docstring", "code", "file", "first_line", "last_line")
+    for field in fields + ("code_hash",):
+        functions[field] = [trace.functions.get(key, {}).get(field) for key in keys]
+    summaries = [
+        trace.metrics[key].summary() if key in trace.metrics else {} for key in keys
+    ]
+    for field in METRIC_KEYS:
+        functions[f"metrics_{field}"] = [summary.get(field) for summary in summaries]
+
+    schema_ids = {}
+
+    def schema_id(columns):
+        """
+        Get the ID of a list of columns or data types
+        :param columns: A tuple with the columns
+        :return: An integer with the ID
+        """
+        return schema_ids.setdefault(columns, len(schema_ids))
+
+    calls = {"call": [], "function": [], "count": []}
+    edges = {"call": [], "kind": [], "position": [], "node": [], "schema": []}
+    for call, (_, record) in enumerate(trace.items()):
+        calls["call"].append(call)
+        calls["function"].append(record.function)
+        calls["count"].append(record.count)
+
+        nodes = itertools.chain(
+            (("db_table", table_name, None) for table_name in record.db_table),
+            (("input", label, columns) for label, columns in record.input),
+            (("output", label, columns) for label, columns in record.output),
+        )
+        positions = collections.Counter()
+        for kind, node, columns in nodes:
+            edges["call"].append(call)
+            edges["kind"].append(kind)
+            edges["position"].append(positions[kind])
+            edges["node"].append(node)
+            edges["schema"].append(None if columns is None else schema_id(columns))
+            positions[kind] += 1
+
+    # The tables and schemas without columns are written as a row with a null
+    # position and column, so they are not lost
+    tables = {"table": [], "position": [], "column": []}
+    for table_name, columns in trace.tables.items():
+        tables["table"] += [table_name] * max(len(columns), 1)
+        tables["position"] += range(len(columns)) if columns else [None]
+        tables["column"] += columns if columns else [None]
+
+    labels = list(dict.fromkeys(itertools.chain(trace.frames, trace.profiles)))
+    frames = {
+        "label": labels,
+        "fingerprint": [trace.frames.get(label, (None, ()))[0] for label in labels],
+        "dtypes": [
+            schema_id(trace.frames.get(label, (None, ()))[1]) for label in labels
+        ],
+        "name": [trace.names.get(label) for label in labels],
+        "profile": [
+            json.dumps(trace.profiles[label]) if label in trace.profiles else None
+            for label in labels
+        ],
+    }
+
+    schemas = {"schema": [], "position": [], "column": []}
+    for columns, schema in schema_ids.items():
+        schemas["schema"] += [schema] * max(len(columns), 1)
+        schemas["position"] += range(len(columns)) if columns else [None]
+        schemas["column"] += columns if columns else [None]
+
+    dtypes = {
+        "functions": {"key": category, "name": category, "type": category},
+        "calls": {"call": pl.UInt32, "function": category, "count": pl.UInt64},
+        "edges": {
+            "call": pl.UInt32,
+            "kind": category,
+            "position": pl.UInt32,
+            "node": category,
+            "schema": pl.UInt32,
+        },
+        "tables": {"table": category, "position": pl.UInt32, "column": category},
+        "frames": {"label": category, "fingerprint": category, "dtypes": pl.UInt32},
+        "schemas": {"schema": pl.UInt32, "position": pl.UInt32, "column": category},
+    }
+    data = {
+        "functions": functions,
+        "calls": calls,
+        "edges": edges,
+        "tables": tables,
+        "frames": frames,
+        "schemas": schemas,
+    }
+    for table, columns in data.items():
+        df = pl.DataFrame(columns, schema_overrides=dtypes[table], strict=False)
+        file_path = os.path.join(path, table + extension)
+        if format == "parquet":
+            df.write_parquet(file_path)
+        else:
+            df.write_ipc(file_path)
+
+
+# Columns of the frames table, in the order they are read
+FRAME_COLUMNS = ("label", "fingerprint", "dtypes", "name", "profile")
+
+
+def read_columnar(path="doc_etl/trace"):
+    """
+    Read the tables written by write_columnar, to write the documentation again
+    :param path: A string with the path of the folder with the tables
+    :return: A TraceStore
+    """
+    import polars as pl
+
+    data = {}
+    for table in ("functions", "calls", "edges", "tables", "frames", "schemas"):
+        for format, extension in COLUMNAR_FORMATS.items():
+            file_path = os.path.join(path, table + extension)
+            if os.path.exists(file_path):
+                if format == "parquet":
+                    data[table] = pl.read_parquet(file_path)
+                else:
+                    data[table] = pl.read_ipc(file_path)
+                break
+        else:
+            raise FileNotFoundError(f"Missing {table} table in {path}")
+
+    trace = TraceStore(functions={})
+    fields = ("name", "type", "docstring", "code", "file", "first_line", "last_line")
+    for row in data["functions"].iter_rows(named=True):
+        key = row["key"]
+        if row["name"] is not None:
+            trace.functions[key] = {field: row[field] for field in fields}
+            trace.functions[key]["code_hash"] = row["code_hash"]
+        if row["calls"]:
+            trace.call_counts[key] = row["calls"]
+        if row["chunks"]:
+            trace.chunk_counts[key] = row["chunks"]
+        if row["metrics_calls"] is not None:
+            summary = {field: row[f"metrics_{field}"] for field in METRIC_KEYS}
+            trace.metrics[key] = StageMetrics.from_summary(summary)
+
+    tables = data["tables"].sort("table", "position", maintain_order=True)
+    for (table_name,), group in tables.group_by("table", maintain_order=True):
+        trace.add_table(table_name, group["column"].drop_nulls().to_list())
+
+    schemas = data["schemas"].sort("schema", "position")
+    schemas = schemas.group_by("schema", maintain_order=True).agg(
+        pl.col("column").drop_nulls()
+    )
+    schemas = {
+        schema: trace.intern_columns(columns)
+        for schema, columns in zip(*(column.to_list() for column in schemas))
+    }
+
+    # The frames are added once here, so the edges only carry the labels and columns
+    for label, fingerprint, dtypes, name, profile in zip(
+        *(data["frames"][column].to_list() for column in FRAME_COLUMNS)
+    ):
+        if fingerprint is not None:
+            trace.add_frame(label, fingerprint, schemas.get(dtypes, ()), name)
+        if profile is not None:
+            trace.add_profile(label, json.loads(profile))
+
+    # The edges are written grouped by call and in order. The records are built
+    # without the cyclic garbage collector, which otherwise scans the growing trace
+    # again and again while nothing can be collected
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return read_edges(trace, data, schemas)
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def read_edges(trace, data, schemas):
+    """
+    Add the records of the edges and calls tables to a trace
+    :param trace: A TraceStore
+    :param data: A dictionary with the tables
+    :param schemas: A dictionary with the interned columns by schema ID
+    :return: The TraceStore
+    """
+    edges = collections.defaultdict(lambda: ([], [], []))
+    kinds = {"db_table": 0, "input": 1, "output": 2}
+    columns = ("call", "kind", "node", "schema")
+    for call, kind, node, schema in zip(
+        *(data["edges"][column].to_list() for column in columns)
+    ):
+        if kind == "db_table":
+            edges[call][0].append(node)
+        else:
+            edges[call][kinds[kind]].append(FrameInfo(node, schemas.get(schema, ())))
+
+    for call, function, count in data["calls"].sort("call").iter_rows():
+        db_table, inputs, outputs = edges[call]
+        trace.add_call(function, db_table, inputs, outputs, count=count)
+    return trace
+
+
+class MermaidGraph:
+    """
+    Builder of a Mermaid flowchart. Each node is declared once and referenced by its
+    ID in the edges, the parallel edges are collapsed into one edge with the summed
+    count, and the function nodes are grouped in subgraphs by their type
+    """
+
+    def __init__(self, direction="TD"):
+        self.direction = direction
+        self.nodes = {}
+        self.edges = {}
+        self.styles = {}
+        self.classes = collections.defaultdict(list)
+        self.subgraphs = {}
+        self.titles = {}
+        self.ids = itertools.count()
+
+    def node(self, key, shape, group=None):
+        """
+        Add a node to the graph, if it was not added before
+        :param key: A hashable value that identifies the node
+        :param shape: A string with the Mermaid shape and label of the node
+        :param group: A string with the subgraph of the node, or None
+        :return: A string with the node ID
+        """
+        node = self.nodes.get(key)
+        if node is None:
+            node = self.nodes[key] = [f"n{next(self.ids)}", shape, group]
+        return node[0]
+
+    def subgraph(self, key, title):
+        """
+        Add a subgraph with a title to the graph, if it was not added before. Its ID
+        does not depend on the title, so subgraphs with the same title are distinct
+        :param key: A hashable value that identifies the subgraph
+        :param title: A string with the title of the subgraph
+        :return: A string with the subgraph ID, to use as the group of the nodes
+        """
+        subgraph_id = self.subgraphs.get(key)
+        if subgraph_id is None:
+            subgraph_id = self.subgraphs[key] = f"s{next(self.ids)}"
+            self.titles[subgraph_id] = title
+        return subgraph_id
+
+    def edge(self, source, target, count=1, label=None):
+        """
+        Add an edge to the graph, adding the count to the existing edge if any
+        :param source: A string with the source node ID
+        :param target: A string with the target node ID
+        :param count: An integer with the number of calls that use the edge
+        :param label: A string with an extra label of the edge, or None
+        :return: None
+        """
+        edge = self.edges.setdefault((source, target), [0, label])
+        edge[0] += count
+        edge[1] = edge[1] or label
+
+    def add_class(self, node_id, name, style):
+        """
+        Add a node to a class
+        :param node_id: A string with the node ID
+        :param name: A string with the class name
+        :param style: A string with the Mermaid style of the class
+        :return: None
+        """
+        self.styles[name] = style
+        if node_id not in self.classes[name]:
+            self.classes[name].append(node_id)
+
+    def fold(self, max_nodes):
+        """
+        Fold the nodes that are not in a subgraph and have a single edge into one node
+        per neighbour and direction, until the graph has at most max_nodes nodes or
+        there is nothing else to fold
+        :param max_nodes: An integer with the maximum number of nodes
+        :return: None
+        """
+        degree = collections.Counter()
+        for source, target in self.edges:
+            degree[source] += 1
+            degree[target] += 1
+
+        groups = collections.defaultdict(list)
+        for key, (node_id, _, group) in self.nodes.items():
+            if group is None and degree[node_id] == 1:
+                groups[node_id] = key
+        candidates = collections.defaultdict(list)
+        for (source, target), (count, _) in self.edges.items():
+            if source in groups:
+                candidates[(target, "in")].append((source, count))
+            elif target in groups:
+                candidates[(source, "out")].append((target, count))
+
+        # Fold the largest groups first, since they remove the most nodes
+        excess = len(self.nodes) - max_nodes
+        for (neighbour, direction), folded in sorted(
+            candidates.items(), key=lambda item: -len(item[1])
+        ):
+            if excess <= 0:
+                break
+            if len(folded) < 2:
+                continue
+
+            count = 0
+            for node_id, edge_count in folded:
+                del self.nodes[groups[node_id]]
+                for node_ids in self.classes.values():
+                    if node_id in node_ids:
+                        node_ids.remove(node_id)
+                edge = (
+                    (node_id, neighbour) if direction == "in" else (neighbour, node_id)
+                )
+                del self.edges[edge]
+                count += edge_count
+
+            node_id = self.node(
+                ("fold", neighbour, direction), f'[["{len(folded)} folded nodes"]]'
+            )
+            if direction == "in":
+                self.edge(node_id, neighbour, count)
+            else:
+                self.edge(neighbour, node_id, count)
+            excess -= len(folded) - 1
+
+    def lines(self):
+        """
+        Get the lines of the diagram
+        :return: A generator with the lines
+        """
+        yield f"graph {self.direction}\n"
+
+        groups = collections.defaultdict(list)
+        for node_id, shape, group in self.nodes.values():
+            groups[group].append(f"{node_id}{shape}\n")
+
+        yield from groups.pop(None, [])
+        for group, declarations in groups.items():
+            if group in self.titles:
+                title = str(self.titles[group]).replace('"', "#quot;")
+                yield f'subgraph {group} ["{title}"]\n'
+            else:
+                yield f"subgraph {group}\n"
+            yield from declarations
+            yield "end\n"
+
+        for (source, target), (count, label) in self.edges.items():
+            edge_text = [f"x{count}"] if count > 1 else []
+            if label:
+                edge_text.append(label)
+            arrow = f"-->|{', '.join(edge_text)}|" if edge_text else "-->"
+            yield f"{source} {arrow} {target}\n"
+
+        for name, node_ids in self.classes.items():
+            if not node_ids:
+                continue
+            yield f"classDef {name} {self.styles[name]}\n"
+            yield f"class {','.join(node_ids)} {name}\n"
+
+    def write(self, path):
+        """
+        Write the diagram to a Markdown file
+        :param path: A string with the path to save the file
+        :return: None
+        """
+        with open(path, "w") as f:
+            f.write("\n```mermaid\n")
+            f.writelines(self.lines())
+            f.write("```")
+
+
+def table_shape(table_name, columns):
+    """
+    Get the Mermaid shape of a database table node
+    :param table_name: A string with the table name
+    :param columns: A tuple with the column names
+    :return: A string with the shape
+    """
+    columns_string = "\n" + "\n".join([f"{column}" for column in columns])
+    label_columns = "_" + str(table_name) + "_" + str(columns_string)
+    return f'[("`{label_columns}`")]'
+
+
+def frame_shape(label, info):
+    """
+    Get the Mermaid shape of a DataFrame node
+    :param label: A string with the DataFrame label
+    :param info: A tuple with the column names
+    :return: A string with the shape
+    """
+    # If the number of columns is greater than 4, only show the first 3 and the last one
+    if len(info) > 4:
+        columns_string = "\n".join(info[:3]) + "\n(...)\n " + info[-1]
+    else:
+        columns_string = "\n" + "\n ".join(info)
+
+    label_columns = "_" + str(label) + "_" + columns_string
+    return '@{ shape: braces, label: "' + label_columns + '" }'
+
+
+def build_mermaid(trace, max_nodes=None):
+    """
+    Build the Mermaid diagram of a trace, with a node for each function, database
+    table and DataFrame
+    :param trace: A TraceStore with the information
+    :param max_nodes: An integer with the maximum number of nodes, or None
+    :return: A MermaidGraph
+    """
+    graph = MermaidGraph()
+    slowest = set(trace.slowest())
+
+    for _, record in trace.items():
+        function_info = trace.function(record)
+        function_type = function_info["type"]
+
+        node_text = function_info["name"]
+        calls = trace.call_counts.get(record.function)
+        if calls and calls > 1:
+            node_text += f" x{calls}"
+
+        # Annotate the slowest functions with their timings
+        edge_label = None
+        if record.function in slowest:
+            summary = trace.metrics[record.function].summary()
+            node_text += f", p95 {format_duration(summary['wall_p95'])}"
+            edge_label = format_duration(summary["wall_total"])
+
+        function_id = graph.node(
+            ("function", record.function), f"[/{node_text}/]", function_type
+        )
+        if edge_label:
+            graph.add_class(function_id, "slow", "stroke:#d33,stroke-width:3px")
+
+        for table_name in record.db_table:
+            shape = table_shape(table_name, trace.tables[table_name])
+            table_id = graph.node(("table", table_name), shape)
+            if function_type == "extract":
+                graph.edge(table_id, function_id, record.count, edge_label)
+            elif function_type == "insert":
+                graph.edge(function_id, table_id, record.count, edge_label)
+
+        for label, info in record.input:
+            frame_id = graph.node(("frame", label), frame_shape(label, info))
+            graph.edge(frame_id, function_id, record.count, edge_label)
+
+        for label, info in record.output:
+            frame_id = graph.node(("frame", label), frame_shape(label, info))
+            graph.edge(function_id, frame_id, record.count, edge_label)
+
+    if max_nodes:
+        graph.fold(max_nodes)
+    return graph
+
+
+def get_mermaid_max_nodes():
+    """
+    Get the maximum number of nodes of the Mermaid diagram, from the
+    DOC_ETL_MERMAID_MAX_NODES environment variable
+    :return: An integer with the number of nodes, or 0 if there is no limit
+    """
+    return int(os.environ.get("DOC_ETL_MERMAID_MAX_NODES") or 0)
+
+
+def write_mermaid(trace, path="doc_etl/mermaid.md", max_nodes=None):
+    """
+    Write the trace to a Mermaid diagram
+    :param trace: A TraceStore with the information
+    :param path: A string with the path to save the file
+    :param max_nodes: An integer with the maximum number of nodes. The
+        DOC_ETL_MERMAID_MAX_NODES environment variable is used by default, and there
+        is no limit if it is not set
+    :return: None
+    """
+    if max_nodes is None:
+        max_nodes = get_mermaid_max_nodes()
+
+    build_mermaid(trace, max_nodes).write(path)
+
+
+class LineageGraph:
+    """
+    Lineage graph of a trace, with the edges in the direction of the data. A function
+    has a node for each of its records, so its unrelated calls are not joined, and a
+    database table or DataFrame has a node for each version: the version written
+    after it was read (e.g. a table updated by the pipeline that reads it) is a new
+    node, so the graph has no cycles. The nodes are identified by strings like
+    "table:NAME", "frame:LABEL" or "function:KEY", with a "#N" suffix from the second
+    node of the same name, and the forward and reverse adjacency are indexed, so
+    every query is O(V + E)
+    """
+
+    def __init__(self):
+        self.nodes = {}
+        self.forward = {}
+        self.reverse = {}
+        self.names = {}
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __contains__(self, node):
+        return node in self.nodes
+
+    @staticmethod
+    def node_id(kind, name, index=1):
+        """
+        Get the ID of a node
+        :param kind: A string with the node kind: "table", "frame" or "function"
+        :param name: A string with the table name, DataFrame label or function key
+        :param index: An integer with the number of the node among the nodes of the
+            same kind and name, starting at 1
+        :return: A string with the node ID
+        """
+        return f"{kind}:{name}" if index == 1 else f"{kind}:{name}#{index}"
+
+    def add_node(self, kind, name, new=False, **attributes):
+        """
+        Add a node to the graph, if there is no node of the same kind and name
+        :param kind: A string with the node kind: "table", "frame" or "function"
+        :param name: A string with the table name, DataFrame label or function key
+        :param new: A boolean to add a node even if there is one of the same name
+        :param attributes: The attributes of the node
+        :return: A string with the ID of the added node, or of the last node of the
+            same kind and name
+        """
+        nodes = self.names.get((kind, name), ())
+        if nodes and not new:
+            return nodes[-1]
+        node = self.node_id(kind, name, len(nodes) + 1)
+        self._insert(node, {"kind": kind, "name": name, **attributes})
+        return node
+
+    def _insert(self, node, attributes):
+        """
+        Insert a node in the graph and in the index of the names
+        :param node: A string with the node ID
+        :param attributes: A dictionary with the kind, name and attributes of the node
+        :return: None
+        """
+        self.nodes[node] = attributes
+        self.forward[node] = {}
+        self.reverse[node] = {}
+        self.names.setdefault((attributes["kind"], attributes["name"]), []).append(node)
+
+    def find(self, kind, name):
+        """
+        Get the nodes of a name, e.g. the nodes of the records of a function to get
+        the lineage of all its calls
+        :param kind: A string with the node kind: "table", "frame" or "function"
+        :param name: A string with the table name, DataFrame label or function key
+        :return: A list with the node IDs, in the order they were added
+        """
+        return list(self.names.get((kind, name), ()))
+
+    def add_edge(self, source, target):
+        """
+        Add an edge to the graph
+        :param source: A string with the source node ID
+        :param target: A string with the target node ID
+        :return: None
+        """
+        self.forward[source][target] = None
+        self.reverse[target][source] = None
+
+    def edges(self):
+        """
+        Iterate over the edges of the graph
+        :return: A generator with tuples of the source and target node IDs
+        """
+        for source, targets in self.forward.items():
+            for target in targets:
+                yield source, target
+
+    @classmethod
+    def from_trace(cls, trace):
+        """
+        Build the lineage graph of a trace
+        :param trace: A TraceStore with the information
+        :return: A LineageGraph
+        """
+        graph = cls()
+        read = set()
+
+        def source(kind, name, columns):
+            node = graph.add_node(kind, name, columns=columns)
+            read.add(node)
+            return node
+
+        def target(kind, name, columns):
+            # A table or DataFrame written after it was read is a new version
+            node = graph.add_node(kind, name, columns=columns)
+            if node in read:
+                node = graph.add_node(kind, name, new=True, columns=columns)
+            return node
+
+        for _, record in trace.items():
+            function_info = trace.function(record)
+            function_type = function_info["type"]
+            function = graph.add_node(
+                "function",
+                record.function,
+                new=True,
+                label=function_info["name"],
+                type=function_type,
+                count=record.count,
+            )
+
+            for table_name in record.db_table:
+                columns = trace.tables[table_name]
+                if function_type == "extract":
+                    graph.add_edge(source("table", table_name, columns), function)
+                elif function_type == "insert":
+                    graph.add_edge(function, target("table", table_name, columns))
+
+            for label, columns in record.input:
+                graph.add_edge(source("frame", label, columns), function)
+            for label, columns in record.output:
+                graph.add_edge(function, target("frame", label, columns))
+        return graph
+
+    def _closure(self, nodes, adjacency):
+        """
+        Get the nodes reachable from a set of nodes
+        :param nodes: A string or an iterable with the node IDs
+        :param adjacency: A dictionary with the adjacency to follow
+        :return: A list with the reachable node IDs, in breadth-first order, without
+            the starting nodes
+        """
+        start = [nodes] if isinstance(nodes, str) else list(nodes)
+        seen = set(start)
+        queue = collections.deque(start)
+        closure = []
+        while queue:
+            for neighbour in adjacency[queue.popleft()]:
+                if neighbour not in seen:
+                    seen.add(neighbour)
+                    closure.append(neighbour)
+                    queue.append(neighbour)
+        return closure
+
+    def upstream(self, nodes):
+        """
+        Get the nodes a node depends on, e.g. the tables and functions that produce
+        a DataFrame
+        :param nodes: A string or an iterable with the node IDs
+        :return: A list with the node IDs
+        """
+        return self._closure(nodes, self.reverse)
+
+    def downstream(self, nodes):
+        """
+        Get the nodes that depend on a node, e.g. the inserts that use a table
+        :param nodes: A string or an iterable with the node IDs
+        :return: A list with the node IDs
+        """
+        return self._closure(nodes, self.forward)
+
+    def shortest_path(self, source, target):
+        """
+        Get the shortest path between two nodes, following the direction of the data
+        :param source: A string with the source node ID
+        :param target: A string with the target node ID
+        :return: A list with the node IDs of the path, or None if there is no path
+        """
+        parents = {source: None}
+        queue = collections.deque([source])
+        while queue:
+            node = queue.popleft()
+            if node == target:
+                path = []
+                while node is not None:
+                    path.append(node)
+                    node = parents[node]
+                return path[::-1]
+            for neighbour in self.forward[node]:
+                if neighbour not in parents:
+                    parents[neighbour] = node
+                    queue.append(neighbour)
+        return None
+
+    def topological_order(self):
+        """
+        Get the nodes in topological order, so every node comes after the nodes it
+        depends on
+        :return: A list with the node IDs
+        """
+        degrees = {node: len(sources) for node, sources in self.reverse.items()}
+        queue = collections.deque(
+            node for node, degree in degrees.items() if not degree
+        )
+        order = []
+        while queue:
+            node = queue.popleft()
+            order.append(node)
+            for neighbour in self.forward[node]:
+                degrees[neighbour] -= 1
+                if not degrees[neighbour]:
+                    queue.append(neighbour)
+
+        if len(order) < len(self.nodes):
+            cycle = [node for node, degree in degrees.items() if degree]
+            raise ValueError(
+                f"The lineage graph has a cycle through {len(cycle)} nodes, "
+                f"e.g. {cycle[:5]}"
+            )
+        return order
+
+    def connected_components(self):
+        """
+        Get the connected components of the graph, regardless of the edge direction
+        :return: A list with a list of node IDs for each component
+        """
+        seen = set()
+        components = []
+        for start in self.nodes:
+            if start in seen:
+                continue
+            seen.add(start)
+            component = [start]
+            queue = collections.deque([start])
+            while queue:
+                node = queue.popleft()
+                for neighbour in itertools.chain(
+                    self.forward[node], self.reverse[node]
+                ):
+                    if neighbour not in seen:
+                        seen.add(neighbour)
+                        component.append(neighbour)
+                        queue.append(neighbour)
+            components.append(component)
+        return components
+
+    def subgraph(self, nodes):
+        """
+        Get the subgraph of a set of nodes, with the edges between them
+        :param nodes: An iterable with the node IDs
+        :return: A LineageGraph
+        """
+        graph = LineageGraph()
+        for node in nodes:
+            graph._insert(node, dict(self.nodes[node]))
+        for node in graph.nodes:
+            for target in self.forward[node]:
+                if target in graph.nodes:
+                    graph.add_edge(node, target)
+        return graph
+
+    def to_dict(self):
+        """
+        Convert the graph to a dictionary that can be serialized to JSON
+        :return: A dictionary with the nodes and edges
+        """
+        return {
+            "nodes": {
+                node: {
+                    key: list(value) if isinstance(value, tuple) else value
+                    for key, value in attributes.items()
+                }
+                for node, attributes in self.nodes.items()
+            },
+            "edges": [list(edge) for edge in self.edges()],
+        }
+
+    def to_mermaid(self):
+        """
+        Convert the graph to a Mermaid diagram
+        :return: A MermaidGraph
+        """
+        mermaid = MermaidGraph()
+        ids = {}
+        for node, attributes in self.nodes.items():
+            kind, name = attributes["kind"], attributes["name"]
+            if kind == "function":
+                shape, group = f"[/{attributes['label']}/]", attributes["type"]
+            elif kind == "table":
+                shape, group = table_shape(name, attributes["columns"]), None
+            else:
+                shape, group = frame_shape(name, attributes["columns"]), None
+            ids[node] = mermaid.node(node, shape, group)
+
+        for source, target in self.edges():
+            mermaid.edge(ids[source], ids[target])
+        return mermaid
+
+    def write_json(self, path):
+        """
+        Write the graph to a JSON file
+        :param path: A string with the path to save the file
+        :return: None
+        """
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=4)
+
+    def write_mermaid(self, path):
+        """
+        Write the graph to a Mermaid diagram
+        :param path: A string with the path to save the file
+        :return: None
+        """
+        self.to_mermaid().write(path)
+
+
+@functools.lru_cache(maxsize=4096)
+def column_diff(source, target):
+    """
+    Diff the columns of a source and a target schema. Only the column names are
+    read, and the diff is cached for each pair of schemas, so the calls with the same
+    schemas are diffed once
+    :param source: A tuple with the columns of the source
+    :param target: A tuple with the columns of the target
+    :return: A tuple with the tuples of the columns passed through, in the order of
+        the target, the columns added to the target and the columns of the source
+        dropped
+    """
+    source_columns, target_columns = set(source), set(target)
+    return (
+        tuple(column for column in target if column in source_columns),
+        tuple(column for column in target if column not in source_columns),
+        tuple(column for column in source if column not in target_columns),
+    )
+
+
+@functools.lru_cache(maxsize=4096)
+def schema_lineage(sources, targets):
+    """
+    Get the column lineage between the input and output schemas of a call, from the
+    diffs of each pair of schemas. A column is added if no input has it, and dropped
+    if no output has it. Without outputs (e.g. an insert into a table of unknown
+    schema) nothing is known to be dropped
+    :param sources: A tuple with the columns of each input
+    :param targets: A tuple with the columns of each output
+    :return: A tuple with the columns passed through from each input to each output,
+        the columns added to each output and the columns dropped from each input
+    """
+    diffs = [[column_diff(source, target) for target in targets] for source in sources]
+    passed = tuple(tuple(diff[0] for diff in row) for row in diffs)
+
+    added = []
+    for j, target in enumerate(targets):
+        kept = set(target).intersection(*(set(row[j][1]) for row in diffs))
+        added.append(tuple(column for column in target if column in kept))
+
+    dropped = []
+    for source, row in zip(sources, diffs):
+        if not targets:
+            dropped.append(())
+            continue
+        kept = set(source).intersection(*(set(diff[2]) for diff in row))
+        dropped.append(tuple(column for column in source if column in kept))
+    return passed, tuple(added), tuple(dropped)
+
+
+def column_lineage(trace):
+    """
+    Get the column-level lineage of a trace from the schemas of the inputs and
+    outputs of each record: the columns passed through from an input to an output,
+    the columns of an output added by the function and the columns of an input that
+    are in no output. The database tables are the inputs of the extract functions and
+    the outputs of the insert functions, and the columns of a table of unknown schema
+    are neither added nor dropped. Each edge bundles the columns between two
+    nodes, which are identified as the first node of their name in the LineageGraph:
+    the bundles of all the records of a function share its "function:KEY" node
+    :param trace: A TraceStore with the information
+    :return: A list with dictionaries with the function key, the kind (passed, added
+        or dropped), the source and target node IDs and the columns. The source of
+        the added columns and the target of the dropped columns is the function
+    """
+    edges = {}
+    for _, record in trace.items():
+        function_type = trace.function(record)["type"]
+        function = "function:" + record.function
+        inputs, outputs = get_record_io(trace, record)
+        input_kind = "table:" if function_type == "extract" else "frame:"
+        output_kind = "table:" if function_type == "insert" else "frame:"
+
+        # A table without columns has an unknown schema, unlike an empty DataFrame.
+        # The columns of the outputs could come from it, or the columns of the
+        # inputs go to it, so nothing is known to be added or dropped
+        unknown_input = input_kind == "table:" and not all(c for _, c in inputs)
+        unknown_output = output_kind == "table:" and not all(c for _, c in outputs)
+        if unknown_input:
+            inputs = [(name, columns) for name, columns in inputs if columns]
+        if unknown_output:
+            outputs = [(name, columns) for name, columns in outputs if columns]
+
+        sources = [input_kind + name for name, _ in inputs]
+        targets = [output_kind + name for name, _ in outputs]
+        passed, added, dropped = schema_lineage(
+            tuple(columns for _, columns in inputs),
+            tuple(columns for _, columns in outputs),
+        )
+
+        bundles = [
+            ("passed", source, target, columns)
+            for source, row in zip(sources, passed)
+            for target, columns in zip(targets, row)
+        ]
+        if not unknown_input:
+            bundles += [("added", function, t, c) for t, c in zip(targets, added)]
+        if not unknown_output:
+            bundles += [("dropped", s, function, c) for s, c in zip(sources, dropped)]
+        for kind, source, target, columns in bundles:
+            if columns:
+                edge = edges.setdefault((record.function, kind, source, target), {})
+                edge.update(dict.fromkeys(columns))
+
+    return [
+        {
+            "function": function,
+            "kind": kind,
+            "source": source,
+            "target": target,
+            "columns": list(columns),
+        }
+        for (function, kind, source, target), columns in edges.items()
+    ]
+
+
+def build_column_mermaid(trace):
+    """
+    Build the Mermaid diagram of the column-level lineage of a trace, with a
+    subgraph with the columns of each table and DataFrame
+    :param trace: A TraceStore with the information
+    :return: A MermaidGraph
+    """
+    graph = MermaidGraph(direction="LR")
+
+    # The subgraphs are identified by the lineage node, since a table, a DataFrame
+    # and a function type can have the same name
+    def column_node(node, column):
+        group = graph.subgraph(("node", node), node.split(":", 1)[1])
+        shape = '["' + str(column).replace('"', "#quot;") + '"]'
+        return graph.node(("column", node, column), shape, group)
+
+    for edge in column_lineage(trace):
+        function_info = trace.functions[edge["function"]]
+        function_id = graph.node(
+            ("function", edge["function"]),
+            f"[/{function_info['name']}/]",
+            graph.subgraph(("type", function_info["type"]), function_info["type"]),
+        )
+        for column in edge["columns"]:
+            if edge["kind"] == "passed":
+                graph.edge(
+                    column_node(edge["source"], column),
+                    column_node(edge["target"], column),
+                    label=function_info["name"],
+                )
+            elif edge["kind"] == "added":
+                graph.edge(function_id, column_node(edge["target"], column))
+            else:
+                graph.edge(
+                    column_node(edge["source"], column), function_id, label="dropped"
+                )
+    return graph
+
+
+def write_column_mermaid(trace, path="doc_etl/column_lineage.md"):
+    """
+    Write the column-level lineage of a trace to a Mermaid diagram
+    :param trace: A TraceStore with the information
+    :param path: A string with the path to save the file
+    :return: None
+    """
+    build_column_mermaid(trace).write(path)
+
+
+def format_duration(seconds):
+    """
+    Format a duration in a human readable way
+    :param seconds: A float with the duration in seconds
+    :return: A string with the duration
+    """
+    if seconds >= 1:
+        return f"{seconds:.2f} s"
+    elif seconds >= 1e-3:
+        return f"{seconds * 1e3:.1f} ms"
+    return f"{seconds * 1e6:.0f} us"
+
+
+def write_metrics(trace, path="doc_etl/metrics.md"):
+    """
+    Write the summary of the runtime metrics to a Markdown table
+    :param trace: A TraceStore with the information
+    :param path: A string with the path to save the file
+    :return: None
+    """
+    lines = [
+        "# ETL Runtime Metrics\n",
+        "| Function | Type | Calls | Wall total | Wall p50 | Wall p95 | Wall max "
+        "| CPU total | Rows in | Rows out | Bytes in | Bytes out | Peak memory |",
+        "|---|---|---|---|---|---|---|---|---|---|---|---|---|",
+    ]
+    for key in trace.slowest(len(trace.metrics)):
+        function_info = trace.functions[key]
+        summary = trace.metrics[key].summary()
+        lines.append(
+            f"| {function_info['name']} | {function_info['type']} "
+            f"| {summary['calls']} "
+            f"| {format_duration(summary['wall_total'])} "
+            f"| {format_duration(summary['wall_p50'])} "
+            f"| {format_duration(summary['wall_p95'])} "
+            f"| {format_duration(summary['wall_max'])} "
+            f"| {format_duration(summary['cpu_total'])} "
+            f"| {summary['rows_in']} | {summary['rows_out']} "
+            f"| {summary['bytes_in']} | {summary['bytes_out']} "
+            f"| {summary['peak_memory'] if summary['peak_memory'] is not None else '-'} |"
+        )
+
+    with open(path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+# Metrics of each function stored in the history, as columns of run_functions
+HISTORY_METRICS = tuple(key for key in METRIC_KEYS if key != "calls")
+
+HISTORY_SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    created REAL NOT NULL,
+    digest TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS functions (
+    id INTEGER PRIMARY KEY,
+    key TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS schemas (
+    id INTEGER PRIMARY KEY,
+    hash TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS schema_columns (
+    schema INTEGER NOT NULL REFERENCES schemas (id),
+    position INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    dtype TEXT,
+    PRIMARY KEY (schema, position)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS run_functions (
+    run INTEGER NOT NULL REFERENCES runs (id),
+    function INTEGER NOT NULL REFERENCES functions (id),
+    type TEXT,
+    code_hash TEXT,
+    calls INTEGER NOT NULL,
+    chunks INTEGER NOT NULL,
+    {", ".join(f"{key} REAL" for key in HISTORY_METRICS)},
+    PRIMARY KEY (run, function)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS run_functions_function ON run_functions (function, run);
+CREATE TABLE IF NOT EXISTS run_tables (
+    run INTEGER NOT NULL REFERENCES runs (id),
+    name TEXT NOT NULL,
+    schema INTEGER NOT NULL REFERENCES schemas (id),
+    PRIMARY KEY (run, name)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS run_tables_name ON run_tables (name, run);
+CREATE TABLE IF NOT EXISTS run_frames (
+    run INTEGER NOT NULL REFERENCES runs (id),
+    function INTEGER NOT NULL REFERENCES functions (id),
+    direction TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    schema INTEGER NOT NULL REFERENCES schemas (id),
+    count INTEGER NOT NULL,
+    PRIMARY KEY (run, function, direction, position, schema)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS run_frames_function
+    ON run_frames (function, direction, position, run);
+"""
+
+
+def get_history_path():
+    """
+    Get the path of the history database, from the DOC_ETL_HISTORY environment
+    variable: a path, or 1 to use doc_etl/history.sqlite
+    :return: A string with the path, or None to not record the runs
+    """
+    path = os.environ.get("DOC_ETL_HISTORY", "")
+    if path.lower() in ("", "0", "false", "no"):
+        return None
+    if path.lower() in ("1", "true", "yes"):
+        return "doc_etl/history.sqlite"
+    return path
+
+
+class HistoryStore:
+    """
+    History of the traced runs in a SQLite database, to compare the functions,
+    schemas and timings between runs. The function keys and the column lists are
+    stored once, and each run adds a row per function, table and DataFrame position.
+    The tables of the runs are keyed by run first, so comparing two runs only reads
+    their rows, however many runs are stored
+    """
+
+    # Maximum number of values of an IN clause
+    chunk_size = 500
+
+    def __init__(self, path="doc_etl/history.sqlite"):
+        import sqlite3
+
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(HISTORY_SCHEMA)
+
+    def close(self):
+        """
+        Close the database
+        :return: None
+        """
+        self.connection.close()
+
+    def intern(self, table, column, values):
+        """
+        Get the IDs of the values of a unique column, inserting the new ones
+        :param table: A string with the table name
+        :param column: A string with the column name
+        :param values: An iterable with the values
+        :return: A tuple with a dictionary with the values and IDs, and the list of
+            the new values
+        """
+        values = list(dict.fromkeys(values))
+
+        def select(values):
+            ids = {}
+            for start in range(0, len(values), self.chunk_size):
+                chunk = values[start : start + self.chunk_size]
+                marks = ", ".join("?" * len(chunk))
+                query = f"SELECT {column}, id FROM {table} WHERE {column} IN ({marks})"
+                ids.update(self.connection.execute(query, chunk))
+            return ids
+
+        ids = select(values)
+        new = [value for value in values if value not in ids]
+        self.connection.executemany(
+            f"INSERT INTO {table} ({column}) VALUES (?)", [(value,) for value in new]
+        )
+        ids.update(select(new))
+        return ids, new
+
+    def record(self, trace, created=None):
+        """
+        Add a run to the history, with batch inserts in a single transaction
+        :param trace: A TraceStore with the information
+        :param created: A float with the timestamp of the run, by default now
+        :return: An integer with the ID of the run
+        """
+        created = time.time() if created is None else created
+        records = [record for _, record in trace.items()]
+        keys = itertools.chain(
+            (record.function for record in records), trace.call_counts, trace.metrics
+        )
+
+        # The column lists, with their data types, of the tables and DataFrames. The
+        # tuples are interned by the trace, so each one is hashed once
+        schemas, hashes = {}, {}
+
+        def schema_hash(columns, dtypes):
+            schema = hashes.get((columns, dtypes))
+            if schema is None:
+                schema = hashes[columns, dtypes] = content_hash(columns, dtypes)
+                schemas[schema] = (columns, dtypes)
+            return schema
+
+        tables = {
+            name: schema_hash(columns, ()) for name, columns in trace.tables.items()
+        }
+        frames = collections.Counter()
+        for record in records:
+            for direction in ("input", "output"):
+                for position, (label, columns) in enumerate(getattr(record, direction)):
+                    dtypes = trace.frames.get(label, (None, ()))[1]
+                    schema = schema_hash(columns, dtypes)
+                    frames[record.function, direction, position, schema] += record.count
+
+        with self.connection:
+            run = self.connection.execute(
+                "INSERT INTO runs (created, digest) VALUES (?, ?)",
+                (created, trace_digest(trace)),
+            ).lastrowid
+            functions, _ = self.intern("functions", "key", keys)
+            schema_ids, new = self.intern("schemas", "hash", schemas)
+            self.connection.executemany(
+                "INSERT INTO schema_columns VALUES (?, ?, ?, ?)",
+                (
+                    (schema_ids[schema], position, column, dtype)
+                    for schema in new
+                    for position, (column, dtype) in enumerate(
+                        itertools.zip_longest(*schemas[schema])
+                    )
+                ),
+            )
+
+            calls = collections.Counter()
+            for record in records:
+                calls[record.function] += record.count
+            rows = []
+            for key, function in functions.items():
+                info = trace.functions.get(key, {})
+                summary = trace.metrics[key].summary() if key in trace.metrics else {}
+                rows.append(
+                    (
+                        run,
+                        function,
+                        info.get("type"),
+                        info.get("code_hash"),
+                        trace.call_counts.get(key) or calls[key],
+                        trace.chunk_counts.get(key, 0),
+                        *(summary.get(metric) for metric in HISTORY_METRICS),
+                    )
+                )
+            marks = ", ".join("?" * (6 + len(HISTORY_METRICS)))
+            self.connection.executemany(
+                f"INSERT INTO run_functions VALUES ({marks})", rows
+            )
+            self.connection.executemany(
+                "INSERT INTO run_tables VALUES (?, ?, ?)",
+                ((run, name, schema_ids[schema]) for name, schema in tables.items()),
+            )
+            self.connection.executemany(
+                "INSERT INTO run_frames VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    (run, functions[key], direction, position, schema_ids[schema], n)
+                    for (key, direction, position, schema), n in frames.items()
+                ),
+            )
+        return run
+
+    def runs(self, limit=None):
+        """
+        Get the stored runs, the latest first
+        :param limit: An integer with the maximum number of runs, or None
+        :return: A list with tuples of the run ID, timestamp and trace digest
+        """
+        query = "SELECT id, created, digest FROM runs ORDER BY id DESC"
+        if limit is not None:
+            return self.connection.execute(query + " LIMIT ?", (limit,)).fetchall()
+        return self.connection.execute(query).fetchall()
+
+    def resolve(self, run):
+        """
+        Get the ID of a run. The negative numbers count back from the latest run, so
+        -1 is the run before it
+        :param run: An integer with the run ID, or None for the latest run
+        :return: An integer with the run ID
+        """
+        latest = self.connection.execute("SELECT MAX(id) FROM runs").fetchone()[0]
+        if latest is None:
+            raise ValueError("The history has no runs")
+        if run is None:
+            return latest
+        if run < 0:
+            run = latest + run
+        exists = "SELECT 1 FROM runs WHERE id = ?"
+        if self.connection.execute(exists, (run,)).fetchone() is None:
+            raise ValueError(f"Unknown run: {run}")
+        return run
+
+    def functions(self, run):
+        """
+        Get the functions of a run
+        :param run: An integer with the run ID
+        :return: A dictionary with the function keys and dictionaries with the type,
+            code hash, calls, chunks and metrics
+        """
+        fields = ("type", "code_hash", "calls", "chunks") + HISTORY_METRICS
+        query = (
+            f"SELECT f.key, {', '.join(f'r.{field}' for field in fields)} "
+            "FROM run_functions AS r JOIN functions AS f ON f.id = r.function "
+            "WHERE r.run = ?"
+        )
+        return {
+            key: dict(zip(fields, values))
+            for key, *values in self.connection.execute(query, (run,))
+        }
+
+    def schemas(self, run):
+        """
+        Get the schemas of the tables and DataFrames of a run
+        :param run: An integer with the run ID
+        :return: A dictionary with the table names, or the function, direction and
+            position of the DataFrames, and dictionaries with the columns and their
+            data types. A DataFrame position can have several schemas, so the data
+            types of a column are a sorted tuple
+        """
+        query = (
+            "SELECT 'table', s.name, NULL, NULL, s.schema, c.position, c.name, c.dtype "
+            "FROM run_tables AS s JOIN schema_columns AS c ON c.schema = s.schema "
+            "WHERE s.run = ? "
+            "UNION ALL "
+            "SELECT 'frame', f.key, s.direction, s.position, s.schema, c.position, "
+            "c.name, c.dtype "
+            "FROM run_frames AS s JOIN functions AS f ON f.id = s.function "
+            "JOIN schema_columns AS c ON c.schema = s.schema "
+            "WHERE s.run = ? "
+            "ORDER BY 1, 2, 3, 4, 5, 6"
+        )
+        schemas = collections.defaultdict(dict)
+        rows = self.connection.execute(query, (run, run))
+        for kind, name, direction, position, _, _, column, dtype in rows:
+            key = name if kind == "table" else f"{name}:{direction}:{position}"
+            dtypes = schemas[kind, key].setdefault(column, set())
+            if dtype is not None:
+                dtypes.add(dtype)
+        return {
+            key: {column: tuple(sorted(dtypes)) for column, dtypes in columns.items()}
+            for key, columns in schemas.items()
+        }
+
+    def changes(self, since, until=None):
+        """
+        Get what changed between two runs: the functions added, removed, with new
+        code or a different number of calls, and the tables and DataFrames with a
+        different schema
+        :param since: An integer with the ID of the first run
+        :param until: An integer with the ID of the last run, by default the latest
+        :return: A dictionary with the changes
+        """
+        since, until = self.resolve(since), self.resolve(until)
+        before, after = self.functions(since), self.functions(until)
+        schemas_before, schemas_after = self.schemas(since), self.schemas(until)
+        return {
+            "since": since,
+            "until": until,
+            "functions_added": sorted(after.keys() - before.keys()),
+            "functions_removed": sorted(before.keys() - after.keys()),
+            "code_changed": sorted(
+                key
+                for key in after.keys() & before.keys()
+                if after[key]["code_hash"] != before[key]["code_hash"]
+            ),
+            "calls_changed": {
+                key: (before[key]["calls"], after[key]["calls"])
+                for key in sorted(after.keys() & before.keys())
+                if after[key]["calls"] != before[key]["calls"]
+            },
+            "schemas_added": sorted(schemas_after.keys() - schemas_before.keys()),
+            "schemas_removed": sorted(schemas_before.keys() - schemas_after.keys()),
+            "schemas_changed": sorted(
+                key
+                for key in schemas_after.keys() & schemas_before.keys()
+                if schemas_after[key] != schemas_before[key]
+            ),
+        }
+
+    def column_changes(self, since, until=None):
+        """
+        Get the columns that appeared, disappeared or changed data type in the
+        tables and DataFrames between two runs
+        :param since: An integer with the ID of the first run
+        :param until: An integer with the ID of the last run, by default the latest
+        :return: A list with dictionaries with the kind (table or frame), the name
+            and the appeared, disappeared and retyped columns
+        """
+        since, until = self.resolve(since), self.resolve(until)
+        before, after = self.schemas(since), self.schemas(until)
+        changes = []
+        for kind, name in sorted(before.keys() & after.keys()):
+            old, new = before[kind, name], after[kind, name]
+            retyped = {
+                column: (old[column], new[column])
+                for column in new
+                if column in old and old[column] != new[column]
+            }
+            if old.keys() != new.keys() or retyped:
+                changes.append(
+                    {
+                        "kind": kind,
+                        "name": name,
+                        "appeared": [column for column in new if column not in old],
+                        "disappeared": [column for column in old if column not in new],
+                        "retyped": retyped,
+                    }
+                )
+        return changes
+
+    def slower(self, since, until=None, metric="wall_p50", threshold=1.2):
+        """
+        Get the functions that got slower: the metric of the last run compared with
+        its median over the runs from since, excluding the last one
+        :param since: An integer with the ID of the first run of the baseline
+        :param until: An integer with the ID of the last run, by default the latest
+        :param metric: A string with the metric, e.g. wall_p50, wall_p95 or cpu_total
+        :param threshold: A float with the minimum ratio to the baseline
+        :return: A list with tuples of the function key, baseline, last value and
+            ratio, the largest ratio first
+        """
+        if metric not in HISTORY_METRICS:
+            raise ValueError(f"Unknown metric: {metric}")
+        since, until = self.resolve(since), self.resolve(until)
+        query = (
+            f"SELECT f.key, r.run, r.{metric} "
+            "FROM run_functions AS r JOIN functions AS f ON f.id = r.function "
+            f"WHERE r.run BETWEEN ? AND ? AND r.{metric} IS NOT NULL"
+        )
+        baselines = collections.defaultdict(list)
+        latest = {}
+        for key, run, value in self.connection.execute(query, (since, until)):
+            if run == until:
+                latest[key] = value
+            else:
+                baselines[key].append(value)
 
+        slower = []
+        for key, value in latest.items():
+            samples = sorted(baselines.get(key, ()))
+            if not samples:
+                continue
+            baseline = samples[len(samples) // 2]
+            if baseline > 0 and value / baseline >= threshold:
+                slower.append((key, baseline, value, value / baseline))
+        return sorted(slower, key=lambda item: item[3], reverse=True)
 
-def parse_schema(schema):
+
+def record_history(trace, path):
     """
-    Parse the schema of a table from the output of the defined query
-    :param schema: A list with the schema of the table
-    :return: A list with the columns of the table
+    Add a run to the history database
+    :param trace: A TraceStore with the information
+    :param path: A string with the path of the database
+    :return: An integer with the ID of the run
     """
-    columns = []
-    for column in schema:
-        column_name = column[2]
-        columns.append(column_name)
-    return columns
+    history = HistoryStore(path)
+    try:
+        return history.record(trace)
+    finally:
+        history.close()
 
 
-def get_table(table):
+def print_history(args):
     """
-    Get the schema of a table from the database schema
-    :param table: A string with the table name
-    :return: A dictionary with the table schema
+    Print the answer of a history command
+    :param args: An argparse.Namespace with the command and its arguments
+    :return: None
     """
-    database_dict = {table: []}
-    for row in DB_SCHEMA:
-        table_name = row[1]
-        if table_name != table:
-            continue
-        database_dict[table_name].append(row)
+    history = HistoryStore(args.db)
+    try:
+        if args.history_command == "runs":
+            for run, created, digest in history.runs(args.limit):
+                created = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(created))
+                print(f"{run}\t{created}\t{digest}")
 
-    for table_name, table_schema in database_dict.items():
-        table = {table_name: parse_schema(table_schema)}
-    return table
+        elif args.history_command == "changes":
+            changes = history.changes(args.since, args.until)
+            print(f"Changes from run {changes['since']} to run {changes['until']}")
+            for field in (
+                "functions_added",
+                "functions_removed",
+                "code_changed",
+                "schemas_added",
+                "schemas_removed",
+                "schemas_changed",
+            ):
+                for item in changes[field]:
+                    item = item if isinstance(item, str) else " ".join(item)
+                    print(f"{field.replace('_', ' ')}: {item}")
+            for key, (before, after) in changes["calls_changed"].items():
+                print(f"calls changed: {key} {before} -> {after}")
 
+        elif args.history_command == "columns":
+            for change in history.column_changes(args.since, args.until):
+                print(f"{change['kind']} {change['name']}")
+                for column in change["appeared"]:
+                    print(f"  + {column}")
+                for column in change["disappeared"]:
+                    print(f"  - {column}")
+                for column, (before, after) in change["retyped"].items():
+                    print(f"  ~ {column}: {'/'.join(before)} -> {'/'.join(after)}")
 
-# TODO: Is there a way to not use a global variable?
-INFO_DICT = {}
+        elif args.history_command == "slower":
+            for key, baseline, value, ratio in history.slower(
+                args.since, args.until, args.metric, args.threshold
+            ):
+                if args.metric.startswith(("wall", "cpu")):
+                    baseline, value = format_duration(baseline), format_duration(value)
+                print(f"{key}\t{baseline} -> {value}\tx{ratio:.2f}")
+    finally:
+        history.close()
 
 
-def log_dataframe_info(df):
+def convert_df_to_string(dfs):
     """
-    Get a string representation of the DataFrame
-    :param df: DataFrame to log
-    :return: A dictionary with the DataFrame label and columns
+    Convert a list of DataFrames to a string
+    :param dfs: A list of tuples with the DataFrame or table names and columns
+    :return: A string with the DataFrames
     """
-    label = f"DataFrame_{id(df)}"
+    return_string = ""
+    for table_name, columns in dfs:
+        columns_string = (
+            "\n - " + "\n - ".join([f"{column}" for column in columns]) + "\n"
+        )
+        return_string += f"{table_name}: {columns_string}\n"
 
-    if isinstance(df, pd.DataFrame):
-        return {label: df.columns.tolist()}
-    elif isinstance(df, pl.DataFrame):
-        return {label: df.columns}
-    else:
-        raise TypeError(f"Unsupported DataFrame type: {type(df).__name__}")
+    return return_string
 
 
-def extract(extract_table):
+def convert_profiles_to_string(trace, dfs):
     """
-    Decorator to log information about the function
-    :param extract_table: A string or list of strings with the table names
-    :return: Decorator
+    Convert the profiles of a list of DataFrames to a string
+    :param trace: A TraceStore with the information
+    :param dfs: A list of tuples with the DataFrame or table names and columns
+    :return: A string with the profiles
     """
+    return_string = ""
+    for label, _ in dfs:
+        profile = trace.profiles.get(label)
+        if profile is None:
+            continue
 
-    def decorator(func):
-        @functools.wraps(func)
-        def wrapper(*args, **kwargs):
-            # Execute the function
-            result = func(*args, **kwargs)
+        rows = f"{profile['rows']} rows"
+        if profile["profiled_rows"] < profile["rows"]:
+            rows += f", sample of {profile['profiled_rows']}"
+        return_string += f"{label} ({rows}):\n"
+        for column, stats in profile["columns"].items():
+            column_string = f" - {column}: {stats['dtype']}, {stats['nulls']} nulls"
+            if stats["distinct"] is not None:
+                column_string += f", ~{stats['distinct']} distinct"
+            if stats["min"] is not None:
+                column_string += f", min {stats['min']}, max {stats['max']}"
+            return_string += column_string + "\n"
+        return_string += "\n"
 
-            # Get the function ID and the arguments ID to obtain an unique ID
-            args_id = [id(arg) for arg in args]
-            args_id = "_".join(map(str, args_id))
-            function_id = str(id(func)) + "_" + args_id
-            INFO_DICT[function_id] = {}
-
-            # Get information about the function
-            INFO_DICT[function_id]["name"] = func.__name__
-            INFO_DICT[function_id]["type"] = "extract"
-            INFO_DICT[function_id]["docstring"] = func.__doc__.replace("\n", " ")
-            INFO_DICT[function_id]["code"] = inspect.getsource(func).strip()
-            INFO_DICT[function_id]["input"] = []
-            INFO_DICT[function_id]["output"] = []
-
-            # Log the tables where the data is extracted
-            # TODO: Find a better way to handle getting the table schema
-            INFO_DICT[function_id]["db_table"] = []
-            if isinstance(extract_table, (list, tuple)):
-                for table in extract_table:
-                    INFO_DICT[function_id]["db_table"].append(get_table(table))
-            elif isinstance(extract_table, str):
-                INFO_DICT[function_id]["db_table"].append(get_table(extract_table))
-
-            # Log the returned DataFrames
-            if isinstance(result, (pd.DataFrame, pl.DataFrame)):
-                INFO_DICT[function_id]["output"].append(log_dataframe_info(result))
-            elif isinstance(result, (tuple, list)):
-                for i, item in enumerate(result):
-                    if isinstance(item, (pd.DataFrame, pl.DataFrame)):
-                        INFO_DICT[function_id]["output"].append(
-                            log_dataframe_info(item)
-                        )
+    return return_string
 
-            return result
 
-        return wrapper
+def get_record_io(trace, record):
+    """
+    Get the inputs and outputs of a record, using the database tables as the input of
+    the extract functions and as the output of the insert functions
+    :param trace: A TraceStore with the information
+    :param record: A CallRecord
+    :return: A tuple with the lists of inputs and outputs
+    """
+    tables = [(table_name, trace.tables[table_name]) for table_name in record.db_table]
+    function_type = trace.function(record)["type"]
+    if function_type == "extract":
+        return tables, record.output
+    elif function_type == "insert":
+        return record.input, tables
+    return record.input, record.output
 
-    return decorator
 
+# Function that counts the tokens of a text, set with set_tokenizer. By default the
+# tokens are estimated as one every four characters
+TOKENIZER = None
 
-def transform():
+
+def set_tokenizer(tokenizer):
     """
-    Decorator to log information about the function
-    :return: Decorator
+    Set the function used to count the tokens of the prompts
+    :param tokenizer: A function that returns the number of tokens of a string, e.g.
+        lambda text: len(encoding.encode(text)), or None to use the estimate
+    :return: None
     """
+    global TOKENIZER
+    TOKENIZER = tokenizer
 
-    def decorator(func):
-        @functools.wraps(func)
-        def wrapper(*args, **kwargs):
-            # Get the function ID and the arguments ID to obtain an unique ID
-            args_id = [id(arg) for arg in args]
-            args_id = "_".join(map(str, args_id))
-            function_id = str(id(func)) + "_" + args_id
-            INFO_DICT[function_id] = {}
-
-            # Get information about the function
-            INFO_DICT[function_id]["name"] = func.__name__
-            INFO_DICT[function_id]["type"] = "transform"
-            INFO_DICT[function_id]["docstring"] = func.__doc__.replace("\n", " ")
-            INFO_DICT[function_id]["code"] = inspect.getsource(func).strip()
-            INFO_DICT[function_id]["db_table"] = []
-            INFO_DICT[function_id]["input"] = []
-            INFO_DICT[function_id]["output"] = []
-
-            # Log the input DataFrames
-            for i, arg in enumerate(args):
-                if isinstance(arg, (pd.DataFrame, pl.DataFrame)):
-                    INFO_DICT[function_id]["input"].append(log_dataframe_info(arg))
-
-            # Execute the function
-            result = func(*args, **kwargs)
-
-            # Log the returned DataFrames
-            if isinstance(result, (pd.DataFrame, pl.DataFrame)):
-                INFO_DICT[function_id]["output"].append(log_dataframe_info(result))
-            elif isinstance(result, (tuple, list)):
-                for i, item in enumerate(result):
-                    if isinstance(item, (pd.DataFrame, pl.DataFrame)):
-                        INFO_DICT[function_id]["output"].append(
-                            log_dataframe_info(item)
-                        )
 
-            return result
+def count_tokens(text):
+    """
+    Count the tokens of a text
+    :param text: A string
+    :return: An integer with the number of tokens
+    """
+    if TOKENIZER is not None:
+        return TOKENIZER(text)
+    return (len(text) + 3) // 4
 
-        return wrapper
 
-    return decorator
+def tokenizer_name():
+    """
+    Get the name of the function used to count the tokens of the prompts, so the
+    cached prompts are rebuilt when it changes
+    :return: A string with the module and name of the function, or None for the
+        estimate
+    """
+    if TOKENIZER is None:
+        return None
+    tokenizer = getattr(TOKENIZER, "func", TOKENIZER)
+    return ".".join(
+        str(getattr(tokenizer, attribute, type(tokenizer).__name__))
+        for attribute in ("__module__", "__qualname__")
+    )
 
 
-def insert(insert_table):
+def get_prompt_budget():
     """
-    Decorator to log information about the function
-    :param insert_table: A string or list of strings with the table names
-    :return: Decorator
+    Get the maximum number of tokens of a prompt, from the DOC_ETL_PROMPT_TOKENS
+    environment variable
+    :return: An integer with the number of tokens
     """
+    return int(os.environ.get("DOC_ETL_PROMPT_TOKENS") or 32000)
 
-    def decorator(func):
-        @functools.wraps(func)
-        def wrapper(*args, **kwargs):
-            # Get the function ID and the arguments ID to obtain an unique ID
-            args_id = [id(arg) for arg in args]
-            args_id = "_".join(map(str, args_id))
-            function_id = str(id(func)) + "_" + args_id
-            INFO_DICT[function_id] = {}
-
-            # Get information about the function
-            INFO_DICT[function_id]["name"] = func.__name__
-            INFO_DICT[function_id]["type"] = "insert"
-            INFO_DICT[function_id]["docstring"] = func.__doc__.replace("\n", " ")
-            INFO_DICT[function_id]["code"] = inspect.getsource(func).strip()
-            INFO_DICT[function_id]["input"] = []
-            INFO_DICT[function_id]["output"] = []
-
-            # Log the input DataFrames
-            for i, arg in enumerate(args):
-                if isinstance(arg, (pd.DataFrame, pl.DataFrame)):
-                    INFO_DICT[function_id]["input"].append(log_dataframe_info(arg))
-
-            # Execute the function
-            result = func(*args, **kwargs)
 
-            # Log the tables where the data is inserted
-            # TODO: Find a better way to handle getting the table schema
-            INFO_DICT[function_id]["db_table"] = []
-            if isinstance(insert_table, (list, tuple)):
-                for table in insert_table:
-                    INFO_DICT[function_id]["db_table"].append(get_table(table))
-            elif isinstance(insert_table, str):
-                INFO_DICT[function_id]["db_table"].append(get_table(insert_table))
+def summarize_code(code, max_lines=100, max_tokens=None):
+    """
+    Summarize the code of a function that is too long for the prompt, keeping its
+    first lines, the functions and methods it calls and what it returns
+    :param code: A string with the code
+    :param max_lines: An integer with the maximum number of lines
+    :param max_tokens: An integer with the maximum number of tokens, or None
+    :return: A string with the code or its summary
+    """
+    lines = code.splitlines()
+    too_long = max_tokens is not None and count_tokens(code) > max_tokens
+    if len(lines) <= max_lines and not too_long:
+        return code
+
+    head = lines[: max_lines // 2]
+    while (
+        max_tokens is not None
+        and head
+        and count_tokens("\n".join(head)) > max_tokens // 2
+    ):
+        head = head[: len(head) // 2]
 
-            return result
+    summary = head + [f"# ... {len(lines) - len(head)} more lines summarized ..."]
+    try:
+        tree = ast.parse(textwrap.dedent(code))
+    except SyntaxError:
+        return "\n".join(summary)
 
-        return wrapper
+    calls = {}
+    returns = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Call):
+            function = node.func
+            name = getattr(function, "id", None) or getattr(function, "attr", None)
+            if name:
+                calls.setdefault(name)
+        elif isinstance(node, ast.Return) and node.value is not None:
+            returns.append(ast.unparse(node.value)[:120])
 
-    return decorator
+    if calls:
+        summary.append(f"# Calls: {', '.join(calls)}")
+    summary += [f"# Returns: {value}" for value in dict.fromkeys(returns)]
+    return "\n".join(summary)
 
 
-def write_json(info_dict, path="doc_etl/raw.json"):
+def function_groups(trace, process=None):
     """
-    Write the dictionary to a JSON file
-    :param info_dict: A dictionary with the information
-    :return: None
+    Group the records by the code of their function, so a function is described once
+    regardless of the number of records. Functions without code are grouped by key
+    :param trace: A TraceStore with the information
+    :param process: A string with the function type to keep, or None for all
+    :return: A dictionary with the group keys and lists of tuples of the record ID
+        and the CallRecord, in the order they were recorded
     """
-    with open(path, "w") as f:
-        json.dump(info_dict, f, indent=4)
+    groups = collections.defaultdict(list)
+    for func_id, record in trace.items():
+        function_info = trace.function(record)
+        if process is not None and function_info["type"] != process:
+            continue
+        key = function_info["code_hash"] if function_info["code"] else record.function
+        groups[key].append((func_id, record))
+    return groups
 
 
-def write_mermaid(info_dict, path="doc_etl/mermaid.md"):
+def group_components(trace, groups):
     """
-    Write the dictionary to a Mermaid diagram
-    :param info_dict: A dictionary with the information
-    :param path: A string with the path to save the file
-    :return: None
+    Split the groups into connected subgraphs: two groups are connected if one uses a
+    DataFrame or database table of the other
+    :param trace: A TraceStore with the information
+    :param groups: A dictionary returned by function_groups
+    :return: A list with lists of group keys, in the order they were recorded
     """
+    parents = {key: key for key in groups}
 
-    string = """
-```mermaid
-graph TD
-
-    """
+    def find(key):
+        while parents[key] != key:
+            parents[key] = parents[parents[key]]
+            key = parents[key]
+        return key
 
-    for func_id, func_info in info_dict.items():
-        tables = func_info.get("db_table", [])
-        for table in tables:
-            for table_name, columns in table.items():
-                columns_string = "\n" + "\n".join([f"{column}" for column in columns])
-                label_columns = "_" + str(table_name) + "_" + str(columns_string)
-                label_string = str(table_name) + f'[("`{label_columns}`")]'
+    # Link the groups through the DataFrames and tables they share
+    owners = {}
+    for key, records in groups.items():
+        for _, record in records:
+            nodes = itertools.chain(
+                (label for label, _ in itertools.chain(record.input, record.output)),
+                (("table", table_name) for table_name in record.db_table),
+            )
+            for node in nodes:
+                owner = owners.setdefault(node, key)
+                parents[find(owner)] = find(key)
 
-                if func_info["type"] == "extract":
-                    string += f"{label_string} --> {func_id}[/{func_info['name']}/]\n"
-                elif func_info["type"] == "insert":
-                    string += f"{func_id}[/{func_info['name']}/] --> {label_string}\n"
+    components = collections.defaultdict(list)
+    for key in groups:
+        components[find(key)].append(key)
+    return list(components.values())
 
-        for input_df in func_info["input"]:
-            for label, info in input_df.items():
-                # If the number of columns is greater than 4, only show the first 3 and the last one
-                if len(info) > 4:
-                    columns_string = "\n".join(info[:3]) + "\n(...)\n " + info[-1]
-                else:
-                    columns_string = "\n" + "\n ".join(info)
-
-                label_columns = "_" + str(label) + "_" + columns_string
-                label_string = (
-                    str(label)
-                    + "@"
-                    + '{ shape: braces, label: "'
-                    + label_columns
-                    + '" }'
-                )
-                string += f"{label_string} --> {func_id}[/{func_info["name"]}/]\n"
 
-        for output_df in func_info["output"]:
-            for label, info in output_df.items():
-                # If the number of columns is greater than 4, only show the first 3 and the last one
-                if len(info) > 4:
-                    columns_string = "\n".join(info[:3]) + "\n(...)\n " + info[-1]
-                else:
-                    columns_string = "\n" + "\n ".join(info)
-
-                label_columns = "_" + str(label) + "_" + columns_string
-                label_string = (
-                    str(label)
-                    + "@"
-                    + '{ shape: braces, label: "'
-                    + label_columns
-                    + '" }'
-                )
-                string += f"{func_id}[/{func_info["name"]}/] --> {label_string}\n"
+def group_section(trace, records, code=False, max_code_tokens=None):
+    """
+    Write the section of a group of records of the same function
+    :param trace: A TraceStore with the information
+    :param records: A list with tuples of the record ID and the CallRecord
+    :param code: A boolean to include the code of the function
+    :param max_code_tokens: An integer with the maximum number of tokens of the code
+    :return: A string with the section
+    """
+    function_info = trace.function(records[0][1])
+    functions = {record.function: trace.function(record) for _, record in records}
+    inputs, outputs = {}, {}
+    for _, record in records:
+        record_inputs, record_outputs = get_record_io(trace, record)
+        inputs.update(record_inputs)
+        outputs.update(record_outputs)
 
-    string += "```"
+    calls = sum(
+        trace.call_counts.get(function)
+        or sum(record.count for _, record in records if record.function == function)
+        for function in functions
+    )
+    chunks = sum(trace.chunk_counts.get(function, 0) for function in functions)
+    names = ", ".join(dict.fromkeys(info["name"] for info in functions.values()))
 
-    with open(path, "w") as f:
-        f.write(string)
+    prompt = f"Type: {function_info['type']}\n\n"
+    prompt += f"Function: {names}\n\n"
+    prompt += f"Docstring: {function_info['docstring']}\n\n"
+    prompt += f"Calls: {calls}\n\n"
+    if chunks:
+        prompt += f"Chunks: {chunks}\n\n"
+    prompt += f"Input DataFrames:\n{convert_df_to_string(inputs.items())}\n\n"
+    prompt += f"Output DataFrames:\n{convert_df_to_string(outputs.items())}\n\n"
+    profiles = convert_profiles_to_string(
+        trace, itertools.chain(inputs.items(), outputs.items())
+    )
+    if code and profiles:
+        prompt += f"DataFrame Profiles:\n{profiles}\n"
+    if code:
+        function_code = summarize_code(
+            function_info["code"], max_tokens=max_code_tokens
+        )
+        prompt += f"Code:\n```\n{function_code}\n```\n\n"
+    return prompt
 
 
-def convert_df_to_string(dfs):
+def pack_prompt(header, sections, components, budget, split=False):
     """
-    Convert a list of DataFrames to a string
-    :param dfs: A list of DataFrames
-    :return: A string with the DataFrames
+    Join the sections into prompts of at most budget tokens, keeping the sections of
+    a connected subgraph in the same prompt when it fits
+    :param header: A string with the instructions repeated in each prompt
+    :param sections: A dictionary with the group keys and sections
+    :param components: A list with lists of group keys
+    :param budget: An integer with the maximum number of tokens of a prompt
+    :param split: A boolean to return the list of prompts instead of joining them
+    :return: A string with the prompts, or a list with the prompts if split
     """
-    return_string = ""
-    for dict_df in dfs:
-        for table_name, columns in dict_df.items():
-            columns_string = (
-                "\n - " + "\n - ".join([f"{column}" for column in columns]) + "\n"
-            )
-            return_string += f"{table_name}: {columns_string}\n"
+    available = budget - count_tokens(header)
+    parts = [[]]
+    used = 0
+    for component in components:
+        tokens = [count_tokens(sections[key]) for key in component]
+        if used and used + sum(tokens) > available:
+            parts.append([])
+            used = 0
 
-    return return_string
+        # A subgraph larger than the budget is split in the order it was recorded
+        for key, section_tokens in zip(component, tokens):
+            if used and used + section_tokens > available:
+                parts.append([])
+                used = 0
+            parts[-1].append(sections[key])
+            used += section_tokens
+
+    prompts = [header + "".join(part) for part in parts]
+    if split or len(prompts) == 1:
+        return prompts if split else prompts[0]
+    return "".join(
+        f"### Part {i} of {len(prompts)}\n\n" + prompt
+        for i, prompt in enumerate(prompts, 1)
+    )
 
 
-def write_intro_prompt(info_dict):
+def write_intro_prompt(trace, cache=None, budget=None, split=False):
     """
     Write the prompt for the introduction section
-    :param info_dict: A dictionary with the information
-    :return: A string with the prompt
+    :param trace: A TraceStore with the information
+    :param cache: A DocCache to reuse the sections of the unchanged functions
+    :param budget: An integer with the maximum number of tokens of a prompt, by
+        default from get_prompt_budget
+    :param split: A boolean to return the list of parts instead of joining them
+    :return: A string with the prompt, split in parts if it is over the budget
     """
+    budget = get_prompt_budget() if budget is None else budget
 
     prompt = """Please redact the introduction to the documentation for this ETL process, focusing on the different relationships between the various executions of the functions. This section should only be an introduction, as there will be specific sections made for extraction, transformations and insertions. The response should be structured with clear sections and titles, with an overall overview of the whole ETL process. The overall tone should be narrative, with long sentences that explain the flow and interconnectedness of the functions. Ensure that the output reflects the complexity of the process while being organized and easy to follow. The documentation should include:
 
@@ -323,33 +4638,32 @@ def write_intro_prompt(info_dict):
 
 Here you have a brief description of each function used, with the type of functions (extract, transform or insert),  the name of the function, the docstring of function, and the input and output DataFrames or database tables for each one:\n\n"""
 
-    # Iterate over the functions to get only the information needed
-    for func_id, func_info in info_dict.items():
-        input_key = "input"
-        output_key = "output"
-        if func_info["type"] == "extract":
-            input_key = "db_table"
-        elif func_info["type"] == "insert":
-            output_key = "db_table"
-
-        prompt += f"Type: {func_info["type"]}\n\n"
-        prompt += f"Function: {func_info["name"]}\n\n"
-        prompt += f"Docstring: {func_info["docstring"]}\n\n"
-        prompt += f"Input DataFrames:\n{convert_df_to_string(func_info[input_key])}\n\n"
-        prompt += (
-            f"Output DataFrames:\n{convert_df_to_string(func_info[output_key])}\n\n"
+    # Describe each function once, with the DataFrames of all its records
+    groups = function_groups(trace)
+    sections = {
+        key: cached(
+            cache,
+            ("intro", [record_digest(trace, record) for _, record in records]),
+            lambda: group_section(trace, records),
         )
-
-    return prompt
+        for key, records in groups.items()
+    }
+    components = group_components(trace, groups)
+    return pack_prompt(prompt, sections, components, budget, split)
 
 
-def write_process_prompt(info_dict, process):
+def write_process_prompt(trace, process, cache=None, budget=None, split=False):
     """
     Write the prompt for a specific process section
-    :param info_dict: A dictionary with the information
+    :param trace: A TraceStore with the information
     :param process: A string with the process type
-    :return: A string with the prompt
+    :param cache: A DocCache to reuse the sections of the unchanged functions
+    :param budget: An integer with the maximum number of tokens of a prompt, by
+        default from get_prompt_budget
+    :param split: A boolean to return the list of parts instead of joining them
+    :return: A string with the prompt, split in parts if it is over the budget
     """
+    budget = get_prompt_budget() if budget is None else budget
 
     prompt = f"""Please redact the documentation for the {process} part in this ETL process, focusing on the different relationships between the various executions of the functions. The response should be structured with clear sections and titles, each addressing specific aspects of the {process} process. The overall tone should be narrative, with long sentences that explain the flow and interconnectedness of the functions. Ensure that the output reflects the complexity of the process while being organized and easy to follow. The documentation should include:
 
@@ -359,44 +4673,36 @@ def write_process_prompt(info_dict, process):
 
 Here you have a description of each function used, with the type of functions (extract, transform or insert),  the name of the function, the docstring of function, the input and output DataFrames or database tables for each one, and the code for the function:\n"""
 
-    # Iterate over the functions to get only the information needed
-    for func_id, func_info in info_dict.items():
-        if func_info["type"] != process:
-            continue
-
-        input_key = "input"
-        output_key = "output"
-        if func_info["type"] == "extract":
-            input_key = "db_table"
-        elif func_info["type"] == "insert":
-            output_key = "db_table"
-
-        code = func_info["code"]
-        if len(code.splitlines()) > 100:
-            code = "***Code not included in prompt due to length.***"
-
-        prompt += f"Type: {func_info["type"]}\n\n"
-        prompt += f"Function: {func_info["name"]}\n\n"
-        prompt += f"Docstring: {func_info["docstring"]}\n\n"
-        prompt += f"Input DataFrames:\n{convert_df_to_string(func_info[input_key])}\n\n"
-        prompt += (
-            f"Output DataFrames:\n{convert_df_to_string(func_info[output_key])}\n\n"
+    # Describe each function once, with the DataFrames of all its records. The code
+    # of a function can use up to a quarter of the budget before it is summarized
+    groups = function_groups(trace, process)
+    sections = {
+        key: cached(
+            cache,
+            (
+                "process",
+                budget,
+                tokenizer_name(),
+                [record_digest(trace, record) for _, record in records],
+            ),
+            lambda: group_section(trace, records, True, budget // 4),
         )
-        prompt += f"Code:\n```\n{code}\n```\n\n"
-
-    return prompt
+        for key, records in groups.items()
+    }
+    components = group_components(trace, groups)
+    return pack_prompt(prompt, sections, components, budget, split)
 
 
-def write_prompt(info_dict):
+def write_prompt(trace, cache=None):
     title = "# Prompts for ETL Documentation\n\n"
     intro_title = "## Introduction\n\n"
-    intro = write_intro_prompt(info_dict)
+    intro = write_intro_prompt(trace, cache)
     extract_title = "## Extract\n\n"
-    extract = write_process_prompt(info_dict, "extract")
+    extract = write_process_prompt(trace, "extract", cache)
     transform_title = "## Transform\n\n"
-    transform = write_process_prompt(info_dict, "transform")
+    transform = write_process_prompt(trace, "transform", cache)
     insert_title = "## Insert\n\n"
-    insert = write_process_prompt(info_dict, "insert")
+    insert = write_process_prompt(trace, "insert", cache)
 
     with open("doc_etl/prompt.md", "w") as f:
         f.write(title)
@@ -410,104 +4716,693 @@ def write_prompt(info_dict):
         f.write(insert)
 
 
-def find_dataframe_keys(data):
+def prompt_parts(trace, cache=None):
     """
-    Find the keys in a dictionary that start with "DataFrame_"
-    :param data: A dictionary
-    :return: A set with the keys
+    Get the prompts of each section of the documentation, with the parts of the
+    prompts over the budget. The processes without functions are skipped
+    :param trace: A TraceStore with the information
+    :param cache: A DocCache to reuse the sections of the unchanged functions
+    :return: A dictionary with the section titles and lists of prompts
     """
-    unique_dataframes = set()
+    parts = {"Introduction": write_intro_prompt(trace, cache, split=True)}
+    for process in ("extract", "transform", "insert"):
+        if function_groups(trace, process):
+            parts[process.capitalize()] = write_process_prompt(
+                trace, process, cache, split=True
+            )
+    return parts
+
 
-    # Recursive function to traverse the dictionary
-    def extract_dataframes(d):
-        if isinstance(d, dict):
-            for key, value in d.items():
-                if isinstance(key, str) and key.startswith("DataFrame_"):
-                    # Add key to the set
-                    unique_dataframes.add(key)
-                if isinstance(value, (str, list, dict)):
-                    # Recurse into substructures
-                    extract_dataframes(value)
-        elif isinstance(d, list):
-            for item in d:
-                extract_dataframes(item)
+class LLMError(Exception):
+    """
+    Error of a documentation backend. The retryable errors are sent again
+    """
 
-    extract_dataframes(data)
-    return unique_dataframes
+    def __init__(self, message, retryable=True):
+        super().__init__(message)
+        self.retryable = retryable
 
 
-def apply_substitutions(original_dict, substitutions_dict):
+class LLMBackend:
     """
-    Apply substitutions to the keys of a dictionary
-    :param original_dict: A dictionary to make substitutions
-    :param substitutions_dict: A dictionary with the substitutions
-    :return: The dictionary with the substitutions
+    Backend that writes the documentation from the prompts. The name is part of the
+    keys of the response cache, so the responses of different models are not mixed
     """
 
-    def recursive_replace(d):
-        if isinstance(d, dict):
-            return {
-                substitutions_dict.get(k, k): recursive_replace(v) for k, v in d.items()
-            }
-        elif isinstance(d, list):
-            return [recursive_replace(i) for i in d]
-        else:
-            return d
+    name = "base"
 
-    return recursive_replace(original_dict)
+    async def complete(self, prompt):
+        """
+        Get the response of the model to a prompt
+        :param prompt: A string with the prompt
+        :return: A string with the response
+        """
+        raise NotImplementedError
 
 
-def correct_df_names():
+class LocalBackend(LLMBackend):
     """
-    Correct the names of the DataFrames in the dictionary
-    :return: A dictionary with the corrected names
+    Deterministic backend that lists the functions described in the prompt, without
+    a model. It is used to test the documentation stage offline
     """
-    path = "doc_etl/temp_mermaid.md"
-    write_mermaid(INFO_DICT, path)
 
-    unique_dataframes = find_dataframe_keys(INFO_DICT)
+    name = "local"
+
+    async def complete(self, prompt):
+        """
+        Write a section for each function described in the prompt
+        :param prompt: A string with the prompt
+        :return: A string with the response
+        """
+        sections = []
+        for block in prompt.split("\nType: ")[1:]:
+            lines = block.splitlines()
+            fields = dict(
+                line.split(": ", 1)
+                for line in lines
+                if line.startswith(("Function: ", "Docstring: ", "Calls: "))
+            )
+            frames = {"Input DataFrames:": [], "Output DataFrames:": []}
+            current = None
+            for line in lines:
+                if line in frames:
+                    current = frames[line]
+                elif line.startswith(("DataFrame Profiles:", "Code:")):
+                    current = None
+                elif current is not None and line.endswith(": "):
+                    current.append(line[:-2])
+
+            section = f"### {fields.get('Function', '')} ({lines[0]})\n\n"
+            if fields.get("Docstring", "").strip():
+                section += fields["Docstring"].strip() + "\n\n"
+            section += f"- Calls: {fields.get('Calls', 0)}\n"
+            inputs, outputs = frames.values()
+            section += f"- Reads: {', '.join(inputs) or '-'}\n"
+            section += f"- Writes: {', '.join(outputs) or '-'}\n"
+            sections.append(section)
+        return "\n".join(sections)
 
-    substitutions = {}
-    for dataframe in unique_dataframes:
-        user_input = input(f"Enter substitution for {dataframe}: ")
-        substitutions[dataframe] = user_input
 
-    print("Substitutions:")
-    for dataframe, substitution in substitutions.items():
-        print(f"{dataframe} -> {substitution}")
+class HTTPBackend(LLMBackend):
+    """
+    Backend of a chat completions API compatible with OpenAI. The requests are sent
+    with urllib in threads, so no client library is needed
+    """
 
-    new_info_dict = apply_substitutions(INFO_DICT, substitutions)
+    def __init__(self, url, model, api_key=None, timeout=300):
+        self.url = url
+        self.model = model
+        self.api_key = api_key
+        self.timeout = timeout
+        self.name = f"http:{model}"
 
-    return new_info_dict
+    @classmethod
+    def from_env(cls):
+        """
+        Build the backend from the DOC_ETL_LLM_URL, DOC_ETL_LLM_MODEL and
+        DOC_ETL_LLM_API_KEY environment variables
+        :return: An HTTPBackend
+        """
+        model = os.environ.get("DOC_ETL_LLM_MODEL")
+        if not model:
+            raise ValueError("DOC_ETL_LLM_MODEL is required by the http backend")
+        return cls(
+            os.environ.get("DOC_ETL_LLM_URL")
+            or "https://api.openai.com/v1/chat/completions",
+            model,
+            os.environ.get("DOC_ETL_LLM_API_KEY"),
+        )
 
+    def request(self, prompt):
+        """
+        Send a prompt to the API
+        :param prompt: A string with the prompt
+        :return: A string with the response
+        """
+        import urllib.error
+        import urllib.request
 
-def write():
+        body = {"model": self.model, "messages": [{"role": "user", "content": prompt}]}
+        headers = {"Content-Type": "application/json"}
+        if self.api_key:
+            headers["Authorization"] = f"Bearer {self.api_key}"
+        request = urllib.request.Request(self.url, json.dumps(body).encode(), headers)
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                data = json.load(response)
+        except urllib.error.HTTPError as error:
+            # Only the rate limits and the server errors can succeed if sent again
+            retryable = error.code == 429 or error.code >= 500
+            raise LLMError(f"HTTP {error.code} from {self.url}", retryable) from error
+        return data["choices"][0]["message"]["content"]
+
+    async def complete(self, prompt):
+        """
+        Get the response of the model to a prompt. The request is sent in a plain
+        thread instead of the executor of the event loop, which can not be used in
+        the exit handler that writes the documentation
+        :param prompt: A string with the prompt
+        :return: A string with the response
+        """
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def settle(method, value):
+            # The request can outlive a timeout, and then nobody waits for it
+            if not future.done():
+                method(value)
+
+        def run():
+            try:
+                response = self.request(prompt)
+            except BaseException as error:
+                result = (future.set_exception, error)
+            else:
+                result = (future.set_result, response)
+            try:
+                loop.call_soon_threadsafe(settle, *result)
+            except RuntimeError:
+                pass
+
+        threading.Thread(target=run, daemon=True).start()
+        return await future
+
+
+def make_llm_backend(name):
     """
-    Write the documentation files
+    Build a documentation backend by its name
+    :param name: A string with the name, "local" or "http"
+    :return: An LLMBackend
+    """
+    if name == "local":
+        return LocalBackend()
+    if name == "http":
+        return HTTPBackend.from_env()
+    raise ValueError(f"Unknown documentation backend: {name}")
+
+
+LLM_BACKEND = None
+
+
+def set_llm_backend(backend):
+    """
+    Set the backend used to write the documentation from the prompts
+    :param backend: An LLMBackend, or None to use the DOC_ETL_LLM environment variable
     :return: None
     """
+    global LLM_BACKEND
+    LLM_BACKEND = backend
+
+
+def get_llm_backend():
+    """
+    Get the backend used to write the documentation, set with set_llm_backend or
+    from the DOC_ETL_LLM environment variable ("local" or "http")
+    :return: An LLMBackend, or None to only write the prompts
+    """
+    if LLM_BACKEND is not None:
+        return LLM_BACKEND
+    name = os.environ.get("DOC_ETL_LLM", "").lower()
+    if not name:
+        return None
+    try:
+        return make_llm_backend(name)
+    except ValueError as error:
+        warnings.warn(f"The documentation is not written: {error}")
+        return None
+
+
+class ResponseCache:
+    """
+    Cache of the responses of the backends, with a file per response named by the
+    hash of the backend name and the prompt, so an unchanged prompt is not sent again
+    """
+
+    def __init__(self, path="doc_etl/responses"):
+        self.path = path
+
+    def file(self, key):
+        """
+        Get the path of the file of a response
+        :param key: A string with the hash of the prompt
+        :return: A string with the path
+        """
+        return os.path.join(self.path, key + ".md")
+
+    def get(self, key):
+        """
+        Get a cached response
+        :param key: A string with the hash of the prompt
+        :return: A string with the response, or None if it is not cached
+        """
+        try:
+            with open(self.file(key)) as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def set(self, key, response):
+        """
+        Save a response. The file is replaced at once, so an interrupted run does not
+        leave a partial response
+        :param key: A string with the hash of the prompt
+        :param response: A string with the response
+        :return: None
+        """
+        os.makedirs(self.path, exist_ok=True)
+        temporary = f"{self.file(key)}.{os.getpid()}.tmp"
+        with open(temporary, "w") as f:
+            f.write(response)
+        os.replace(temporary, self.file(key))
 
-    def create_folder_structure(folder_structure):
+    def prune(self, keys):
         """
-        Create a folder structure if it does not exist
-        :param List folder_structure: List of folders to create
+        Remove the responses of the prompts that are no longer used
+        :param keys: An iterable with the hashes of the prompts in use
         :return: None
         """
-        _ = [os.makedirs(path, exist_ok=True) for path in folder_structure]
+        keep = {key + ".md" for key in keys}
+        if not os.path.isdir(self.path):
+            return
+        for entry in os.scandir(self.path):
+            if entry.name.endswith(".md") and entry.name not in keep:
+                os.remove(entry.path)
+
+
+async def dispatch_prompts(
+    prompts, backend, cache=None, concurrency=4, retries=3, backoff=1.0, timeout=None
+):
+    """
+    Send the prompts to a backend concurrently. The cached and repeated prompts are
+    not sent, and the failed requests are retried with exponential backoff
+    :param prompts: A list with the prompts
+    :param backend: An LLMBackend
+    :param cache: A ResponseCache, or None
+    :param concurrency: An integer with the maximum number of requests in flight
+    :param retries: An integer with the number of retries of a failed request
+    :param backoff: A float with the seconds to wait before the first retry, doubled
+        on each retry
+    :param timeout: A float with the seconds to wait for a response, or None
+    :return: A list with the responses, or the exceptions of the prompts that failed,
+        in the order of the prompts
+    """
+    import asyncio
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def send(prompt):
+        key = content_hash(backend.name, prompt)
+        response = cache.get(key) if cache is not None else None
+        if response is not None:
+            return response
+
+        for attempt in range(retries + 1):
+            try:
+                async with semaphore:
+                    coroutine = backend.complete(prompt)
+                    response = await asyncio.wait_for(coroutine, timeout)
+                break
+            except (OSError, asyncio.TimeoutError, LLMError) as error:
+                if attempt == retries or not getattr(error, "retryable", True):
+                    raise
+            # The wait is outside the semaphore, so other prompts are sent meanwhile
+            await asyncio.sleep(backoff * 2**attempt * (1 + random.random()))
+
+        if cache is not None:
+            cache.set(key, response)
+        return response
+
+    unique = list(dict.fromkeys(prompts))
+    results = await asyncio.gather(
+        *(send(prompt) for prompt in unique), return_exceptions=True
+    )
+    results = dict(zip(unique, results))
+    return [results[prompt] for prompt in prompts]
+
+
+def run_coroutine(coroutine):
+    """
+    Run a coroutine to completion, in a new thread if an event loop is already
+    running in this one (e.g. in a notebook)
+    :param coroutine: A coroutine
+    :return: The result of the coroutine
+    """
+    import asyncio
+
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+
+    # A plain thread, since the executors can not be used in the exit handler
+    result = {}
+
+    def run():
+        try:
+            result["value"] = asyncio.run(coroutine)
+        except BaseException as error:
+            result["error"] = error
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    thread.join()
+    if "error" in result:
+        raise result["error"]
+    return result["value"]
+
+
+def write_documentation(
+    trace, backend, cache=None, responses=None, path="doc_etl/documentation.md"
+):
+    """
+    Write the documentation with the responses of a backend to the prompts. The
+    limits of the requests are set with the DOC_ETL_LLM_CONCURRENCY,
+    DOC_ETL_LLM_RETRIES and DOC_ETL_LLM_TIMEOUT environment variables
+    :param trace: A TraceStore with the information
+    :param backend: An LLMBackend
+    :param cache: A DocCache to reuse the sections of the unchanged functions
+    :param responses: A ResponseCache, by default in doc_etl/responses
+    :param path: A string with the path to save the file
+    :return: A boolean, False if some prompts failed
+    """
+    responses = ResponseCache() if responses is None else responses
+    parts = prompt_parts(trace, cache)
+    prompts = [prompt for section in parts.values() for prompt in section]
+    timeout = os.environ.get("DOC_ETL_LLM_TIMEOUT")
+    results = run_coroutine(
+        dispatch_prompts(
+            prompts,
+            backend,
+            responses,
+            concurrency=int(os.environ.get("DOC_ETL_LLM_CONCURRENCY") or 4),
+            retries=int(os.environ.get("DOC_ETL_LLM_RETRIES") or 3),
+            timeout=float(timeout) if timeout else None,
+        )
+    )
+
+    results = iter(results)
+    failed = 0
+    with open(path, "w") as f:
+        f.write("# ETL Documentation\n\n")
+        for title, section in parts.items():
+            f.write(f"## {title}\n\n")
+            for _ in section:
+                result = next(results)
+                if isinstance(result, BaseException):
+                    failed += 1
+                    f.write(f"_This part could not be written: {result!r}_\n\n")
+                else:
+                    f.write(result.strip() + "\n\n")
+
+    if failed:
+        warnings.warn(f"{failed} of {len(prompts)} documentation prompts failed")
+        return False
+    responses.prune(content_hash(backend.name, prompt) for prompt in prompts)
+    return True
+
+
+def frame_keys(trace):
+    """
+    Get a key for each DataFrame label that does not depend on the run, made of the
+    function that returned the DataFrame (or received it, for the DataFrames that are
+    not returned by a decorated function), its position, its schema fingerprint and
+    the index of the DataFrame among the ones with the same function, position and
+    fingerprint, e.g. when a function is called in a loop
+    :param trace: A TraceStore with the information
+    :return: A dictionary with the DataFrame labels and keys
+    """
+    keys = {}
+    indexes = collections.Counter()
+    for label in trace.labels():
+        occurrences = trace.occurrences(label)
+        record, direction, position = next(
+            (item for item in occurrences if item[1] == "output"), occurrences[0]
+        )
+        fingerprint = trace.frames.get(label, (None, None))[0]
+        key = f"{record.function}:{direction}:{position}:{fingerprint}"
+        keys[label] = f"{key}:{indexes[key]}"
+        indexes[key] += 1
+    return keys
+
+
+def load_names(path="doc_etl/names.json"):
+    """
+    Load the names given to the DataFrames in previous runs. The file can be edited
+    to rename a DataFrame
+    :param path: A string with the path of the mapping file
+    :return: A dictionary with the DataFrame keys and names
+    """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_names(names, path="doc_etl/names.json"):
+    """
+    Save the names given to the DataFrames
+    :param names: A dictionary with the DataFrame keys and names
+    :param path: A string with the path of the mapping file
+    :return: None
+    """
+    with open(path, "w") as f:
+        json.dump(names, f, indent=4, sort_keys=True)
+
+
+def frame_names(trace, names=None):
+    """
+    Name the DataFrames of the trace in a single pass. A DataFrame keeps the name of
+    a previous run; otherwise it gets the name of the variable it was assigned to or
+    of the parameter it was passed as, and else the name of its function. Repeated
+    new names get a numeric suffix
+    :param trace: A TraceStore with the information
+    :param names: A dictionary with the names given in previous runs, by DataFrame key,
+        which is updated with the new names
+    :return: A dictionary with the DataFrame labels and names
+    """
+    names = {} if names is None else names
+    keys = frame_keys(trace)
+
+    # Two DataFrames never get the same name, even if the mapping file was edited
+    substitutions = {}
+    taken = set()
+    for label, key in keys.items():
+        name = names.get(key)
+        if name and name not in taken:
+            substitutions[label] = name
+            taken.add(name)
+    suffixes = collections.Counter()
+
+    for label, key in keys.items():
+        if label in substitutions:
+            continue
+
+        name = trace.names.get(label)
+        if not name:
+            function, direction, position, _, _ = key.rsplit(":", 4)
+            name = f"{trace.functions[function]['name']}_{direction}"
+            if position != "0":
+                name += f"_{int(position) + 1}"
+
+        unique_name = name
+        while unique_name in taken:
+            suffixes[name] += 1
+            unique_name = f"{name}_{suffixes[name] + 1}"
+        taken.add(unique_name)
+        substitutions[label] = names[key] = unique_name
+
+    return substitutions
+
+
+def correct_df_names(trace, substitutions):
+    """
+    Correct the names of the DataFrames in the trace, in place
+    :param trace: A TraceStore with the information
+    :param substitutions: A dictionary with the DataFrame labels and names
+    :return: The TraceStore with the corrected names
+    """
+    trace.rename(substitutions)
+    return trace
+
+
+def create_folder_structure(folder_structure):
+    """
+    Create a folder structure if it does not exist
+    :param List folder_structure: List of folders to create
+    :return: None
+    """
+    _ = [os.makedirs(path, exist_ok=True) for path in folder_structure]
+
 
+def write_docs(trace):
+    """
+    Write the documentation files of a trace
+    :param trace: A TraceStore with the information
+    :return: None
+    """
     folder_structure = ["doc_etl"]
     create_folder_structure(folder_structure)
 
-    new_info_dict = correct_df_names()
+    names = load_names()
+    substitutions = frame_names(trace, names)
+    save_names(names)
+
+    # Skip the writing when the trace, the names and the documentation did not change
+    cache = DocCache()
+    backend = get_llm_backend()
+    backend_name = backend.name if backend is not None else None
+    columns = os.environ.get("DOC_ETL_COLUMN_LINEAGE", "").lower() in (
+        "1",
+        "true",
+        "yes",
+        "on",
+    )
+    digest = content_hash(
+        trace_digest(trace),
+        substitutions,
+        backend_name,
+        get_prompt_budget(),
+        tokenizer_name(),
+        get_mermaid_max_nodes(),
+    )
+    outputs = ["doc_etl/raw.json", "doc_etl/mermaid.md", "doc_etl/prompt.md"]
+    if trace.metrics:
+        outputs.append("doc_etl/metrics.md")
+    columnar = get_columnar_format()
+    if columnar is not None:
+        outputs.append(f"doc_etl/trace/calls{COLUMNAR_FORMATS[columnar]}")
+    if backend is not None:
+        outputs.append("doc_etl/documentation.md")
+    if columns:
+        outputs.append("doc_etl/column_lineage.md")
+    if digest == cache.digest and all(os.path.exists(path) for path in outputs):
+        print("Doc ETL documentation is up to date. Check './doc_etl' for details.")
+        return
 
-    print(new_info_dict)
+    new_trace = correct_df_names(trace, substitutions)
 
-    write_json(new_info_dict)
-    write_mermaid(new_info_dict)
-    write_prompt(new_info_dict)
+    write_json(new_trace)
+    write_mermaid(new_trace)
+    write_prompt(new_trace, cache)
+    if new_trace.metrics:
+        write_metrics(new_trace)
+    if columnar is not None:
+        write_columnar(new_trace, format=columnar)
+    if columns:
+        write_column_mermaid(new_trace)
+    # The digest is not saved when some prompts failed, so they are sent again
+    if backend is not None and not write_documentation(new_trace, backend, cache):
+        digest = None
+    cache.save(digest)
 
     print("Doc ETL process completed. Check './doc_etl' for details.")
 
 
+def write():
+    """
+    Write the documentation files
+    :return: None
+    """
+    # Only the parent process writes the documentation
+    if is_worker():
+        flush()
+        if SPOOL is not None:
+            SPOOL.close()
+        return
+
+    trace = flush()
+    if JOURNAL is not None:
+        JOURNAL.close()
+        if os.path.exists(JOURNAL.path):
+            trace = read_journal(JOURNAL.path, trace)
+    if MULTIPROCESS:
+        merge_spools(trace)
+
+    write_docs(trace)
+
+    history = get_history_path()
+    if history is not None:
+        record_history(trace, history)
+
+
+def regenerate(path="doc_etl/journal.jsonl"):
+    """
+    Write the documentation files from a journal, which can be partial, or from the
+    folder of a columnar export
+    :param path: A string with the path of the journal or the folder
+    :return: None
+    """
+    if os.path.isdir(path):
+        write_docs(read_columnar(path))
+    else:
+        write_docs(read_journal(path))
+
+
+def main(argv=None):
+    """
+    Command line entry point
+    :param argv: A list with the command line arguments
+    :return: An integer with the exit code
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="doc_etl", description="Doc ETL tools")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    regenerate_parser = commands.add_parser(
+        "regenerate", help="Write the documentation from a journal or columnar export"
+    )
+    regenerate_parser.add_argument("path", nargs="?", default="doc_etl/journal.jsonl")
+    regenerate_parser.add_argument(
+        "--llm",
+        choices=("local", "http"),
+        help="Write documentation.md with the responses of this backend",
+    )
+
+    history_parser = commands.add_parser(
+        "history", help="Compare the runs recorded in the history database"
+    )
+    history_parser.add_argument("--db", default="doc_etl/history.sqlite")
+    history_commands = history_parser.add_subparsers(
+        dest="history_command", required=True
+    )
+    runs_parser = history_commands.add_parser("runs", help="List the recorded runs")
+    runs_parser.add_argument("--limit", type=int, default=20)
+    for name, help in (
+        ("changes", "What changed since a run"),
+        ("columns", "Which columns appeared or disappeared since a run"),
+        ("slower", "Which functions got slower since a run"),
+    ):
+        command_parser = history_commands.add_parser(name, help=help)
+        command_parser.add_argument(
+            "since", type=int, help="Run ID, or a negative number of runs back"
+        )
+        command_parser.add_argument("--until", type=int, help="Run ID, or the latest")
+        if name == "slower":
+            command_parser.add_argument("--metric", default="wall_p50")
+            command_parser.add_argument("--threshold", type=float, default=1.2)
+
+    args = parser.parse_args(argv)
+    if args.command == "history":
+        try:
+            print_history(args)
+        except ValueError as error:
+            parser.error(str(error))
+    elif args.command == "regenerate":
+        if args.llm:
+            set_llm_backend(make_llm_backend(args.llm))
+        regenerate(args.path)
+    return 0
+
+
 # Register the write function to be executed at the end of the script
-atexit.register(write)
+if ENABLED:
+    atexit.register(write)
+
+if __name__ == "__main__":
+    # The command line tools do not trace a pipeline
+    atexit.unregister(write)
+    sys.exit(main())
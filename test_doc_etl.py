@@ -0,0 +1,1308 @@
+import collections
+import http.server
+import io
+import json
+import multiprocessing
+import os
+import sqlite3
+import subprocess
+import sys
+import threading
+import types
+import warnings
+
+import pytest
+
+# The tests build their own traces, so importing the module must not trace anything
+# or write the documentation of the test session at exit
+os.environ["DOC_ETL_DISABLED"] = "1"
+
+import doc_etl  # noqa: E402
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+FUNCTIONS = {
+    "etl.read": {"name": "read", "type": "extract", "docstring": "", "code_hash": "1"},
+    "etl.clean": {
+        "name": "clean",
+        "type": "transform",
+        "docstring": "",
+        "code_hash": "2",
+    },
+}
+
+PIPELINE = """
+import pandas as pd
+
+from doc_etl import extract, transform
+
+
+@extract("SOURCE")
+def read_part(index):
+    \"\"\"Read a partition.\"\"\"
+    return pd.DataFrame({"id": [index], "value": [index * 2]})
+
+
+@transform()
+def double(part):
+    \"\"\"Double the values of a partition.\"\"\"
+    return part.assign(value=part["value"] * 2)
+
+
+for index in range(3):
+    part = read_part(index)
+    doubled = double(part)
+"""
+
+
+MULTIPROCESS_PIPELINE = """
+import multiprocessing
+import subprocess
+import sys
+
+import pandas as pd
+
+import doc_etl
+from doc_etl import extract, insert, transform
+
+
+@extract("SOURCE")
+def read_part(index):
+    \"\"\"Read a partition.\"\"\"
+    return pd.DataFrame({"id": [index], "value": [index * 2]})
+
+
+@transform()
+def double(part):
+    \"\"\"Double the values of a partition.\"\"\"
+    return part.assign(value=part["value"] * 2)
+
+
+@insert("TARGET")
+def save(doubled):
+    \"\"\"Save a partition.\"\"\"
+
+
+if __name__ == "__main__":
+    doc_etl.enable_multiprocess()
+    parts = [read_part(index) for index in range(2)]
+    with multiprocessing.get_context(sys.argv[1]).Pool(2) as pool:
+        for doubled in pool.map(double, parts):
+            save(doubled)
+
+    # The other programs run by the pipeline are not workers
+    check = "import doc_etl, sys; doc_etl.disable(); sys.exit(doc_etl.is_worker())"
+    subprocess.run([sys.executable, "-c", check], check=True)
+"""
+
+
+CONCURRENT_PIPELINE = """
+import asyncio
+import concurrent.futures
+
+import pandas as pd
+
+from doc_etl import extract, insert, transform
+
+
+@extract("SOURCE")
+async def read_part(index):
+    \"\"\"Read a partition.\"\"\"
+    await asyncio.sleep(0)
+    return pd.DataFrame({"id": [index, index], "value": [index, index * 2]})
+
+
+@transform()
+async def split(part):
+    \"\"\"Split a partition into its rows.\"\"\"
+    for row in range(len(part)):
+        await asyncio.sleep(0)
+        yield part.iloc[[row]]
+
+
+@transform()
+def double(part):
+    \"\"\"Double the values of a row.\"\"\"
+    return part.assign(value=part["value"] * 2)
+
+
+@insert("TARGET")
+def save(doubled):
+    \"\"\"Save a row.\"\"\"
+
+
+async def main():
+    parts = await asyncio.gather(*(read_part(index) for index in range(8)))
+    rows = [row for part in parts async for row in split(part)]
+    with concurrent.futures.ThreadPoolExecutor(4) as executor:
+        doubled = list(executor.map(double, rows))
+    await asyncio.gather(*(asyncio.to_thread(save, row) for row in doubled))
+
+
+asyncio.run(main())
+"""
+
+
+STREAM_PIPELINE = """
+import csv
+
+import pandas as pd
+import polars as pl
+
+from doc_etl import extract, transform
+
+pd.DataFrame({"id": range(5), "value": range(5)}).to_csv("source.csv", index=False)
+
+
+@extract("SOURCE")
+def read_chunks(path):
+    \"\"\"Read a CSV file in chunks.\"\"\"
+    return pd.read_csv(path, chunksize=2)
+
+
+@extract("SOURCE")
+def read_rows(path):
+    \"\"\"Read the rows of a CSV file.\"\"\"
+    return csv.reader(open(path))
+
+
+@transform()
+def lazy_double(frame):
+    \"\"\"Double the values of a LazyFrame.\"\"\"
+    return frame.with_columns(double=pl.col("value") * 2)
+
+
+@transform()
+def values(frames):
+    \"\"\"Get the values of the frames.\"\"\"
+    return map(len, frames)
+
+
+reader = read_chunks("source.csv")
+first = reader.get_chunk()
+chunks = [first, *reader]
+assert sum(map(len, chunks)) == 5
+
+rows = read_rows("source.csv")
+assert type(rows).__name__ == "reader" and next(rows) == ["id", "value"]
+assert type(values(chunks)) is map
+
+lazy = lazy_double(pl.LazyFrame({"id": [1], "value": [2]}))
+assert isinstance(lazy, pl.LazyFrame)
+"""
+
+
+def run_pipeline(path, source=PIPELINE, args=(), **environ):
+    """
+    Run a test pipeline in a new process, which writes its documentation at exit
+    :param path: A path with the working directory of the process
+    :param source: A string with the code of the pipeline
+    :param args: A tuple with the arguments of the pipeline
+    :param environ: The extra environment variables of the process
+    :return: None
+    """
+    (path / "pipeline.py").write_text(source)
+    env = {key: value for key, value in os.environ.items() if key != "DOC_ETL_DISABLED"}
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [ROOT, env.get("PYTHONPATH")]))
+    env.update(environ)
+    subprocess.run(
+        [sys.executable, "pipeline.py", *args],
+        cwd=path,
+        env=env,
+        check=True,
+        timeout=120,
+    )
+
+
+class CompletionHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Handler of a chat completions API that answers every prompt with its length
+    """
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        prompt = body["messages"][0]["content"]
+        content = json.dumps(
+            {"choices": [{"message": {"content": f"Answer to {len(prompt)}"}}]}
+        ).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def test_http_backend_at_exit(tmp_path):
+    pytest.importorskip("pandas")
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), CompletionHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        run_pipeline(
+            tmp_path,
+            DOC_ETL_LLM="http",
+            DOC_ETL_LLM_MODEL="test",
+            DOC_ETL_LLM_URL=f"http://127.0.0.1:{server.server_address[1]}/",
+            DOC_ETL_LLM_RETRIES="0",
+        )
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    documentation = (tmp_path / "doc_etl" / "documentation.md").read_text()
+    assert "Answer to" in documentation
+    assert "could not be written" not in documentation
+
+
+@pytest.mark.parametrize("method", ["fork", "spawn", "forkserver"])
+def test_multiprocess_lineage(tmp_path, method):
+    pytest.importorskip("pandas")
+    if method not in multiprocessing.get_all_start_methods():
+        pytest.skip(f"The {method} start method is not available")
+    run_pipeline(tmp_path, MULTIPROCESS_PIPELINE, (method,))
+
+    # The DataFrames sent to and from the workers keep their labels
+    trace = json.loads((tmp_path / "doc_etl" / "raw.json").read_text())
+    inputs, outputs = collections.defaultdict(set), collections.defaultdict(set)
+    for call in trace["calls"].values():
+        name = call["function"].rsplit(".", 1)[1]
+        inputs[name].update(label for frame in call["input"] for label in frame)
+        outputs[name].update(label for frame in call["output"] for label in frame)
+    assert len(inputs["double"]) == 2
+    assert inputs["double"] == outputs["read_part"]
+    assert inputs["save"] == outputs["double"]
+    assert not (tmp_path / "doc_etl" / "spool").exists()
+
+
+def frame(label, columns, name=None):
+    """
+    Build the FrameInfo of a test DataFrame
+    :param label: A string with the DataFrame label
+    :param columns: A tuple with the column names
+    :param name: A string with the DataFrame name, or None
+    :return: A FrameInfo
+    """
+    dtypes = ("int64",) * len(columns)
+    fingerprint = doc_etl.schema_fingerprint(columns, dtypes)
+    return doc_etl.FrameInfo(label, columns, fingerprint, dtypes, 3, 24, name)
+
+
+def build_trace():
+    """
+    Build a trace with a read and two cleans of its DataFrame
+    :return: A TraceStore
+    """
+    trace = doc_etl.TraceStore(functions=dict(FUNCTIONS))
+    trace.add_table("orders", ["id", "amount"])
+    raw = frame("DataFrame_1", ("id", "amount"), "raw")
+    trace.add_call("etl.read", ["orders"], [], [raw])
+    trace.add_call("etl.clean", [], [raw], [frame("DataFrame_2", ("id",), "clean")])
+    trace.add_call("etl.clean", [], [raw], [frame("DataFrame_3", ("id",))])
+    trace.call_counts.update({"etl.read": 1, "etl.clean": 2})
+    return trace
+
+
+def test_trace_round_trip():
+    trace = build_trace()
+    trace.rename(
+        {
+            "DataFrame_1": "raw",
+            "DataFrame_2": "DataFrame_3",
+            "DataFrame_3": "DataFrame_2",
+        }
+    )
+
+    assert "DataFrame_1" not in trace.labels()
+    assert [direction for _, direction, _ in trace.occurrences("raw")] == [
+        "output",
+        "input",
+        "input",
+    ]
+    data = json.loads(json.dumps(trace.to_dict()))
+    assert data["frames"]["raw"]["name"] == "raw"
+    assert data["frames"]["DataFrame_3"]["name"] == "clean"
+    assert [call["output"] for call in data["calls"].values()] == [
+        [{"raw": ["id", "amount"]}],
+        [{"DataFrame_3": ["id"]}],
+        [{"DataFrame_2": ["id"]}],
+    ]
+    assert doc_etl.TraceStore.from_dict(data).to_dict() == data
+
+
+def test_frame_names_are_stable():
+    names = {}
+    first = doc_etl.frame_names(build_trace(), names)
+    saved = dict(names)
+    second = doc_etl.frame_names(build_trace(), names)
+
+    assert (
+        first
+        == second
+        == {
+            "DataFrame_1": "raw",
+            "DataFrame_2": "clean",
+            "DataFrame_3": "clean_output",
+        }
+    )
+    assert names == saved
+
+
+def test_loop_frame_names_are_stable(tmp_path):
+    pytest.importorskip("pandas")
+    run_pipeline(tmp_path)
+    first = json.loads((tmp_path / "doc_etl" / "names.json").read_text())
+    run_pipeline(tmp_path)
+    second = json.loads((tmp_path / "doc_etl" / "names.json").read_text())
+
+    # The DataFrames of each iteration keep distinct names
+    assert first == second
+    assert len(set(first.values())) == len(first) == 6
+
+
+def test_journal_matches_memory(tmp_path, monkeypatch):
+    for key, info in FUNCTIONS.items():
+        monkeypatch.setitem(doc_etl.FUNCTION_REGISTRY, key, info)
+    raw = frame("DataFrame_1", ("id", "amount"))
+    clean = frame("DataFrame_2", ("id",), "clean")
+    batches = [
+        [
+            ("call", "etl.read", None, [], [raw], False),
+            ("metrics", "etl.read", 0.5, 0.25, 0, 3, 0, 24, None),
+        ],
+        [
+            # The DataFrame gets a name after its first call
+            ("call", "etl.clean", None, [raw._replace(name="raw")], [clean], False),
+            ("profile", "etl.clean", "DataFrame_2", {"rows": 3}),
+            ("chunks", "etl.clean", 2),
+        ],
+    ]
+    counts = collections.Counter({"etl.read": 1, "etl.clean": 1})
+
+    memory = doc_etl.TraceStore(functions=dict(FUNCTIONS))
+    journal = doc_etl.TraceJournal(str(tmp_path / "journal.jsonl"), mode="w")
+    for events in batches:
+        doc_etl.apply_events(memory, events, counts)
+        journal.write_events(events, counts)
+    journal.close()
+
+    assert memory.names == {"DataFrame_1": "raw", "DataFrame_2": "clean"}
+    read = doc_etl.read_journal(str(tmp_path / "journal.jsonl"))
+    assert read.to_dict() == memory.to_dict()
+
+
+def test_mermaid_fold():
+    graph = doc_etl.MermaidGraph()
+    center = graph.node("center", '["center"]', "transform")
+    for index in range(5):
+        leaf = graph.node(index, f'["{index}"]')
+        graph.edge(leaf, center)
+        graph.add_class(leaf, "frame", "fill:#fff")
+    graph.node("other", '["other"]')
+
+    graph.fold(3)
+    folded = graph.node("after", '["after"]')
+
+    ids = [node_id for node_id, _, _ in graph.nodes.values()]
+    assert len(ids) == len(set(ids)) == 4
+    lines = list(graph.lines())
+    assert f"{ids[-2]} -->|x5| {center}\n" in lines
+    assert not any(line.startswith("classDef") for line in lines)
+    assert folded not in {center, *ids[:-1]}
+
+
+@pytest.fixture
+def schema_provider():
+    """
+    Set the schema provider of a test, and restore the default one afterwards
+    :return: The set_schema_provider function
+    """
+    yield doc_etl.set_schema_provider
+    doc_etl.set_schema_provider(None)
+
+
+class CountingProvider(doc_etl.SchemaProvider):
+    """
+    Schema provider that counts how many times the schema is read
+    """
+
+    def __init__(self, rows):
+        self.schema = rows
+        self.reads = 0
+
+    def rows(self):
+        self.reads += 1
+        return self.schema
+
+
+def test_file_schema_providers(tmp_path):
+    rows = [["dbo", "orders", "id"], ["dbo", "orders", "amount"], ["dbo", "c", "id"]]
+    (tmp_path / "rows.json").write_text(json.dumps(rows))
+    (tmp_path / "tables.json").write_text(json.dumps({"orders": ["id", "amount"]}))
+
+    index = doc_etl.FileSchemaProvider(str(tmp_path / "rows.json")).build_index()
+    assert index == {"orders": ("id", "amount"), "c": ("id",)}
+    index = doc_etl.FileSchemaProvider(str(tmp_path / "tables.json")).build_index()
+    assert index == {"orders": ("id", "amount")}
+
+
+def test_sqlite_and_const_schema_providers(tmp_path, monkeypatch):
+    connection = sqlite3.connect(tmp_path / "warehouse.db")
+    connection.execute("CREATE TABLE orders (id INTEGER, amount REAL)")
+    connection.execute("CREATE VIEW totals AS SELECT SUM(amount) AS total FROM orders")
+    index = doc_etl.SQLiteSchemaProvider(connection).build_index()
+    assert index == {"orders": ("id", "amount"), "totals": ("total",)}
+
+    module = types.ModuleType("test_schema")
+    module.data_schema = [("dbo", "orders", "id")]
+    monkeypatch.setitem(sys.modules, "test_schema", module)
+    index = doc_etl.ConstSchemaProvider("test_schema").build_index()
+    assert index == {"orders": ("id",)}
+
+
+def test_schema_lookups_are_cached(schema_provider):
+    provider = CountingProvider([("dbo", "orders", "id")])
+    schema_provider(provider)
+
+    assert doc_etl.get_table("orders") == {"orders": ["id"]}
+    assert doc_etl.get_table("orders") is doc_etl.get_table("orders")
+    assert doc_etl.get_table("missing") == {"missing": []}
+    assert provider.reads == 1
+
+    # A new provider drops the cached lookups
+    schema_provider(CountingProvider([("dbo", "orders", "amount")]))
+    assert doc_etl.get_table("orders") == {"orders": ["amount"]}
+
+
+@pytest.mark.parametrize("source", ["json", "sqlite", "rows"])
+def test_schema_failures_are_cached(tmp_path, schema_provider, source):
+    if source == "json":
+        (tmp_path / "schema.json").write_text("{not json")
+        provider = doc_etl.FileSchemaProvider(str(tmp_path / "schema.json"))
+    elif source == "sqlite":
+        provider = doc_etl.SQLiteSchemaProvider(
+            str(tmp_path / "warehouse.db"), "SELECT * FROM missing"
+        )
+    else:
+        provider = CountingProvider([("orders",)])
+    schema_provider(provider)
+
+    with pytest.warns(UserWarning, match="Could not load the database schema"):
+        assert doc_etl.get_table("orders") == {"orders": []}
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        assert doc_etl.get_table("customers") == {"customers": []}
+
+
+def test_frame_labels():
+    registry = doc_etl.FrameRegistry("Test_")
+
+    class Frame:
+        pass
+
+    first, second = Frame(), Frame()
+    assert registry.label(first, "a") == "Test_1"
+    assert registry.label(second, "a") == "Test_2"
+    assert registry.label(first, "b") == "Test_1"
+    assert registry.find(second) == "Test_2"
+
+    # A collected frame is forgotten, so a new frame never gets its label
+    del first
+    assert len(registry) == 1
+    assert registry.label(Frame(), "a") == "Test_3"
+
+    # Objects that can not be weak-referenced are matched by id() and fingerprint
+    values = ("not", "a", "frame")
+    assert registry.label(values, "a") == "Test_4"
+    assert registry.label(values, "a") == "Test_4"
+    assert registry.label(values, "b") == "Test_5"
+    assert registry.find(values) is None
+
+
+def test_schema_fingerprints():
+    pd = pytest.importorskip("pandas")
+    df = pd.DataFrame({"id": [1, 2], "name": ["a", "b"]})
+    same = pd.DataFrame({"id": [3], "name": ["c"]})
+    other = df.astype({"id": "float64"})
+
+    info = doc_etl.log_dataframe_info(df)
+    assert info.columns == ("id", "name")
+    assert info.dtypes == ("int64", str(df["name"].dtype))
+    assert doc_etl.log_dataframe_info(same).fingerprint == info.fingerprint
+    assert doc_etl.log_dataframe_info(other).fingerprint != info.fingerprint
+    assert doc_etl.log_dataframe_info(df).label == info.label
+
+
+def test_returned_frame_reuses_its_info():
+    pd = pytest.importorskip("pandas")
+    df = pd.DataFrame({"id": [1, 2]})
+    info = doc_etl.log_dataframe_info(df, metrics=True, name="df")
+    known = {id(df): info}
+
+    [output] = doc_etl.log_result(df, True, ("result",), known)
+    assert output == info._replace(name="result")
+
+    # A column added in place changes the schema of the same DataFrame
+    df["name"] = ["a", "b"]
+    [output] = doc_etl.log_result(df, False, None, known)
+    assert output.label == info.label
+    assert output.columns == ("id", "name")
+    assert output.fingerprint != info.fingerprint
+
+
+def test_capture_policies(monkeypatch):
+    parse = doc_etl.CapturePolicy.parse
+    monkeypatch.delenv("DOC_ETL_CAPTURE", raising=False)
+    assert parse().mode == "all"
+    monkeypatch.setenv("DOC_ETL_CAPTURE", " First:2 ")
+    assert parse().limit == 2
+    with pytest.raises(ValueError, match="Unsupported capture mode"):
+        parse("every")
+
+    def recorded(policy, calls=5):
+        return [policy.should_record(number) for number in range(1, calls + 1)]
+
+    assert recorded(parse("all")) == [True] * 5
+    assert recorded(parse("first:2")) == [True, True, False, False, False]
+    assert recorded(parse("once")) == [True, False, False, False, False]
+    assert recorded(parse("sample:0")) == [False] * 5
+    assert recorded(parse("sample:1")) == [True] * 5
+    assert parse("aggregate").aggregate and not parse("all").aggregate
+
+
+def test_sampling_keeps_the_random_state():
+    policy = doc_etl.CapturePolicy.parse("sample:0.5")
+    random_state = doc_etl.random.getstate()
+    recorded = [policy.should_record(number) for number in range(1, 201)]
+    assert doc_etl.random.getstate() == random_state
+    assert 0 < sum(recorded) < 200
+
+
+def test_metric_percentiles():
+    metrics = doc_etl.StageMetrics()
+    for wall in range(100, 0, -1):
+        metrics.add(
+            wall, wall / 10, rows_in=2, rows_out=1, bytes_in=8, peak_memory=wall
+        )
+
+    summary = metrics.summary()
+    assert summary["calls"] == 100
+    assert summary["wall_total"] == 5050
+    assert (summary["wall_p50"], summary["wall_p95"], summary["wall_max"]) == (
+        51,
+        95,
+        100,
+    )
+    assert summary["cpu_p95"] == 9.5
+    assert (summary["rows_in"], summary["rows_out"], summary["bytes_in"]) == (
+        200,
+        100,
+        800,
+    )
+    assert summary["peak_memory"] == 100
+    assert doc_etl.StageMetrics.from_summary(summary).summary() == summary
+    assert doc_etl.StageMetrics().summary()["wall_p50"] == 0.0
+
+
+def test_metric_reservoir():
+    metrics = doc_etl.StageMetrics()
+    random_state = doc_etl.random.getstate()
+    for wall in range(5000):
+        metrics.add(wall, 0.0)
+    assert doc_etl.random.getstate() == random_state
+
+    assert len(metrics.wall_samples) == doc_etl.StageMetrics.reservoir_size
+    assert metrics.summary()["wall_max"] == 4999
+    # The reservoir keeps a uniform sample, not the first or last durations
+    assert 1000 < metrics.summary()["wall_p50"] < 4000
+
+
+def test_frame_sizes():
+    pd = pytest.importorskip("pandas")
+    df = pd.DataFrame(
+        {
+            "id": [1, 2, 3],
+            "name": ["a", "b", "c"],
+            "group": pd.Categorical(["x", "y", "x"]),
+            "count": pd.array([1, None, 3], dtype="Int64"),
+        },
+        index=pd.MultiIndex.from_arrays([["a", "b", "c"], [1, 2, 3]]),
+    )
+    adapter = doc_etl.FRAME_ADAPTERS.get(pd.DataFrame)
+    assert adapter.size(df) == df.memory_usage(deep=False).sum()
+    assert adapter.size(df.iloc[:0]) == df.iloc[:0].memory_usage(deep=False).sum()
+
+
+def test_thread_buffers_are_released():
+    def run():
+        buffer = doc_etl.get_buffer()
+        assert buffer is doc_etl.get_buffer()
+        assert buffer in doc_etl.BUFFERS
+        buffer.add("chunks", "test.released", 3)
+        buffers.append(buffer)
+
+    buffers = []
+    threads = [threading.Thread(target=run) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    try:
+        assert len(set(map(id, buffers))) == 4
+        assert not any(buffer in doc_etl.BUFFERS for buffer in buffers)
+        assert not any(buffer.events for buffer in buffers)
+        assert doc_etl.TRACE.chunk_counts["test.released"] == 12
+    finally:
+        del doc_etl.TRACE.chunk_counts["test.released"]
+
+
+def test_concurrent_lineage(tmp_path):
+    pytest.importorskip("pandas")
+    run_pipeline(tmp_path, CONCURRENT_PIPELINE)
+
+    # The calls made by the tasks and the threads are all merged into the trace
+    trace = json.loads((tmp_path / "doc_etl" / "raw.json").read_text())
+    assert {
+        key.rsplit(".", 1)[1]: count for key, count in trace["call_counts"].items()
+    } == {
+        "read_part": 8,
+        "split": 8,
+        "double": 16,
+        "save": 16,
+    }
+    assert trace["chunk_counts"] == {"__main__.split": 16}
+
+    inputs, outputs = collections.defaultdict(set), collections.defaultdict(set)
+    for call in trace["calls"].values():
+        name = call["function"].rsplit(".", 1)[1]
+        inputs[name].update(label for frame in call["input"] for label in frame)
+        outputs[name].update(label for frame in call["output"] for label in frame)
+    assert inputs["split"] == outputs["read_part"]
+    assert len(inputs["double"]) == 16
+    assert inputs["save"] == outputs["double"]
+
+
+def test_record_digests_are_stable():
+    trace = build_trace()
+    digests = [doc_etl.record_digest(trace, record) for _, record in trace.items()]
+    assert len(set(digests)) == 3
+
+    # A call recorded first shifts the record IDs, but not the content of the others
+    shifted = doc_etl.TraceStore(functions=dict(FUNCTIONS))
+    shifted.add_table("orders", ["id", "amount"])
+    shifted.add_call("etl.read", ["orders"], [], [frame("DataFrame_0", ("id",))])
+    for _, record in trace.items():
+        shifted.add_call(record.function, record.db_table, record.input, record.output)
+    shifted.call_counts.update(trace.call_counts)
+    assert [doc_etl.record_digest(shifted, record) for _, record in shifted.items()][
+        1:
+    ] == digests
+
+
+def test_chunk_readers():
+    pd = pytest.importorskip("pandas")
+    reader = pd.read_csv(io.StringIO("id\n1\n2\n"), chunksize=1)
+    assert doc_etl.FRAME_ADAPTERS.is_reader(type(reader))
+    assert not doc_etl.FRAME_ADAPTERS.is_reader(map)
+    assert not doc_etl.FRAME_ADAPTERS.is_reader(types.GeneratorType)
+
+    # The chunks read with get_chunk or by iterating are logged, once per schema
+    log = doc_etl.StreamLog(metrics=True)
+    finished = []
+    stream = doc_etl.FrameStream(reader, log, lambda: finished.append(True))
+    assert len(stream.get_chunk()) == 1
+    assert len(list(stream)) == 1
+    assert finished == [True] and log.chunks == 2
+    [output] = log.outputs()
+    assert output.columns == ("id",) and output.rows == 2
+
+
+def test_stream_lineage(tmp_path):
+    pytest.importorskip("pandas")
+    pytest.importorskip("polars")
+    run_pipeline(tmp_path, STREAM_PIPELINE)
+
+    trace = json.loads((tmp_path / "doc_etl" / "raw.json").read_text())
+    assert trace["chunk_counts"] == {"__main__.read_chunks": 3}
+    calls = {
+        call["function"].rsplit(".", 1)[1]: call for call in trace["calls"].values()
+    }
+    assert calls["read_chunks"]["output"] == [{"read_chunks_output": ["id", "value"]}]
+    # The iterators of other values are returned as they are, without outputs
+    assert calls["read_rows"]["output"] == calls["values"]["output"] == []
+    # The LazyFrames are logged from their plan, without collecting them
+    assert calls["lazy_double"]["output"] == [{"lazy": ["id", "value", "double"]}]
+
+
+def test_prompt_packing():
+    # Each section is 10 tokens, and the header 1
+    sections = {key: key * 40 for key in "abc"}
+
+    # A subgraph is moved to the next prompt instead of being split
+    prompts = doc_etl.pack_prompt("H", sections, [["a"], ["b", "c"]], 26, split=True)
+    assert prompts == ["H" + sections["a"], "H" + sections["b"] + sections["c"]]
+    assert doc_etl.pack_prompt("H", sections, [["a"], ["b", "c"]], 31) == (
+        "H" + sections["a"] + sections["b"] + sections["c"]
+    )
+
+    # A subgraph over the budget is split in the order it was recorded
+    prompts = doc_etl.pack_prompt("H", sections, [["a", "b", "c"]], 26, split=True)
+    assert prompts == ["H" + sections["a"] + sections["b"], "H" + sections["c"]]
+    joined = doc_etl.pack_prompt("H", sections, [["a", "b", "c"]], 26)
+    assert joined.startswith("### Part 1 of 2\n\nH")
+    assert "### Part 2 of 2\n\nH" + sections["c"] in joined
+
+
+def test_prompt_budget(monkeypatch):
+    monkeypatch.setenv("DOC_ETL_PROMPT_TOKENS", "1000")
+    monkeypatch.setattr(doc_etl, "TOKENIZER", None)
+    assert doc_etl.get_prompt_budget() == 1000
+    assert doc_etl.count_tokens("x" * 9) == 3
+    assert doc_etl.tokenizer_name() is None
+
+    doc_etl.set_tokenizer(len)
+    assert doc_etl.count_tokens("x" * 9) == 9
+    assert doc_etl.tokenizer_name() == "builtins.len"
+
+
+def test_code_summary():
+    code = "def load(df):\n"
+    code += "".join(f"    df = df.assign(c{i}=1)\n" for i in range(300))
+    code += "    return clean(df)\n"
+    assert doc_etl.summarize_code("def load(df):\n    return df\n") == (
+        "def load(df):\n    return df\n"
+    )
+
+    summary = doc_etl.summarize_code(code, max_lines=10)
+    assert summary.splitlines()[:6] == code.splitlines()[:5] + [
+        "# ... 297 more lines summarized ..."
+    ]
+    assert "# Calls: assign, clean" in summary
+    assert "# Returns: clean(df)" in summary
+    # The head is shortened to fit the token budget
+    assert doc_etl.count_tokens(doc_etl.summarize_code(code, max_tokens=50)) < 100
+
+
+def test_split_process_prompt():
+    functions = {
+        key: dict(info, code=f"def {key}(): pass") for key, info in FUNCTIONS.items()
+    }
+    trace = build_trace()
+    trace.functions = functions
+    header = doc_etl.write_process_prompt(doc_etl.TraceStore(functions), "transform")
+
+    budget = doc_etl.count_tokens(header) + 10**4
+    [prompt] = doc_etl.write_process_prompt(
+        trace, "transform", budget=budget, split=True
+    )
+    assert prompt.count("Function: clean") == 1
+    assert "Function: read" not in prompt
+    [prompt] = doc_etl.write_intro_prompt(trace, budget=budget, split=True)
+    assert "Function: read" in prompt and "Function: clean" in prompt
+
+    # The functions of the same subgraph are split when they do not fit together
+    prompts = doc_etl.write_intro_prompt(
+        trace, budget=doc_etl.count_tokens(prompt) - 1, split=True
+    )
+    assert len(prompts) == 2
+    assert "Function: read" in prompts[0] and "Function: clean" in prompts[1]
+
+
+def test_disabled_mode(tmp_path):
+    def clean(df):
+        return df
+
+    # The tests import the module disabled, so the process was not prepared either
+    assert doc_etl.transform()(clean) is clean
+    assert not doc_etl.INITIALIZED
+
+    pytest.importorskip("pandas")
+    run_pipeline(tmp_path, DOC_ETL_DISABLED="1")
+    assert not (tmp_path / "doc_etl").exists()
+
+
+def test_once_mode(tmp_path):
+    pytest.importorskip("pandas")
+    run_pipeline(tmp_path, DOC_ETL_CAPTURE="once")
+
+    # The wrappers are replaced with the functions after their first call
+    trace = json.loads((tmp_path / "doc_etl" / "raw.json").read_text())
+    assert trace["call_counts"] == {"__main__.read_part": 1, "__main__.double": 1}
+    assert [call["count"] for call in trace["calls"].values()] == [1, 1]
+
+
+def lineage_trace(*calls):
+    """
+    Build a trace from a list of calls
+    :param calls: Tuples with the function name, the tables, the input DataFrame
+        labels and the output DataFrame labels of each call
+    :return: A TraceStore
+    """
+    functions = {
+        f"etl.{name}": {"name": name, "type": function_type, "docstring": ""}
+        for name, function_type in (
+            ("read", "extract"),
+            ("clean", "transform"),
+            ("save", "insert"),
+        )
+    }
+    trace = doc_etl.TraceStore(functions=functions)
+    for name, tables, inputs, outputs in calls:
+        for table_name in tables:
+            trace.add_table(table_name, ["id"])
+        trace.add_call(
+            f"etl.{name}",
+            tables,
+            [frame(label, ("id",)) for label in inputs],
+            [frame(label, ("id",)) for label in outputs],
+        )
+    return trace
+
+
+def test_lineage_of_unrelated_calls():
+    graph = doc_etl.LineageGraph.from_trace(
+        lineage_trace(
+            ("read", ["A"], [], ["p0"]),
+            ("clean", [], ["p0"], ["d0"]),
+            ("read", ["B"], [], ["p1"]),
+            ("clean", [], ["p1"], ["d1"]),
+        )
+    )
+
+    # Each record of a function has its own node
+    calls = graph.find("function", "etl.clean")
+    assert calls == ["function:etl.clean", "function:etl.clean#2"]
+    assert graph.nodes[calls[1]]["label"] == "clean"
+    assert set(graph.upstream("frame:d0")) == {
+        "function:etl.clean",
+        "frame:p0",
+        "function:etl.read",
+        "table:A",
+    }
+    assert "frame:d0" not in graph.downstream("table:B")
+    assert set(graph.downstream(calls)) == {"frame:d0", "frame:d1"}
+    assert sorted(map(sorted, graph.connected_components())) == [
+        ["frame:d0", "frame:p0", "function:etl.clean", "function:etl.read", "table:A"],
+        [
+            "frame:d1",
+            "frame:p1",
+            "function:etl.clean#2",
+            "function:etl.read#2",
+            "table:B",
+        ],
+    ]
+
+
+def test_lineage_has_no_cycles():
+    trace = lineage_trace(
+        ("read", ["orders"], [], ["p0"]),
+        ("clean", [], ["p0"], ["d0"]),
+        ("clean", [], ["d0"], ["e0"]),
+        # An in-place change returns the DataFrame it was given
+        ("clean", [], ["e0"], ["e0"]),
+        ("save", ["orders"], ["e0"], []),
+        ("read", ["orders"], [], ["r0"]),
+    )
+    graph = doc_etl.LineageGraph.from_trace(trace)
+
+    assert graph.shortest_path("frame:p0", "frame:e0") == [
+        "frame:p0",
+        "function:etl.clean",
+        "frame:d0",
+        "function:etl.clean#2",
+        "frame:e0",
+    ]
+    assert graph.shortest_path("frame:e0", "frame:p0") is None
+
+    # The table written by the pipeline is a new version, read by the next extract
+    order = graph.topological_order()
+    assert order[0] == "table:orders"
+    assert order.index("table:orders#2") < order.index("frame:r0")
+    assert graph.find("frame", "e0") == ["frame:e0", "frame:e0#2"]
+    assert graph.upstream("frame:r0")[:2] == ["function:etl.read#2", "table:orders#2"]
+    assert "table:orders" in graph.upstream("frame:r0")
+    assert len(graph.connected_components()) == 1
+
+    subgraph = graph.subgraph(graph.downstream("frame:e0#2"))
+    assert set(subgraph.nodes) == {
+        "function:etl.save",
+        "table:orders#2",
+        "function:etl.read#2",
+        "frame:r0",
+    }
+    assert len(list(subgraph.edges())) == 3
+
+
+def test_benchmark_lineage():
+    benchmark = pytest.importorskip("benchmark")
+    graph = doc_etl.LineageGraph.from_trace(benchmark.synthetic_trace(200))
+    order = graph.topological_order()
+    assert len(order) == len(graph)
+    positions = {node: index for index, node in enumerate(order)}
+    assert all(
+        positions[source] < positions[target] for source, target in graph.edges()
+    )
+
+
+def test_profile_values():
+    np = pytest.importorskip("numpy")
+    pd = pytest.importorskip("pandas")
+    values = [np.int64(3), np.float64("nan"), np.str_("a"), pd.NA, pd.NaT, True, None]
+    assert list(map(doc_etl.profile_value, values)) == [
+        3,
+        None,
+        "a",
+        None,
+        None,
+        True,
+        None,
+    ]
+    assert doc_etl.profile_value(pd.Timestamp("2020-01-02")) == "2020-01-02 00:00:00"
+
+
+def test_profile_frames():
+    pd = pytest.importorskip("pandas")
+    df = pd.DataFrame(
+        {
+            "id": [1, 2, 3, None],
+            "when": pd.to_datetime(["2020-01-01", "2021-01-01", None, "2019-05-05"]),
+            "tags": [[1], [2], [1], [3]],
+        }
+    )
+    profile = doc_etl.profile_frame(df)
+    assert (profile["rows"], profile["profiled_rows"]) == (4, 4)
+    assert profile["columns"]["id"] == {
+        "dtype": "float64",
+        "nulls": 1,
+        "distinct": 3,
+        "min": 1.0,
+        "max": 3.0,
+    }
+    assert profile["columns"]["when"]["min"] == "2019-05-05 00:00:00"
+    # The lists have no distinct count, minimum or maximum
+    assert profile["columns"]["tags"]["distinct"] is None
+
+    # The large DataFrames are profiled on the same sample in every run
+    large = pd.DataFrame({"x": range(1000)})
+    profile = doc_etl.profile_frame(large, sample_rows=10)
+    assert (profile["rows"], profile["profiled_rows"]) == (1000, 10)
+    assert profile == doc_etl.profile_frame(large, sample_rows=10)
+
+    # The LazyFrames are not profiled, since it would run their plan
+    pl = pytest.importorskip("polars")
+    assert doc_etl.profile_frame(pl.LazyFrame({"x": [1]})) is None
+    profile = doc_etl.profile_frame(pl.DataFrame({"x": [1, None]}))
+    assert profile["columns"]["x"]["nulls"] == 1
+
+
+def test_profiler_budget(monkeypatch):
+    pd = pytest.importorskip("pandas")
+    monkeypatch.setattr(doc_etl, "PROFILED_LABELS", set())
+    frames = [pd.DataFrame({"id": [1, 2]}), pd.DataFrame({"id": [3]})]
+    infos = [frame("Test_1", ("id",)), frame("Test_2", ("id",))]
+
+    # Each label is profiled once
+    buffer = doc_etl.TraceBuffer()
+    profiler = doc_etl.Profiler(budget=10)
+    profiler.profile(buffer, "etl.clean", frames, infos, profiler.deadline())
+    profiler.profile(buffer, "etl.clean", frames, infos, profiler.deadline())
+    assert [event[2] for event in buffer.events] == ["Test_1", "Test_2"]
+    assert buffer.events[0][3]["rows"] == 2
+    assert profiler.seconds_per_row > 0
+
+    # The DataFrames left when the budget is spent are not profiled
+    monkeypatch.setattr(doc_etl, "PROFILED_LABELS", set())
+    buffer = doc_etl.TraceBuffer()
+    profiler = doc_etl.Profiler(budget=0)
+    profiler.profile(buffer, "etl.clean", frames, infos, profiler.deadline())
+    assert not buffer.events
+
+    monkeypatch.setenv("DOC_ETL_PROFILE_BUDGET", "0.5")
+    assert doc_etl.Profiler().budget == 0.5
+
+
+@pytest.mark.parametrize("format", ["parquet", "ipc"])
+def test_columnar_round_trip(tmp_path, format):
+    pytest.importorskip("polars")
+    trace = build_trace()
+    code = {"file": "etl.py", "first_line": 1, "last_line": 2}
+    trace.functions = {
+        key: dict(info, code=f"def {info['name']}(): pass", **code)
+        for key, info in FUNCTIONS.items()
+    }
+    trace.add_table("empty", [])
+    trace.add_call("etl.read", ["empty"], [], [frame("DataFrame_4", ())])
+    trace.add_metrics("etl.clean", 0.5, 0.25, 3, 3, 24, 24, None)
+    trace.add_metrics("etl.clean", 1.5, 0.75, 3, 3, 24, 24, 1024)
+    trace.add_profile("DataFrame_1", {"rows": 3, "profiled_rows": 3, "columns": {}})
+    trace.chunk_counts["etl.read"] = 2
+
+    doc_etl.write_columnar(trace, str(tmp_path / "trace"), format)
+    loaded = doc_etl.read_columnar(str(tmp_path / "trace"))
+    assert loaded.to_dict() == trace.to_dict()
+    assert loaded.metrics["etl.clean"].summary() == trace.metrics["etl.clean"].summary()
+
+
+def test_columnar_empty_trace(tmp_path):
+    pytest.importorskip("polars")
+    trace = doc_etl.TraceStore(functions={})
+    doc_etl.write_columnar(trace, str(tmp_path), "ipc")
+    assert doc_etl.read_columnar(str(tmp_path)).to_dict() == trace.to_dict()
+
+    (tmp_path / "calls.arrow").unlink()
+    with pytest.raises(FileNotFoundError, match="Missing calls table"):
+        doc_etl.read_columnar(str(tmp_path))
+
+
+def test_lazy_imports(tmp_path):
+    check = (
+        "import sys, doc_etl; "
+        "print(sorted({'numpy', 'pandas', 'polars', 'pyarrow'} & set(sys.modules)))"
+    )
+    env = {key: value for key, value in os.environ.items() if key != "DOC_ETL_DISABLED"}
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [ROOT, env.get("PYTHONPATH")]))
+    process = subprocess.run(
+        [sys.executable, "-c", check],
+        cwd=tmp_path,
+        env=env,
+        check=True,
+        capture_output=True,
+        text=True,
+        timeout=120,
+    )
+    assert process.stdout.splitlines()[0] == "[]"
+
+
+def test_frame_adapters():
+    np = pytest.importorskip("numpy")
+    pa = pytest.importorskip("pyarrow")
+    pl = pytest.importorskip("polars")
+    records = np.rec.array([(1, "a"), (2, "b")], dtype=[("id", "i8"), ("name", "U1")])
+    assert doc_etl.frame_schema(records, True) == (
+        ("id", "name"),
+        ("int64", "<U1"),
+        2,
+        24,
+    )
+    assert doc_etl.frame_schema(pa.table({"id": [1, 2]}), True) == (
+        ("id",),
+        ("int64",),
+        2,
+        16,
+    )
+    assert doc_etl.frame_schema(pl.DataFrame({"id": [1]}), True) == (
+        ("id",),
+        ("Int64",),
+        1,
+        8,
+    )
+    # The LazyFrames are not run to count their rows
+    assert doc_etl.frame_schema(pl.LazyFrame({"id": [1]}), True) == (
+        ("id",),
+        ("Int64",),
+        None,
+        None,
+    )
+    assert not doc_etl.is_frame(np.zeros(2)) and not doc_etl.is_frame([1])
+    with pytest.raises(TypeError, match="Unsupported DataFrame type: list"):
+        doc_etl.frame_schema([1])
+
+
+def test_adapter_registry(monkeypatch):
+    class Frame:
+        pass
+
+    class SubFrame(Frame):
+        pass
+
+    module = types.ModuleType("test_frames")
+    module.Frame = Frame
+
+    class FrameAdapter(doc_etl.FrameAdapter):
+        library = "test_frames"
+
+        def types(self):
+            return (self.module.Frame,)
+
+        def schema(self, df):
+            return ("id",), ("int64",)
+
+    registry = doc_etl.AdapterRegistry()
+    registry.register(FrameAdapter)
+    # The adapter is not loaded before its library is imported
+    assert registry.get(Frame) is None
+
+    registry = doc_etl.AdapterRegistry()
+    registry.register(FrameAdapter)
+    monkeypatch.setitem(sys.modules, "test_frames", module)
+    adapter = registry.get(SubFrame)
+    assert isinstance(adapter, FrameAdapter) and adapter.module is module
+    assert registry.get(Frame) is adapter
+    assert adapter.rows(Frame()) is None and adapter.statistics(Frame()) is None
+    assert not registry.is_reader(Frame)
+
+
+def record_runs(path):
+    """
+    Record three runs of the test trace and a last run with a slower clean, with new
+    code and a new output column
+    :param path: A path with the history database
+    :return: None
+    """
+    history = doc_etl.HistoryStore(str(path))
+    for index, wall in enumerate((1.0, 1.2, 1.1)):
+        trace = build_trace()
+        trace.add_metrics("etl.clean", wall, wall)
+        history.record(trace, created=1000 + index)
+
+    trace = build_trace()
+    trace.functions["etl.clean"] = dict(trace.functions["etl.clean"], code_hash="3")
+    raw, output = frame("DataFrame_1", ("id", "amount")), frame("DataFrame_5", ("x",))
+    trace.add_call("etl.clean", [], [raw], [output])
+    trace.call_counts["etl.clean"] += 1
+    trace.add_metrics("etl.clean", 5.0, 5.0)
+    history.record(trace, created=2000)
+    history.close()
+
+
+def test_history_queries(tmp_path):
+    record_runs(tmp_path / "history.sqlite")
+    history = doc_etl.HistoryStore(str(tmp_path / "history.sqlite"))
+
+    assert [run for run, _, _ in history.runs()] == [4, 3, 2, 1]
+    assert history.resolve(None) == 4 and history.resolve(-1) == 3
+    with pytest.raises(ValueError, match="Unknown run: 9"):
+        history.resolve(9)
+    changes = history.changes(-1)
+    assert (changes["since"], changes["until"]) == (3, 4)
+    assert changes["code_changed"] == ["etl.clean"]
+    assert changes["calls_changed"] == {"etl.clean": (2, 3)}
+    assert changes["functions_added"] == changes["schemas_removed"] == []
+    assert changes["schemas_changed"] == [("frame", "etl.clean:output:0")]
+    assert history.column_changes(1) == [
+        {
+            "kind": "frame",
+            "name": "etl.clean:output:0",
+            "appeared": ["x"],
+            "disappeared": [],
+            "retyped": {},
+        }
+    ]
+    assert history.changes(2, 3)["schemas_changed"] == []
+
+    # The last run is compared with the median of the previous ones
+    assert history.slower(1) == [("etl.clean", 1.1, 5.0, 5.0 / 1.1)]
+    assert history.slower(1, threshold=5) == []
+    with pytest.raises(ValueError, match="Unknown metric"):
+        history.slower(1, metric="rows")
+    history.close()
+
+
+def test_history_cli(tmp_path, capsys):
+    database = str(tmp_path / "history.sqlite")
+    record_runs(database)
+
+    assert doc_etl.main(["history", "--db", database, "runs", "--limit", "2"]) == 0
+    assert [line.split("\t")[0] for line in capsys.readouterr().out.splitlines()] == [
+        "4",
+        "3",
+    ]
+
+    doc_etl.main(["history", "--db", database, "changes", "-1"])
+    assert capsys.readouterr().out.splitlines() == [
+        "Changes from run 3 to run 4",
+        "code changed: etl.clean",
+        "schemas changed: frame etl.clean:output:0",
+        "calls changed: etl.clean 2 -> 3",
+    ]
+
+    doc_etl.main(["history", "--db", database, "columns", "1"])
+    assert capsys.readouterr().out == "frame etl.clean:output:0\n  + x\n"
+
+    doc_etl.main(["history", "--db", database, "slower", "1", "--until", "4"])
+    [line] = capsys.readouterr().out.splitlines()
+    assert line.startswith("etl.clean\t") and line.endswith("\tx4.55")
+
+    with pytest.raises(SystemExit) as error:
+        doc_etl.main(["history", "--db", database, "slower", "1", "--metric", "x"])
+    assert error.value.code == 2
+    assert "Unknown metric: x" in capsys.readouterr().err
+
+
+def column_edges(trace):
+    """
+    Get the column lineage of a trace as a set
+    :param trace: A TraceStore with the information
+    :return: A set with tuples of the function name, kind, source, target and columns
+    """
+    return {
+        (
+            edge["function"].split(".")[1],
+            edge["kind"],
+            edge["source"],
+            edge["target"],
+            tuple(edge["columns"]),
+        )
+        for edge in doc_etl.column_lineage(trace)
+    }
+
+
+def test_column_lineage():
+    trace = lineage_trace()
+    trace.add_table("orders", ["id", "amount"])
+    trace.add_table("archive", ["id", "total"])
+    raw = frame("raw", ("id", "amount", "loaded"))
+    clean = frame("clean", ("id", "total"))
+    trace.add_call("etl.read", ["orders"], [], [raw])
+    trace.add_call("etl.clean", [], [raw], [clean])
+    trace.add_call("etl.save", ["archive"], [clean], [])
+
+    assert column_edges(trace) == {
+        ("read", "passed", "table:orders", "frame:raw", ("id", "amount")),
+        ("read", "added", "function:etl.read", "frame:raw", ("loaded",)),
+        ("clean", "passed", "frame:raw", "frame:clean", ("id",)),
+        ("clean", "added", "function:etl.clean", "frame:clean", ("total",)),
+        ("clean", "dropped", "frame:raw", "function:etl.clean", ("amount", "loaded")),
+        ("save", "passed", "frame:clean", "table:archive", ("id", "total")),
+    }
+
+
+def test_column_lineage_of_unknown_tables():
+    # The tables of the default schema provider have no columns
+    trace = lineage_trace()
+    trace.add_table("unknown", [])
+    trace.add_table("archive", ["id"])
+    raw, empty = frame("raw", ("id", "amount")), frame("empty", ())
+    trace.add_call("etl.read", ["unknown"], [], [raw])
+    trace.add_call("etl.save", ["unknown"], [raw], [])
+    assert column_edges(trace) == set()
+
+    # Only the known tables are diffed, and an empty DataFrame has a known schema
+    trace.add_call("etl.save", ["unknown", "archive"], [raw], [])
+    trace.add_call("etl.clean", [], [raw], [empty])
+    assert column_edges(trace) == {
+        ("save", "passed", "frame:raw", "table:archive", ("id",)),
+        ("clean", "dropped", "frame:raw", "function:etl.clean", ("id", "amount")),
+    }
+
+
+def test_column_lineage_cache():
+    doc_etl.column_diff.cache_clear()
+    doc_etl.schema_lineage.cache_clear()
+    trace = lineage_trace()
+    for index in range(3):
+        trace.add_call(
+            "etl.clean",
+            [],
+            [frame(f"raw_{index}", ("id", "amount"))],
+            [frame(f"clean_{index}", ("id",))],
+        )
+    assert len(doc_etl.column_lineage(trace)) == 6
+
+    # The calls with the same schemas are diffed once
+    assert doc_etl.schema_lineage.cache_info().misses == 1
+    assert doc_etl.schema_lineage.cache_info().hits == 2
+    assert doc_etl.column_diff.cache_info().misses == 1
+    assert doc_etl.column_diff(("id", "amount"), ("id",)) == (("id",), (), ("amount",))
+    assert doc_etl.column_diff.cache_info().hits == 1